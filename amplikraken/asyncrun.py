@@ -0,0 +1,137 @@
+# This file contains an asyncio runner, managing many kraken2 processes from a single event loop
+import os
+import sys
+import asyncio
+import functools
+import inspect
+import weakref
+import amplikraken.utils
+from amplikraken.run import KrakenRunner, CONSUMER_BATCH
+from amplikraken.consumers import OutputWriter
+
+# Bytes read at a time from the output of kraken2
+READ_SIZE = 1024 * 1024
+
+
+class AsyncKrakenRunner(KrakenRunner):
+    """
+    Run kraken2 from asyncio: each run() is a coroutine, so one event loop (and one thread) can
+    drive many kraken2 processes at once, at most `limit` at a time (default: as many as the
+    CPUs allow with `threads` each). The output and the errors of kraken2 are read without
+    blocking, and the output is fed to `consumers` (amplikraken.consumers, whose methods can
+    also be coroutines; the other methods run in the default executor, off the event loop) in
+    batches. Cancelling a run, or exceeding its timeout, kills kraken2 and aborts the consumers.
+    Only files are classified: iterables of records, the standard input, the result cache and
+    the trimmer of KrakenRunner are not supported (use KrakenRunner or KrakenBatch).
+
+    Input:
+        runner = AsyncKrakenRunner("db/silva138", threads=4, limit=16, timeout=3600)
+        asyncio.run(runner.run_datasets(datasets, "output"))
+    Output:
+        {"Sample1": "output/Sample1.tsv", "Sample2": RuntimeError("Error running Kraken2: ..."), ...}
+    """
+    def __init__(self, db, binary="kraken2", threads=1, confidence=0.0, verbose=False, keepunclassified=False, names=True, limit=None, timeout=None, memory_mapping=False):
+        super().__init__(db, binary=binary, threads=threads, confidence=confidence, verbose=verbose, keepunclassified=keepunclassified, names=names, memory_mapping=memory_mapping)
+        self.limit = limit if limit else max(1, (os.cpu_count() or 1) // max(1, threads))
+        self.timeout = timeout
+        # One semaphore per event loop: a semaphore cannot be shared between loops
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def __repr__(self) -> str:
+        return f"AsyncKrakenRunner({self.db}, threads={self.threads}, limit={self.limit})"
+
+    async def run(self, file1, file2=None, output=None, consumers=None, timeout=None):
+        """
+        Classify the reads of one sample once a slot is free, saving the output to `output`
+        (if set) and feeding the `consumers`, whose results are returned. Without output and
+        consumers the output is printed. `timeout` (seconds) overrides the one of the runner
+        """
+        if file1 == "-" or not isinstance(file1, (str, os.PathLike)):
+            raise ValueError("AsyncKrakenRunner only classifies files: use KrakenRunner for iterables of records and standard input")
+        if self.cache is not None or self.trimmer is not None:
+            raise ValueError("AsyncKrakenRunner does not support the result cache and the trimmer: use KrakenRunner or KrakenBatch")
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.limit)
+        consumers = list(consumers) if consumers else []
+        writers = [OutputWriter(output, unclassified=self.keepunclassified)] if output else []
+        timeout = timeout if timeout is not None else self.timeout
+        async with self._semaphores[loop]:
+            try:
+                results = await asyncio.wait_for(self._run(self._command(file1, file2), consumers + writers), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Kraken2 did not finish in {timeout} seconds on {file1}") from None
+        return results[:len(consumers)]
+
+    async def run_datasets(self, datasets, outdir, timeout=None):
+        """
+        Classify a list of FastqDataset (or a FastqDatasets) concurrently, saving the outputs
+        as {outdir}/{sample}.tsv. Returns {sample: output file, or the exception of the run}
+        """
+        if hasattr(datasets, "datasets"):
+            datasets = list(datasets.datasets.values())
+        os.makedirs(outdir, exist_ok=True)
+        outputs = {dataset.name: os.path.join(outdir, f"{dataset.name}.tsv") for dataset in datasets}
+        results = await asyncio.gather(*(self.run(dataset.forward, dataset.reverse, output=outputs[dataset.name], timeout=timeout)
+                                         for dataset in datasets), return_exceptions=True)
+        return {dataset.name: result if isinstance(result, BaseException) else outputs[dataset.name]
+                for dataset, result in zip(datasets, results)}
+
+    async def _run(self, cmd, consumers):
+        cmd = amplikraken.utils.list_to_string(cmd)
+        if self.verbose:
+            print(" ".join(cmd), file=sys.stderr)
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        # Read stderr while reading stdout: kraken2 blocks if the stderr pipe fills up
+        errors = asyncio.ensure_future(process.stderr.read())
+        try:
+            rest = b""
+            while True:
+                chunk = await process.stdout.read(READ_SIZE)
+                if not chunk:
+                    break
+                lines = (rest + chunk).split(b"\n")
+                rest = lines.pop()
+                for start in range(0, len(lines), CONSUMER_BATCH):
+                    await self._feed(consumers, [line.decode() + "\n" for line in lines[start:start + CONSUMER_BATCH]])
+            if rest:
+                await self._feed(consumers, [rest.decode() + "\n"])
+            return_code = await process.wait()
+            error_message = (await errors).decode(errors="replace")
+        except BaseException:
+            # Cancelled, timed out or failed consumer: stop kraken2
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            errors.cancel()
+            await _call_all(consumers, "abort")
+            raise
+
+        if return_code != 0:
+            await _call_all(consumers, "abort")
+            raise RuntimeError(f"Error running Kraken2: {error_message}")
+        return await _call_all(consumers, "close")
+
+    async def _feed(self, consumers, lines):
+        if not consumers:
+            await _call(self._print, lines)
+        for consumer in consumers:
+            await _call(consumer.feed, lines)
+
+    def _print(self, lines):
+        for line in lines:
+            self.process_line(line)
+
+
+async def _call(method, *args):
+    # Await a coroutine consumer method, run the others in the default executor so that
+    # they do not block the event loop
+    if inspect.iscoroutinefunction(method):
+        return await method(*args)
+    result = await asyncio.get_running_loop().run_in_executor(None, functools.partial(method, *args))
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+async def _call_all(consumers, name):
+    return [await _call(getattr(consumer, name)) for consumer in consumers]
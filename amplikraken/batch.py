@@ -0,0 +1,201 @@
+# This file contains a scheduler running Kraken2 on many samples at once
+import os
+import sys
+import shutil
+import concurrent.futures
+from amplikraken.run import KrakenRunner, KrakenMultiplexRunner
+from amplikraken.taxonomy import load_taxonomy
+from amplikraken.consumers import KrakenNamer, KrakenReporter, OutputWriter
+from amplikraken.derep import Dereplicator, expand_output
+from amplikraken.database import resolve_database
+
+
+def database_memory(db):
+    """
+    Memory needed by one kraken2 process: the size of the database files it loads (*.k2d)
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(db) if entry.name.endswith(".k2d"))
+
+def available_memory():
+    """
+    Available physical memory in bytes, or None if it cannot be read
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def dataset_size(dataset):
+    return sum(os.path.getsize(f) for f in (dataset.forward, dataset.reverse) if f is not None)
+
+
+class KrakenBatch:
+    """
+    Run Kraken2 on all the samples of a FastqDatasets, several processes at a time, sharing a
+    budget of `threads` and `memory` (bytes, default: the available memory). Each process needs
+    the whole database in memory, so the number of parallel jobs is limited by both, and the
+    threads are split among them. Largest samples start first, and samples whose output
+    ({outdir}/{sample}.tsv) already exists are skipped.
+    With `multiplex=True` all the samples are classified by a single kraken2 process instead
+    (one for the paired-end and one for the single-end samples), using all the threads.
+    With `report=True` each sample also gets the kraken2 report ({outdir}/{sample}.report):
+    kraken2 runs once without names, and the names and the report are added in Python
+    from the database taxonomy. A KrakenResultCache as `cache` avoids classifying again the
+    samples already classified with the same database and parameters.
+    With `dereplicate=True` only the unique reads (or pairs) are classified, and the output
+    is expanded back to every read, identical to the output of classifying all of them.
+    With a ReadTrimmer as `trimmer` the reads are trimmed and filtered on the fly (before the
+    dereplication, if any) and streamed into kraken2 without intermediate files.
+    With a DatabaseManager as `staging` the database (a directory or an akget code) is staged
+    on local storage for the run, and kraken2 maps it (--memory-mapping): the processes share
+    one copy in the page cache, so the number of jobs is no longer limited by the memory.
+
+    Input:
+        batch = KrakenBatch("db/silva138", "output", threads=32)
+        batch.run(pairedend_samples_from_path("data"))
+    Output:
+        {"Sample1": "output/Sample1.tsv", ...}
+    """
+    def __init__(self, db, outdir, binary="kraken2", threads=None, memory=None, jobs=None, confidence=0.0, keepunclassified=False, multiplex=False, report=False, cache=None, dereplicate=False, trimmer=None, staging=None, verbose=False) -> None:
+        self.db = resolve_database(db)
+        self.outdir = outdir
+        self.binary = binary
+        self.threads = threads if threads else os.cpu_count()
+        self.memory = memory if memory else available_memory()
+        self.jobs = jobs
+        self.confidence = confidence
+        self.keepunclassified = keepunclassified
+        self.multiplex = multiplex
+        self.report = report
+        self.cache = cache
+        self.dereplicate = dereplicate
+        self.trimmer = trimmer
+        self.staging = staging
+        self._db = self.db
+        if multiplex and (report or dereplicate or trimmer):
+            raise ValueError("Reports, dereplication and trimming are not available in multiplexed runs")
+        self.verbose = verbose
+
+    def __repr__(self) -> str:
+        return f"KrakenBatch({self.db}, {self.outdir}, threads={self.threads}, memory={self.memory})"
+
+    def output(self, dataset):
+        return os.path.join(self.outdir, f"{dataset.name}.tsv")
+
+    def plan(self, datasets):
+        """
+        Samples still to run (valid and without output), largest first
+        """
+        todo = []
+        for dataset in datasets.datasets.values():
+            if not dataset.valid or dataset.forward is None:
+                print(f"Skipping {dataset}: incomplete", file=sys.stderr)
+            elif os.path.exists(self.output(dataset)):
+                if self.verbose:
+                    print(f"Skipping {dataset.name}: {self.output(dataset)} exists", file=sys.stderr)
+            else:
+                todo.append(dataset)
+        return sorted(todo, key=lambda dataset: (-dataset_size(dataset), dataset.name))
+
+    def slots(self, samples):
+        """
+        Number of parallel jobs and threads per job for a number of samples
+        """
+        jobs = min(max(samples, 1), self.threads)
+        if self.jobs:
+            jobs = min(jobs, self.jobs)
+        if self.memory is not None and self.staging is None:
+            per_job = database_memory(self.db)
+            if per_job > 0:
+                jobs = min(jobs, max(1, self.memory // per_job))
+        return jobs, max(1, self.threads // jobs)
+
+    def run(self, datasets):
+        """
+        Classify the samples, returning {sample: output file} for the samples run now.
+        Failures are reported after all the other samples are done
+        """
+        os.makedirs(self.outdir, exist_ok=True)
+        todo = self.plan(datasets)
+        if self.staging is None or not todo:
+            return self._run_all(todo)
+        with self.staging.acquire(self.db) as staged:
+            self._db = staged.path
+            try:
+                return self._run_all(todo)
+            finally:
+                self._db = self.db
+
+    def _run_all(self, todo):
+        if self.multiplex:
+            return self._run_multiplexed(todo)
+        jobs, threads = self.slots(len(todo))
+        if self.report and todo:
+            self._taxonomy = load_taxonomy(self._db).index
+        if self.verbose:
+            print(f"Running {len(todo)} samples, {jobs} at a time with {threads} threads each", file=sys.stderr)
+
+        outputs, errors = {}, {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(self._run, dataset, threads): dataset for dataset in todo}
+            for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                dataset = futures[future]
+                try:
+                    outputs[dataset.name] = future.result()
+                    print(f"Done [{done}/{len(todo)}] {dataset.name}", file=sys.stderr)
+                except Exception as e:
+                    errors[dataset.name] = e
+                    print(f"Failed [{done}/{len(todo)}] {dataset.name}: {e}", file=sys.stderr)
+
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(f"Result cache: {stats['hits']} hits, {stats['misses']} misses", file=sys.stderr)
+        if errors:
+            raise RuntimeError(f"Kraken2 failed on {len(errors)} samples: {', '.join(errors)}")
+        return outputs
+
+    def _run(self, dataset, threads):
+        file1, file2 = dataset.forward, dataset.reverse
+        output = self.output(dataset)
+        if not self.dereplicate:
+            self._classify(dataset, file1, file2, output, threads, self.trimmer)
+            return output
+
+        workdir = os.path.join(self.outdir, f".derep-{dataset.name}")
+        try:
+            derep = Dereplicator(workdir)
+            file1, file2 = derep.run(file1, file2, trimmer=self.trimmer)
+            if self.verbose:
+                print(f"{dataset.name}: {derep.uniques} unique of {derep.reads} reads", file=sys.stderr)
+            uniques = os.path.join(workdir, "uniques.tsv")
+            self._classify(dataset, file1, file2, uniques, threads, None)
+            with open(uniques) as lines:
+                expand_output(lines, derep.mapping, output, max_uniques=derep.max_uniques, partitions=derep.partitions)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return output
+
+    def _classify(self, dataset, file1, file2, output, threads, trimmer):
+        if self.report:
+            # A single kraken2 pass for the output with names and the report
+            consumers = [KrakenReporter(self._taxonomy, os.path.join(self.outdir, f"{dataset.name}.report"), weighted=self.dereplicate),
+                         KrakenNamer(self._taxonomy, OutputWriter(output, unclassified=self.keepunclassified))]
+            runner = KrakenRunner(self._db, binary=self.binary, threads=threads, confidence=self.confidence,
+                                  verbose=self.verbose, consumers=consumers, names=False, cache=self.cache, trimmer=trimmer,
+                                  memory_mapping=self.staging is not None)
+        else:
+            runner = KrakenRunner(self._db, binary=self.binary, threads=threads, confidence=self.confidence,
+                                  output=output, verbose=self.verbose, keepunclassified=self.keepunclassified, cache=self.cache, trimmer=trimmer,
+                                  memory_mapping=self.staging is not None)
+        runner.run(file1, file2)
+
+    def _run_multiplexed(self, todo):
+        outputs = {}
+        for paired in (True, False):
+            group = [dataset for dataset in todo if (dataset.reverse is not None) == paired]
+            if group:
+                runner = KrakenMultiplexRunner(self._db, binary=self.binary, threads=self.threads, confidence=self.confidence,
+                                               verbose=self.verbose, keepunclassified=self.keepunclassified, memory_mapping=self.staging is not None)
+                outputs.update(runner.run(group, outdir=self.outdir))
+                print(f"Done {len(group)} samples in one run", file=sys.stderr)
+        return outputs
@@ -0,0 +1,464 @@
+# This file contains classes to cache Kraken2 outputs: parsed, in a binary columnar format,
+# and the results of kraken2 runs
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import xopen
+import numpy as np
+import pandas as pd
+
+# Columns saved for each read, and their type
+CACHE_COLUMNS = {
+    "classified": np.uint8,
+    "taxid": np.int32,
+    "len1": np.int32,
+    "len2": np.int32,
+    "total": np.int32,
+    "defined": np.int32,
+}
+
+def file_hash(filename, blocksize=1024 * 1024):
+    """
+    Content hash of a file (blake2b)
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class KrakenCache:
+    """
+    Directory of parsed Kraken2 outputs, each saved as raw binary columns that are memory-mapped
+    when loaded. Entries are keyed by the content hash of the file, and a key from the path,
+    size and modification time avoids hashing files already seen. When the directory grows
+    larger than `maxsize` bytes the least recently used entries are removed.
+    With `kmers=True` the LCA strings are saved too, as needed to re-score with a taxonomy.
+    """
+    def __init__(self, directory, maxsize=10 * 1024 ** 3, kmers=False) -> None:
+        self.directory = os.path.abspath(directory)
+        self.maxsize = maxsize
+        self.kmers = kmers
+        self._hashes = {}
+        os.makedirs(os.path.join(self.directory, "keys"), exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"KrakenCache({self.directory}, maxsize={self.maxsize})"
+
+    def get(self, filename):
+        """
+        Return the cached KrakenCacheEntry for a file, or None
+        """
+        keyfile = self._keyfile(filename)
+        try:
+            with open(keyfile) as f:
+                entry = self._entry(f.read().strip())
+            if entry is not None:
+                return entry
+        except FileNotFoundError:
+            pass
+
+        # Unknown (or modified) file: it might still be a copy of a cached one
+        entry = self._entry(self._hash(filename))
+        if entry is not None:
+            self._write_key(filename, entry.hash)
+        return entry
+
+    def content_hash(self, filename):
+        """
+        Content hash of a file (as file_hash()), without reading it again when already known
+        """
+        try:
+            with open(self._keyfile(filename)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return self._hash(filename)
+
+    def writer(self, filename, kmers=None):
+        return KrakenCacheWriter(self, filename, kmers=self.kmers if kmers is None else kmers)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in maxsize
+        """
+        _evict(self.directory, self.maxsize)
+
+        # Drop the keys pointing to removed entries (other processes may be replacing or removing keys)
+        keys = os.path.join(self.directory, "keys")
+        for key in os.listdir(keys):
+            if key.startswith(".tmp-"):
+                continue
+            try:
+                with open(os.path.join(keys, key)) as f:
+                    content_hash = f.read().strip()
+                if not os.path.isdir(os.path.join(self.directory, content_hash)):
+                    os.remove(os.path.join(keys, key))
+            except FileNotFoundError:
+                pass
+
+    def _entry(self, content_hash):
+        path = os.path.join(self.directory, content_hash)
+        try:
+            entry = KrakenCacheEntry(path)
+            # Mark as recently used
+            os.utime(os.path.join(path, "meta.json"))
+        except FileNotFoundError:
+            # Not cached, or evicted meanwhile by another process
+            return None
+        return entry
+
+    def _hash(self, filename):
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            self._hashes[key] = file_hash(filename)
+        return self._hashes[key]
+
+    def _keyfile(self, filename):
+        stat = os.stat(filename)
+        key = f"{os.path.abspath(filename)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        return os.path.join(self.directory, "keys", hashlib.sha1(key.encode()).hexdigest())
+
+    def _write_key(self, filename, content_hash):
+        _write_atomic(self._keyfile(filename), content_hash)
+
+
+class KrakenCacheEntry:
+    """
+    A cached Kraken2 output: columns are memory-mapped, read-only arrays
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.hash = os.path.basename(path)
+        self.kmers = self.meta["kmers"]
+        self.columns = {name: self._map(name, dtype) for name, dtype in self.meta["columns"].items()}
+
+    def __len__(self):
+        return self.meta["reads"]
+
+    def _map(self, name, dtype):
+        filename = os.path.join(self.path, f"{name}.bin")
+        if os.path.getsize(filename) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode="r")
+
+    def chunks(self, chunksize=None):
+        """
+        Yield the reads as DataFrames like the parsed (and validated) Kraken2 output,
+        with the k-mer run counts in place of the LCA strings unless they were saved
+        """
+        chunksize = chunksize or max(len(self), 1)
+        for start in range(0, len(self), chunksize):
+            stop = min(start + chunksize, len(self))
+            columns = {name: np.asarray(values[start:stop]) for name, values in self.columns.items()}
+            table = pd.DataFrame({
+                "Classification": np.where(columns["classified"] == 1, "C", "U"),
+                "TaxID": columns["taxid"].astype(np.int64),
+                "Len": _lengths(columns["len1"], columns["len2"]),
+            }, index=pd.RangeIndex(start, stop))
+            if self.kmers:
+                offsets = columns["kmers_offset"]
+                end = self.columns["kmers_offset"][stop] if stop < len(self) else len(self.columns["kmers"])
+                blob = self.columns["kmers"][offsets[0]:end].tobytes().decode()
+                table["kmers"] = blob.split("\n")[:-1]
+            table["total"] = columns["total"].astype(np.int64)
+            table["defined"] = columns["defined"].astype(np.int64)
+            yield table
+
+
+class KrakenCacheWriter:
+    """
+    Write a cache entry chunk by chunk, in a temporary directory renamed on commit()
+    """
+    def __init__(self, cache, filename, kmers=False) -> None:
+        self.cache = cache
+        self.filename = filename
+        self.kmers = kmers
+        self.reads = 0
+        self.path = tempfile.mkdtemp(prefix=".tmp-", dir=cache.directory)
+        self.columns = dict(CACHE_COLUMNS)
+        if kmers:
+            self.columns.update({"kmers": np.uint8, "kmers_offset": np.int64})
+        self._files = {name: open(os.path.join(self.path, f"{name}.bin"), "wb") for name in self.columns}
+        self._kmers_size = 0
+
+    def append(self, table):
+        """
+        Save a validated chunk, with the k-mer run counts in the 'total' and 'defined' columns
+        """
+        lengths = table["Len"].astype(str).str.partition("|")
+        columns = {
+            "classified": (table["Classification"] == "C").values,
+            "taxid": table["TaxID"].values,
+            "len1": pd.to_numeric(lengths[0], errors="coerce").fillna(-1).values,
+            "len2": pd.to_numeric(lengths[2], errors="coerce").fillna(-1).values,
+            "total": table["total"].values,
+            "defined": table["defined"].values,
+        }
+        if self.kmers:
+            blob = ("\n".join(table["kmers"]) + "\n").encode() if len(table) else b""
+            sizes = np.array([len(s.encode()) + 1 for s in table["kmers"]], dtype=np.int64)
+            columns["kmers_offset"] = self._kmers_size + np.concatenate(([0], np.cumsum(sizes)[:-1]))
+            columns["kmers"] = np.frombuffer(blob, dtype=np.uint8)
+            self._kmers_size += len(blob)
+
+        for name, values in columns.items():
+            self._files[name].write(np.asarray(values).astype(self.columns[name]).tobytes())
+        self.reads += len(table)
+
+    def commit(self):
+        for f in self._files.values():
+            f.close()
+        stat = os.stat(self.filename)
+        content_hash = self.cache._hash(self.filename)
+        meta = {
+            "source": os.path.abspath(self.filename),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "reads": self.reads,
+            "kmers": self.kmers,
+            "columns": {name: np.dtype(dtype).str for name, dtype in self.columns.items()},
+        }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        target = os.path.join(self.cache.directory, content_hash)
+        if os.path.exists(target):
+            shutil.rmtree(target, ignore_errors=True)
+        try:
+            os.rename(self.path, target)
+        except OSError:
+            # Written at the same time by another process
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.cache._write_key(self.filename, content_hash)
+        self.cache.evict()
+
+    def abort(self):
+        for f in self._files.values():
+            f.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class KrakenResultCache:
+    """
+    Directory of kraken2 outputs (gzipped, unclassified reads included), keyed by everything
+    that determines them: the database (size and time of the .k2d files, content of opts.k2d),
+    the content of the FASTQ files, the kraken2 version and the classification parameters.
+    Entries are written to a temporary directory renamed when complete, and the least recently
+    used are removed when the directory grows larger than `maxsize` bytes.
+    Hits and misses are counted by the instance (`hits`, `misses`) and in stats.json.
+
+    Input:
+        cache = KrakenResultCache("~/.cache/amplikraken/results")
+        KrakenRunner(db, cache=cache).run("S1_R1.fq.gz", "S1_R2.fq.gz")
+    Output:
+        kraken2 runs only the first time, the output is then read from the cache
+    """
+    def __init__(self, directory, maxsize=50 * 1024 ** 3) -> None:
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._hashes = {}
+        # KrakenBatch shares the cache between threads
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.directory, "fingerprints"), exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"KrakenResultCache({self.directory}, maxsize={self.maxsize})"
+
+    def key(self, runner, file1, file2=None):
+        """
+        Key of the output of a KrakenRunner on some files
+        """
+        fields = {
+            "database": database_fingerprint(runner.db),
+            "reads": [self.fingerprint(f) for f in (file1, file2) if f is not None],
+            "version": runner.version,
+            "confidence": float(runner.confidence),
+            "names": runner.names,
+            "paired": file2 is not None,
+        }
+        if getattr(runner, "trimmer", None) is not None:
+            fields["trimmer"] = runner.trimmer.parameters()
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def fingerprint(self, filename):
+        """
+        Content hash of an input file, remembered (by path, size and time) to hash it only once
+        """
+        stat = os.stat(filename)
+        key = f"{os.path.abspath(filename)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        keyfile = os.path.join(self.directory, "fingerprints", hashlib.sha1(key.encode()).hexdigest())
+        if key not in self._hashes:
+            if os.path.exists(keyfile):
+                with open(keyfile) as f:
+                    self._hashes[key] = f.read().strip()
+            else:
+                self._hashes[key] = file_hash(filename)
+                _write_atomic(keyfile, self._hashes[key])
+        return self._hashes[key]
+
+    def get(self, key):
+        """
+        KrakenResultEntry of a key, or None (counted as a hit or a miss)
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            # Mark as recently used
+            os.utime(os.path.join(path, "meta.json"))
+        except FileNotFoundError:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return KrakenResultEntry(path)
+
+    def writer(self, key):
+        return KrakenResultWriter(self, key)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in maxsize
+        """
+        _evict(self.directory, self.maxsize)
+
+    def stats(self):
+        """
+        Hits and misses of this instance and of all the processes using the directory
+        (the totals are approximate with concurrent processes), number and size of the entries
+        """
+        entries = [e for e in os.scandir(self.directory) if os.path.exists(os.path.join(e.path, "meta.json"))]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total": self._load_stats(),
+            "entries": len(entries),
+            "size": sum(f.stat().st_size for e in entries for f in os.scandir(e.path)),
+        }
+
+    def _count(self, event):
+        with self._lock:
+            setattr(self, event, getattr(self, event) + 1)
+            totals = self._load_stats()
+            totals[event] += 1
+            _write_atomic(os.path.join(self.directory, "stats.json"), json.dumps(totals))
+
+    def _load_stats(self):
+        try:
+            with open(os.path.join(self.directory, "stats.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0}
+
+
+class KrakenResultEntry:
+    """
+    A cached kraken2 output: open() returns the lines
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return self.meta["lines"]
+
+    def open(self):
+        return xopen.xopen(os.path.join(self.path, "output.gz"), "rt")
+
+
+class KrakenResultWriter:
+    """
+    Save a kraken2 output while it is produced (as a KrakenRunner consumer), in a temporary
+    directory renamed on close()
+    """
+    def __init__(self, cache, key) -> None:
+        self.cache = cache
+        self.key = key
+        self.lines = 0
+        self.path = tempfile.mkdtemp(prefix=".tmp-", dir=cache.directory)
+        self._file = xopen.xopen(os.path.join(self.path, "output.gz"), "wt", compresslevel=1)
+
+    def feed(self, lines):
+        self._file.writelines(lines)
+        self.lines += len(lines)
+
+    def close(self):
+        self._file.close()
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"key": self.key, "lines": self.lines}, f)
+        target = os.path.join(self.cache.directory, self.key)
+        try:
+            os.rename(self.path, target)
+        except OSError:
+            # Saved at the same time by another process
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.cache.evict()
+        return target
+
+    def abort(self):
+        self._file.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def database_fingerprint(db):
+    """
+    Identity of a Kraken2 database: size and modification time of its .k2d files, and the
+    content of opts.k2d (small), without reading the large hash table
+    """
+    files = {}
+    for name in ("hash.k2d", "opts.k2d", "taxo.k2d"):
+        filename = os.path.join(db, name)
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            files[name] = [stat.st_size, stat.st_mtime_ns]
+    if os.path.exists(os.path.join(db, "opts.k2d")):
+        files["opts"] = file_hash(os.path.join(db, "opts.k2d"))
+    return files
+
+def _write_atomic(filename, text):
+    # Write a file via a unique temporary file in the same directory, so that readers never see it partial
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _evict(directory, maxsize):
+    # Remove the least recently used entries (subdirectories with a meta.json) beyond maxsize bytes.
+    # Entries being written (.tmp- directories) are skipped, and other processes may remove
+    # entries at the same time
+    entries = []
+    for name in os.listdir(directory):
+        meta = os.path.join(directory, name, "meta.json")
+        if name.startswith(".tmp-") or not os.path.exists(meta):
+            continue
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(os.path.join(directory, name)))
+            entries.append((os.stat(meta).st_mtime, size, name))
+        except FileNotFoundError:
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= maxsize:
+            break
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        total -= size
+
+def _lengths(len1, len2):
+    # Rebuild the Len column, "251|250" for pairs or the read length
+    if (len2 < 0).all():
+        return len1.astype(np.int64)
+    paired = pd.Series(len1).astype(str) + "|" + pd.Series(len2).astype(str)
+    return np.where(len2 < 0, pd.Series(len1).astype(str), paired)
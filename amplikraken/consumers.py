@@ -0,0 +1,201 @@
+# This file contains consumers of the kraken2 output stream, attached to a KrakenRunner
+import os
+import pandas as pd
+import xopen
+from amplikraken.kraken import KRAKEN_COLUMNS, lca_confidence, taxonomy_splitter, validate_output
+from amplikraken.report import kraken_report, named_lines
+
+# Compression of the output, from the file extension
+COMPRESSION = {".gz": "gz", ".bz2": "bz2", ".xz": "xz", ".zst": "zst"}
+
+
+class KrakenConsumer:
+    """
+    Receives the output of a KrakenRunner (kraken2 lines, with their newline) in batches:
+    feed() is called for each batch by a thread separate from the one reading the pipe,
+    and close() once at the end, returning the result of the consumer. If kraken2 fails,
+    abort() is called instead of close(). With an AsyncKrakenRunner the three methods can
+    also be coroutines.
+    """
+    def feed(self, lines):
+        raise NotImplementedError
+
+    def close(self):
+        return None
+
+    def abort(self):
+        pass
+
+
+class TaxidCounter(KrakenConsumer):
+    """
+    Count the reads per TaxID. close() returns the counts as a collapsed KrakenOutput table
+    (TaxID index, one column called `name`), ready for CountMatrix.from_tables().
+    With `weighted=True` each read counts as the multiplicity in its name ("uid;size=40"),
+    for the uniques of a Dereplicator
+    """
+    def __init__(self, name="Count", unclassified=False, weighted=False) -> None:
+        self.name = name
+        self.unclassified = unclassified
+        self.weighted = weighted
+        self.counts = {}
+
+    def feed(self, lines):
+        for line in lines:
+            classification, read, taxid, _ = line.split("\t", 3)
+            if classification == "U" and not self.unclassified:
+                continue
+            taxid = taxonomy_splitter(taxid)[0]
+            self.counts[taxid] = self.counts.get(taxid, 0) + (read_weight(read) if self.weighted else 1)
+
+    def close(self):
+        counts = pd.Series(self.counts, dtype="int64", name=self.name)
+        counts.index = counts.index.astype("int64")
+        counts.index.name = "TaxID"
+        return counts.sort_index().to_frame()
+
+
+class ConfidenceFilter(KrakenConsumer):
+    """
+    Pass on to `consumers` the reads with a confidence (as str_to_confidence) of at least
+    `minconfidence`, the same reads kept by KrakenOutput: unclassified reads have a confidence
+    of 0, so they are only passed on with `minconfidence` 0, which keeps every read.
+    close() returns the list of results of the consumers
+    """
+    def __init__(self, minconfidence, *consumers) -> None:
+        self.minconfidence = minconfidence
+        self.consumers = list(consumers)
+
+    def feed(self, lines):
+        if self.minconfidence > 0:
+            confidence = lca_confidence(line.rsplit("\t", 1)[1].rstrip("\n") for line in lines)[0]
+            lines = [line for line, score in zip(lines, confidence) if score >= self.minconfidence]
+        for consumer in self.consumers:
+            consumer.feed(lines)
+
+    def close(self):
+        return [consumer.close() for consumer in self.consumers]
+
+    def abort(self):
+        for consumer in self.consumers:
+            consumer.abort()
+
+
+class OutputWriter(KrakenConsumer):
+    """
+    Save the lines to a file, compressed according to its extension (.gz, .bz2, .xz, .zst),
+    through a temporary file renamed when closed. close() returns the file name
+    """
+    def __init__(self, filename, unclassified=True, threads=None, compresslevel=None) -> None:
+        self.filename = filename
+        self.unclassified = unclassified
+        self._tmp = os.path.join(os.path.dirname(os.path.abspath(filename)), f".{os.path.basename(filename)}.{os.getpid()}.tmp")
+        self._file = xopen.xopen(self._tmp, "wt", compresslevel=compresslevel, threads=threads,
+                                 format=COMPRESSION.get(os.path.splitext(filename)[1]))
+
+    def feed(self, lines):
+        if not self.unclassified:
+            lines = [line for line in lines if not line.startswith("U")]
+        self._file.writelines(lines)
+
+    def close(self):
+        self._file.close()
+        os.replace(self._tmp, self.filename)
+        return self.filename
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp)
+
+
+class CacheFeeder(KrakenConsumer):
+    """
+    Fill a KrakenCache with the parsed lines while they are produced, so that akmerge does not
+    parse them again. The entry belongs to `filename`, which must be complete when close() is
+    called: the file of an OutputWriter attached before this consumer.
+    close() returns the KrakenCacheEntry
+    """
+    def __init__(self, cache, filename, kmers=None) -> None:
+        self.cache = cache
+        self.filename = filename
+        self._writer = cache.writer(filename, kmers=kmers)
+
+    def feed(self, lines):
+        table = pd.DataFrame([line.rstrip("\n").split("\t") for line in lines], columns=KRAKEN_COLUMNS)
+        table = validate_output(table, self.filename)
+        _, table['total'], table['defined'] = lca_confidence(table['kmers'])
+        self._writer.append(table)
+
+    def close(self):
+        if not os.path.exists(self.filename):
+            self._writer.abort()
+            raise FileNotFoundError(f"Cannot cache {self.filename}: file not found")
+        self._writer.commit()
+        return self.cache.get(self.filename)
+
+    def abort(self):
+        self._writer.abort()
+
+
+class KrakenNamer(KrakenConsumer):
+    """
+    Pass on to `consumers` the lines of a kraken2 run without --use-names, with the taxa
+    written as kraken2 --use-names does ("Escherichia coli (taxid 562)"), from a TaxonomyIndex.
+    close() returns the list of results of the consumers
+    """
+    def __init__(self, index, *consumers) -> None:
+        self.index = index
+        self.consumers = list(consumers)
+
+    def feed(self, lines):
+        lines = named_lines(lines, self.index)
+        for consumer in self.consumers:
+            consumer.feed(lines)
+
+    def close(self):
+        return [consumer.close() for consumer in self.consumers]
+
+    def abort(self):
+        for consumer in self.consumers:
+            consumer.abort()
+
+
+class KrakenReporter(KrakenConsumer):
+    """
+    Write the report of kraken2 --report from the lines of a kraken2 run without --use-names
+    (all of them, unclassified reads included), using a TaxonomyIndex. close() returns the file name.
+    `weighted` as in TaxidCounter
+    """
+    def __init__(self, index, filename, weighted=False) -> None:
+        self.index = index
+        self.filename = filename
+        self.weighted = weighted
+        self.counts = {}
+        self.unclassified = 0
+
+    def feed(self, lines):
+        for line in lines:
+            classification, read, taxid, _ = line.split("\t", 3)
+            weight = read_weight(read) if self.weighted else 1
+            if classification == "U":
+                self.unclassified += weight
+            else:
+                taxid = int(taxid)
+                self.counts[taxid] = self.counts.get(taxid, 0) + weight
+
+    def close(self):
+        lines = kraken_report(self.index, list(self.counts), list(self.counts.values()), self.unclassified)
+        with open(self.filename + ".tmp", "w") as f:
+            f.writelines(lines)
+        os.replace(self.filename + ".tmp", self.filename)
+        return self.filename
+
+
+def read_weight(read):
+    """
+    Multiplicity of a read from its name
+    Input: "4d1e0f...;size=40"
+    Output: 40 (1 without ";size=")
+    """
+    _, _, size = read.partition(";size=")
+    return int(size) if size else 1
@@ -0,0 +1,349 @@
+# This file contains the catalog of Kraken2 databases and the staging of databases on fast local storage
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import itertools
+from amplikraken.cache import file_hash, database_fingerprint
+
+# Databases downloadable with akget, in JSON format for interoperability
+databases_json = """{
+ 
+  "greengenes": {
+    "md5": "c66091696e1fcf35a7ac6b8fcb48bbef",
+    "ver": "13.5",
+    "outdir": "16S_Greengenes_k2db",
+    "url": "https://genome-idx.s3.amazonaws.com/kraken/16S_Greengenes13.5_20200326.tgz",
+    "desc": "Greengenes",
+    "c": "McDonald 2012",
+    "cite": "McDonald D, (2012) 'An improved Greengenes taxonomy with explicit ranks for ecological and evolutionary analyses of bacteria and archaea' 10.1038/ismej.2011.139 "
+  },
+  "kraken-silva-138": {
+    "md5": "94ecb2c851f3e4f02335559d42013f0f",
+    "outdir": "16S_SILVA138_k2db",
+    "ver": "138",
+    "desc": "SILVA release 138",
+    "url": "https://genome-idx.s3.amazonaws.com/kraken/16S_Silva138_20200326.tgz",
+    "c": "Quast 2013",
+    "cite": "Quast C, Pruesse E, Yilmaz P, Gerken J, Schweer T, Yarza P, Peplies J, Glöckner FO (2013) The SILVA ribosomal RNA gene database project: improved data processing and web-based tools.  ucl. Acids Res. 41 (D1): D590-D596."
+  },
+  "kraken-silva-132": {
+    "url": "https://genome-idx.s3.amazonaws.com/kraken/16S_Silva132_20200326.tgz",
+    "outdir": "16S_SILVA132_k2db",
+    "desc": "SILVA release 132",
+    "md5": "0b6d8ed61e63210c1dc2ccdd373a9d5d",
+    "ver": "132",
+    "c": "Quast 2013",
+    "cite": "Quast C, Pruesse E, Yilmaz P, Gerken J, Schweer T, Yarza P, Peplies J, Glöckner FO (2013) The SILVA ribosomal RNA gene database project: improved data processing and web-based tools.  ucl. Acids Res. 41 (D1): D590-D596."
+  },
+  "kraken-rdp-115": {
+    "url": "https://genome-idx.s3.amazonaws.com/kraken/16S_RDP11.5_20200326.tgz",
+    "outdir": "16S_RDP_k2db",
+    "desc": "RDP release 11.5",
+    "md5": "7381792a19064962741724eee188121e",
+    "ver": "11.5",
+    "c": "Cole 2014",
+    "cite": "Cole JR, Wang Q, Fish JA, Chai B, McGarrell DM, Sun Y, Brown CT, Porras-Alfaro A, Kuske CR, Tiedje JM (2014)'Ribosomal Database Project: data and tools for high throughput rRNA analysis', NAR, 10.1093/nar/gkt1244"
+  }
+}"""
+
+# Directory where akget saves the databases by default
+DEFAULT_REFS = os.path.join(os.path.expanduser("~"), "refs")
+
+# Files of a Kraken2 database
+DATABASE_FILES = ("hash.k2d", "opts.k2d", "taxo.k2d")
+
+def databases():
+    """
+    Catalog of the databases available with akget: {code: {"url", "md5", "outdir", "desc", ...}}
+    """
+    return json.loads(databases_json)
+
+def resolve_database(db, refs=None):
+    """
+    Path of a Kraken2 database given as a directory or as an akget code (downloaded in `refs`)
+    Input: "kraken-silva-138"
+    Output: "/home/user/refs/16S_SILVA138_k2db"
+    """
+    if os.path.isdir(db):
+        return db
+    catalog = databases()
+    if db in catalog:
+        path = os.path.join(refs if refs else DEFAULT_REFS, catalog[db].get("outdir", db))
+        if os.path.isdir(path):
+            return path
+        raise ValueError(f"Database {db} not found in {path}: download it with akget -d {db}")
+    raise ValueError(f"Database {db} not found: not a directory nor a database code ({', '.join(catalog)})")
+
+def check_database(path):
+    """
+    Raise a ValueError if a directory is not a complete Kraken2 database
+    """
+    for name in DATABASE_FILES:
+        filename = os.path.join(path, name)
+        if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+            raise ValueError(f"Invalid Kraken2 database {path}: {name} missing or empty")
+
+
+class DatabaseManager:
+    """
+    Stage Kraken2 databases (directories or akget codes) on fast local storage, `directory`
+    (default: /dev/shm if available), so that the database is read from the network once and
+    the kraken2 processes launched with --memory-mapping share it in the page cache.
+    Copies are checked against the hashes of the source files, and reused while the source
+    is unchanged. Active users are counted (a file per user, so processes that died do not
+    count), and when the staged databases take more than `budget` bytes the least recently
+    used ones without users are removed.
+
+    Input:
+        manager = DatabaseManager(budget=64 * 1024 ** 3)
+        with manager.acquire("kraken-silva-138") as staged:
+            KrakenRunner(staged.path, memory_mapping=True).run("S1_R1.fastq.gz", "S1_R2.fastq.gz")
+    Output:
+        staged.path = "/dev/shm/amplikraken-db/3f2c.../"
+    """
+    def __init__(self, directory=None, budget=None, refs=None, verbose=False) -> None:
+        if directory is None:
+            base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+            directory = os.path.join(base, "amplikraken-db")
+        self.directory = os.path.abspath(directory)
+        self.budget = budget
+        self.refs = refs
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._users = itertools.count()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"DatabaseManager({self.directory}, budget={self.budget})"
+
+    def acquire(self, db):
+        """
+        Stage a database if needed and register a user, returning a StagedDatabase to release
+        (or to use as a context manager)
+        """
+        source = os.path.abspath(resolve_database(db, self.refs))
+        check_database(source)
+        fingerprint = database_fingerprint(source)
+        key = hashlib.sha1(json.dumps([source, fingerprint], sort_keys=True).encode()).hexdigest()
+        path = os.path.join(self.directory, key)
+
+        with self._locked():
+            if self._valid(path):
+                return StagedDatabase(self, source, path, self._use(path))
+            self._evict(database_size(source))
+
+        # Copied without the lock, so that other databases can be acquired and released meanwhile
+        tmp = self._stage(source, fingerprint)
+        try:
+            with self._locked():
+                if self._valid(path):
+                    # Staged by another process meanwhile
+                    shutil.rmtree(tmp, ignore_errors=True)
+                else:
+                    shutil.rmtree(path, ignore_errors=True)
+                    os.rename(tmp, path)
+                return StagedDatabase(self, source, path, self._use(path))
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def release(self, staged):
+        """
+        Remove a user of a staged database, then evict the idle databases beyond the budget
+        """
+        with self._locked():
+            try:
+                os.remove(staged.user)
+            except FileNotFoundError:
+                pass
+            self._evict(0)
+
+    def staged(self):
+        """
+        Staged databases as {path: {"source", "size", "users"}}
+        """
+        return self._staged(prune=False)
+
+    def _staged(self, prune):
+        entries = {}
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            meta = os.path.join(path, "meta.json")
+            # Copies in progress (.staging- directories) are not staged yet
+            if name.startswith(".staging-") or not os.path.exists(meta):
+                continue
+            try:
+                with open(meta) as f:
+                    info = json.load(f)
+            except FileNotFoundError:
+                continue
+            entries[path] = {"source": info["source"], "size": sum(size for size, _ in info["files"].values()), "users": len(self._active_users(path, prune))}
+        return entries
+
+    def verify(self, staged):
+        """
+        Hash the files of a staged database again, raising a RuntimeError if one was altered
+        """
+        with open(os.path.join(staged.path, "meta.json")) as f:
+            files = json.load(f)["files"]
+        for name, (size, digest) in files.items():
+            if file_hash(os.path.join(staged.path, name)) != digest:
+                raise RuntimeError(f"Staged database {staged.path} is corrupted: {name} changed")
+        return True
+
+    def _locked(self):
+        # Serialise staging and eviction between threads and processes sharing the directory
+        return _FileLock(os.path.join(self.directory, ".lock"), self._lock)
+
+    def _valid(self, path):
+        # Complete copy (meta.json is written last) with files of the expected size
+        meta = os.path.join(path, "meta.json")
+        if not os.path.exists(meta):
+            return False
+        with open(meta) as f:
+            files = json.load(f)["files"]
+        return all(os.path.exists(os.path.join(path, name)) and os.path.getsize(os.path.join(path, name)) == size
+                   for name, (size, _) in files.items())
+
+    def _stage(self, source, fingerprint):
+        # Copy of the database in a .staging- directory, returned to be renamed
+        size = database_size(source)
+        free = shutil.disk_usage(self.directory).free
+        if size > free:
+            raise RuntimeError(f"Not enough space in {self.directory} to stage {source}: {size} bytes needed, {free} free")
+        if self.verbose:
+            print(f"Staging {source} to {self.directory}", file=sys.stderr)
+
+        tmp = tempfile.mkdtemp(prefix=".staging-", dir=self.directory)
+        try:
+            files = {}
+            for name in os.listdir(source):
+                if not name.endswith(".k2d"):
+                    continue
+                digest = _copy(os.path.join(source, name), os.path.join(tmp, name))
+                if file_hash(os.path.join(tmp, name)) != digest:
+                    raise RuntimeError(f"Staging {source} failed: {name} differs from the source")
+                files[name] = [os.path.getsize(os.path.join(tmp, name)), digest]
+            os.makedirs(os.path.join(tmp, "users"))
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"source": source, "fingerprint": fingerprint, "files": files}, f)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return tmp
+
+    def _use(self, path):
+        # Register a user of a staged database (with the lock held)
+        user = os.path.join(path, "users", f"{os.getpid()}.{next(self._users)}")
+        open(user, "w").close()
+        # The last use orders the eviction
+        os.utime(os.path.join(path, "meta.json"))
+        return user
+
+    def _active_users(self, path, prune=False):
+        # Users of processes still alive; with `prune` (only with the lock held) the files left
+        # by processes that died are removed
+        users = []
+        directory = os.path.join(path, "users")
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            if _alive(int(name.split(".")[0])):
+                users.append(name)
+            elif prune:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        return users
+
+    def _evict(self, needed):
+        # Remove the least recently used databases without users, to fit `needed` more bytes in the budget
+        if self.budget is None:
+            return
+        entries = []
+        for path, info in self._staged(prune=True).items():
+            entries.append((os.stat(os.path.join(path, "meta.json")).st_mtime, info["size"], info["users"], path))
+        total = sum(size for _, size, _, _ in entries) + needed
+        for _, size, users, path in sorted(entries):
+            if total <= self.budget:
+                break
+            if users == 0:
+                if self.verbose:
+                    print(f"Evicting staged database {path}", file=sys.stderr)
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+class StagedDatabase:
+    """
+    A database staged by a DatabaseManager (`path`, copy of `source`), in use until released
+    """
+    def __init__(self, manager, source, path, user) -> None:
+        self.manager = manager
+        self.source = source
+        self.path = path
+        self.user = user
+        self.released = False
+
+    def __repr__(self) -> str:
+        return f"StagedDatabase({self.source} -> {self.path})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.manager.release(self)
+
+
+class _FileLock:
+    # Exclusive lock on a file (between processes) and on a threading.Lock (between threads)
+    def __init__(self, filename, lock) -> None:
+        self.filename = filename
+        self.lock = lock
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.file = open(self.filename, "a")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.lock.release()
+
+
+def database_size(path):
+    """
+    Size in bytes of the .k2d files of a database
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.name.endswith(".k2d"))
+
+def _copy(source, destination, blocksize=4 * 1024 * 1024):
+    # Copy a file keeping its times (so that the database fingerprint is the same), returning its hash
+    digest = hashlib.blake2b(digest_size=20)
+    with open(source, "rb") as f, open(destination, "wb") as out:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+            out.write(block)
+    shutil.copystat(source, destination)
+    return digest.hexdigest()
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,235 @@
+# This file contains the dereplication of reads before classification, and the expansion of the results
+import os
+import heapq
+import hashlib
+from amplikraken.fastq import FastqReader
+from amplikraken.trim import TrimStats
+
+
+class Dereplicator:
+    """
+    Collapse identical reads (or identical R1, R2 pairs) into unique records, saved as FASTQ files
+    in `workdir` with their multiplicity in the name ("@<hash>;size=40"), keeping the sequence
+    and quality of the first occurrence. Each read name is saved with the hash of its pair
+    (reads.tsv, in input order) to expand the classification of the uniques back to every read.
+    At most `max_uniques` pairs are kept in memory: beyond that they are spilled to `partitions`
+    files by hash, each one dereplicated on its own at the end.
+
+    Input:
+        derep = Dereplicator("tmp/S1")
+        r1, r2 = derep.run("S1_R1.fastq.gz", "S1_R2.fastq.gz")
+    Output:
+        "tmp/S1/uniques_R1.fastq", "tmp/S1/uniques_R2.fastq", with derep.reads and derep.uniques
+    """
+    def __init__(self, workdir, max_uniques=1000000, partitions=64) -> None:
+        self.workdir = workdir
+        self.max_uniques = max_uniques
+        self.partitions = partitions
+        self.reads = 0
+        self.uniques = 0
+        self.spilled = False
+        self.trim_stats = None
+        self.mapping = os.path.join(workdir, "reads.tsv")
+        os.makedirs(workdir, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"Dereplicator({self.workdir}, reads={self.reads}, uniques={self.uniques})"
+
+    def run(self, file1, file2=None, trimmer=None):
+        """
+        Dereplicate the reads, returning the FASTQ files of the uniques (R2 is None for single-end).
+        With a ReadTrimmer the reads are trimmed and filtered first (counts in `trim_stats`)
+        """
+        paired = file2 is not None
+        outputs = [os.path.join(self.workdir, "uniques_R1.fastq")] + ([os.path.join(self.workdir, "uniques_R2.fastq")] if paired else [])
+        batches = FastqReader(file1, file2).batches()
+        if trimmer is not None:
+            self.trim_stats = TrimStats()
+            batches = trimmer.filter(batches, self.trim_stats)
+        pairs = (item if paired else (item,) for batch in batches for item in batch)
+
+        # uid -> [count, (sequence, quality) of each mate of the first occurrence]
+        uniques = {}
+        with open(self.mapping, "w") as mapping:
+            for records in pairs:
+                key = "\0".join(record[1] for record in records)
+                uid = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+                mapping.write(f"{read_id(records[0][0], paired)}\t{uid}\n")
+                self.reads += 1
+                if uid in uniques:
+                    uniques[uid][0] += 1
+                else:
+                    uniques[uid] = [1, [record[1:] for record in records]]
+                    if len(uniques) > self.max_uniques:
+                        self._spill(uniques)
+                        uniques = {}
+
+        files = [open(output, "w") for output in outputs]
+        try:
+            if self.spilled:
+                self._spill(uniques)
+                for partition in range(self.partitions):
+                    self._write(self._merge(partition), files)
+            else:
+                self._write(uniques, files)
+        finally:
+            for f in files:
+                f.close()
+        return outputs[0], outputs[1] if paired else None
+
+    def _partition(self, partition):
+        return os.path.join(self.workdir, f"partition_{partition}.tsv")
+
+    def _spill(self, uniques):
+        # Append the uniques to the partition files: uid, count, then sequence and quality of each mate
+        if not self.spilled:
+            for partition in range(self.partitions):
+                open(self._partition(partition), "w").close()
+            self.spilled = True
+        files = {}
+        try:
+            for uid, (count, records) in uniques.items():
+                partition = int(uid[:8], 16) % self.partitions
+                if partition not in files:
+                    files[partition] = open(self._partition(partition), "a")
+                fields = [uid, str(count)] + [field for record in records for field in record]
+                files[partition].write("\t".join(fields) + "\n")
+        finally:
+            for f in files.values():
+                f.close()
+
+    def _merge(self, partition):
+        # Uniques of a partition, summing the counts of the same pair spilled several times
+        uniques = {}
+        with open(self._partition(partition)) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                uid, count = fields[0], int(fields[1])
+                if uid in uniques:
+                    uniques[uid][0] += count
+                else:
+                    records = [tuple(fields[i:i + 2]) for i in range(2, len(fields), 2)]
+                    uniques[uid] = [count, records]
+        os.remove(self._partition(partition))
+        return uniques
+
+    def _write(self, uniques, files):
+        for uid, (count, records) in uniques.items():
+            for f, (sequence, quality) in zip(files, records):
+                f.write(f"@{uid};size={count}\n{sequence}\n+\n{quality}\n")
+        self.uniques += len(uniques)
+
+
+def read_id(header, paired=False):
+    """
+    Read name as written by kraken2: the header up to the first space, without /1 or /2 for pairs
+    Input: "M00967:43:1101:17025:1426/1 1:N:0:1"
+    Output: "M00967:43:1101:17025:1426"
+    """
+    name = header.split()[0] if header.strip() else ""
+    if paired and len(name) > 2 and name[-2] == "/" and name[-1] in "12":
+        name = name[:-2]
+    return name
+
+def expand_output(lines, mapping, output, max_uniques=1000000, partitions=64):
+    """
+    Write the kraken2 output of every read from the output of the uniques (`lines`) and the
+    read names of a Dereplicator (`mapping`): the same lines, in the same order, as classifying
+    all the reads. The reads of uniques without output (e.g. unclassified, filtered) are skipped.
+    At most `max_uniques` results are kept in memory: beyond that the results and the read names
+    are spilled to `partitions` files by hash, expanded one partition at a time and merged back
+    in input order. Returns the number of lines written
+    """
+    directory = os.path.dirname(os.path.abspath(mapping))
+    results, spill = {}, None
+    for line in lines:
+        classification, read, rest = line.split("\t", 2)
+        results[read.split(";size=")[0]] = (classification, rest)
+        if len(results) > max_uniques:
+            spill = spill or _Partitions(directory, "results", partitions)
+            spill.write((uid, f"{uid}\t{classification}\t{rest}") for uid, (classification, rest) in results.items())
+            results = {}
+
+    written = 0
+    with open(output + ".tmp", "w") as out:
+        if spill is None:
+            with open(mapping) as f:
+                for line in f:
+                    read, uid = line.rstrip("\n").split("\t")
+                    if uid in results:
+                        classification, rest = results[uid]
+                        out.write(f"{classification}\t{read}\t{rest}")
+                        written += 1
+        else:
+            spill.write((uid, f"{uid}\t{classification}\t{rest}") for uid, (classification, rest) in results.items())
+            results = None
+            written = _expand_partitions(spill, mapping, directory, out)
+    os.replace(output + ".tmp", output)
+    return written
+
+def _expand_partitions(spill, mapping, directory, out):
+    # Read names partitioned like the results, with their position in the input
+    reads = _Partitions(directory, "reads", spill.partitions)
+    with open(mapping) as f:
+        reads.write((uid, f"{position}\t{read}\t{uid}") for position, (read, uid) in enumerate(line.rstrip("\n").split("\t") for line in f))
+    # Each partition expanded on its own, in input order, then all of them merged by position
+    expanded = _Partitions(directory, "expanded", spill.partitions)
+    try:
+        for partition in range(spill.partitions):
+            results = {}
+            for line in spill.read(partition):
+                uid, classification, rest = line.split("\t", 2)
+                results[uid] = (classification, rest)
+            with open(expanded.filename(partition), "w") as f:
+                for line in reads.read(partition):
+                    position, read, uid = line.rstrip("\n").split("\t")
+                    if uid in results:
+                        classification, rest = results[uid]
+                        f.write(f"{position}\t{classification}\t{read}\t{rest}")
+        files = [open(expanded.filename(partition)) for partition in range(spill.partitions)]
+        try:
+            written = 0
+            for line in heapq.merge(*files, key=lambda line: int(line[:line.index("\t")])):
+                out.write(line[line.index("\t") + 1:])
+                written += 1
+        finally:
+            for f in files:
+                f.close()
+    finally:
+        for partitions in (spill, reads, expanded):
+            partitions.remove()
+    return written
+
+
+class _Partitions:
+    # Lines spilled to `partitions` files by the hash of their uid (as the Dereplicator does)
+    def __init__(self, directory, name, partitions) -> None:
+        self.directory = directory
+        self.name = name
+        self.partitions = partitions
+        for partition in range(partitions):
+            open(self.filename(partition), "w").close()
+
+    def filename(self, partition):
+        return os.path.join(self.directory, f"{self.name}_{partition}.tsv")
+
+    def write(self, items):
+        files = {}
+        try:
+            for uid, line in items:
+                partition = int(uid[:8], 16) % self.partitions
+                if partition not in files:
+                    files[partition] = open(self.filename(partition), "a")
+                files[partition].write(line if line.endswith("\n") else line + "\n")
+        finally:
+            for f in files.values():
+                f.close()
+
+    def read(self, partition):
+        with open(self.filename(partition)) as f:
+            yield from f
+
+    def remove(self):
+        for partition in range(self.partitions):
+            if os.path.exists(self.filename(partition)):
+                os.remove(self.filename(partition))
@@ -1,5 +1,7 @@
 # This file contains classes and functions for handling fastq files
 import os
+import itertools
+import xopen
 
 class FastqDataset:
     def __init__(self, name, forward=None, reverse=None, basename=False) -> None:
@@ -64,6 +66,21 @@ class FastqDataset:
             self.paired = True
             self.valid = False
 
+    def reader(self, **kwargs):
+        """
+        FastqReader of the reads (pairs if paired-end)
+        """
+        return FastqReader(self.forward, self.reverse, **kwargs)
+
+    def stats(self, threads=None):
+        """
+        Read the files and return their ReadStats (one per file)
+        """
+        reader = self.reader(threads=threads)
+        for _ in reader.batches():
+            pass
+        return reader.stats
+
     def __eq__(self, __value: object) -> bool:
         if isinstance(__value, FastqDataset):
             return self.forward == __value.forward and self.reverse == __value.reverse
@@ -209,4 +226,153 @@ def getSuffixFromList(lst):
             suffix = suffix[i+1:]
         else:
             break
-    return suffix
\ No newline at end of file
+    return suffix
+
+
+def read_fastq(filename):
+    """
+    Records of a FASTQ file (plain or compressed) as (header, sequence, quality), the header without "@"
+    """
+    for batch in FastqReader(filename).batches():
+        yield from batch
+
+
+class ReadStats:
+    """
+    Number of reads and bases, and length distribution, of the reads of one file
+    """
+    def __init__(self) -> None:
+        self.reads = 0
+        self.bases = 0
+        self.lengths = {}
+
+    def __repr__(self) -> str:
+        return f"ReadStats(reads={self.reads}, bases={self.bases}, min={self.min}, max={self.max}, mean={self.mean:.1f})"
+
+    def add(self, records):
+        for _, sequence, _ in records:
+            length = len(sequence)
+            self.lengths[length] = self.lengths.get(length, 0) + 1
+            self.bases += length
+        self.reads += len(records)
+
+    @property
+    def min(self):
+        return min(self.lengths) if self.lengths else 0
+
+    @property
+    def max(self):
+        return max(self.lengths) if self.lengths else 0
+
+    @property
+    def mean(self):
+        return self.bases / self.reads if self.reads else 0.0
+
+    def median(self):
+        seen = 0
+        for length in sorted(self.lengths):
+            seen += self.lengths[length]
+            if seen * 2 >= self.reads:
+                return length
+        return 0
+
+
+class FastqReader:
+    """
+    Streaming reader of single-end or paired-end FASTQ files (plain or compressed, decompressed
+    by helper processes via xopen with `threads`), parsing blocks of `buffer_size` characters and
+    yielding the records in batches of `batch_size`: (header, sequence, quality) tuples, or pairs of
+    them for paired-end files. The mates must have the same names (ignoring /1 and /2 and comments).
+    Statistics of the reads read so far are in `stats` (one ReadStats per file).
+
+    Input:
+        reader = FastqReader("S1_R1.fastq.gz", "S1_R2.fastq.gz")
+        for batch in reader.batches(): ...
+    Output:
+        [(("read1 1:N:0:1", "ACGT", "IIII"), ("read1 2:N:0:1", "TTGC", "IIII")), ...], reader.stats[0].reads
+    """
+    def __init__(self, file1, file2=None, batch_size=10000, buffer_size=4 * 1024 * 1024, threads=None, check_names=True) -> None:
+        self.files = [file1] + ([file2] if file2 is not None else [])
+        self.paired = file2 is not None
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.threads = threads
+        self.check_names = check_names
+        self.stats = [ReadStats() for _ in self.files]
+
+    def __repr__(self) -> str:
+        return f"FastqReader({', '.join(self.files)})"
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def batches(self):
+        if not self.paired:
+            for records in self._blocks(self.files[0]):
+                for start in range(0, len(records), self.batch_size):
+                    batch = records[start:start + self.batch_size]
+                    self.stats[0].add(batch)
+                    yield batch
+            return
+
+        mates = [self._records(filename) for filename in self.files]
+        batch = []
+        for pair in itertools.zip_longest(*mates):
+            if pair[0] is None or pair[1] is None:
+                missing = self.files[0] if pair[0] is None else self.files[1]
+                raise ValueError(f"Mates out of sync: {missing} has fewer reads ({self.stats[0].reads + len(batch)} pairs read)")
+            if self.check_names and not _same_read(pair[0][0], pair[1][0]):
+                raise ValueError(f"Mates out of sync at pair {self.stats[0].reads + len(batch) + 1}: {pair[0][0]} and {pair[1][0]}")
+            batch.append(pair)
+            if len(batch) == self.batch_size:
+                self._count(batch)
+                yield batch
+                batch = []
+        if batch:
+            self._count(batch)
+            yield batch
+
+    def _count(self, pairs):
+        self.stats[0].add([pair[0] for pair in pairs])
+        self.stats[1].add([pair[1] for pair in pairs])
+
+    def _records(self, filename):
+        for records in self._blocks(filename):
+            yield from records
+
+    def _blocks(self, filename):
+        # Lists of records, parsed from blocks of text (incomplete records are kept for the next block)
+        rest = ""
+        with xopen.xopen(filename, "rt", threads=self.threads) as f:
+            while True:
+                block = f.read(self.buffer_size)
+                if not block:
+                    break
+                lines = (rest + block).split("\n")
+                complete = (len(lines) - 1) // 4 * 4
+                rest = "\n".join(lines[complete:])
+                yield _parse(lines[:complete], filename)
+
+        lines = rest.split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+        if len(lines) % 4 != 0:
+            raise ValueError(f"Truncated FASTQ file {filename}")
+        if lines:
+            yield _parse(lines, filename)
+
+
+def _parse(lines, filename):
+    headers, sequences, separators, qualities = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    for header, sequence, separator, quality in zip(headers, sequences, separators, qualities):
+        if not header.startswith("@") or not separator.startswith("+") or len(sequence) != len(quality):
+            raise ValueError(f"Invalid FASTQ file {filename}: bad record {header.strip()}")
+    return [(header[1:].rstrip("\r"), sequence.rstrip("\r"), quality.rstrip("\r")) for header, sequence, quality in zip(headers, sequences, qualities)]
+
+def _same_read(header1, header2):
+    # Same read name, ignoring the comments and the /1 and /2 suffixes
+    name1, name2 = header1.split(maxsplit=1)[0] if header1.strip() else "", header2.split(maxsplit=1)[0] if header2.strip() else ""
+    if name1 == name2:
+        return True
+    return name1[:-2] == name2[:-2] and name1[-2:] in ("/1", "/2") and name2[-2:] in ("/1", "/2")
@@ -4,8 +4,13 @@ C	M00967:43:000000000-A3JHG:1:1101:17549:1611	1102	251|250	3:179 1102:5 3:1 1102
 C	M00967:43:000000000-A3JHG:1:1101:15982:1786	1102	251|250	3:26 535:2 21:3 3:5 535:1 21:1 535:11 3:1 535:9 3:1 535:21 307:5 535:13 307:1 535:10 3:5 307:2 3:73 535:4 3:1 535:5 1102:8 0:4 1383:1 0:4 |:| 3:9 535:1 3:8 535:5 3:1 535:4 3:73 307:2 3:5 535:10 307:1 535:11 0:76 1099:2 0:8
 C	M00967:43:000000000-A3JHG:1:1101:17592:2407	1102	251|250	3:27 307:1 3:8 21:1 3:1 307:8 535:1 1102:8 3:13 535:6 307:5 1102:32 3:106 |:| 3:107 1102:22 0:5 1102:5 541:5 0:62 1102:2 0:8
 """
+import math
+import numpy as np
 import pandas as pd
 import amplikraken.utils
+from amplikraken.taxonomy import TaxonomyIndex
+
+KRAKEN_COLUMNS = ["Classification", "Read", "TaxID", "Len", "kmers"]
 
 class KrakenRecord:
     def __init__(self, line=None,status=None, readname=None, taxid=None, species=None, readlen=None, lca_string=None) -> None:
@@ -49,52 +54,170 @@ class KrakenRecord:
 
 
 class KrakenOutput:
-    def __init__(self, name=None, minconfidence=0.0, unclassified=False, reads=False) -> None:
+    def __init__(self, name=None, minconfidence=0.0, unclassified=False, reads=False, chunksize=None, taxonomy=None, cache=None) -> None:
         self.name = name
         self.minconfidence = minconfidence
         self.unclassified = unclassified
         self.readname = reads
+        # With the taxonomy of the database (KrakenTree), minconfidence is applied as kraken2 would:
+        # labels are moved up the tree instead of discarding low confidence reads
+        self.taxonomy = taxonomy
+        self._rescorer = KrakenRescorer(taxonomy, minconfidence) if taxonomy is not None else None
+        # When set, load() streams the file in chunks of `chunksize` lines and
+        # only keeps the per-TaxID counts (the table is loaded already collapsed)
+        self.chunksize = chunksize
+        # KrakenCache where parsed files are saved, and loaded from without parsing the text again
+        self.cache = cache
+        self.collapsed = False
         self.table = pd.DataFrame()
 
     def __len__(self):
         return self.table.shape[0]
+
     def load(self, filename):
+        if self.chunksize:
+            return self._load_chunks(filename)
         try:
-            self.table = pd.read_csv(filename, sep="\t", header=None, names=["Classification", "Read", "TaxID", "Len", "kmers"])
-            #Check if the file is a report
-            # 1. Column Classification must be either "C" or "U"
-            if not self.table['Classification'].isin(['C', 'U']).all():
-                raise Exception(f"\n----\nError loading kraken output from {filename}:\n  Column Classification must be either 'C' or 'U'")
-            # 2. Column TaxID must be an integer
-            if not self.table['TaxID'].astype(str).str.isdigit().all():
-                raise Exception(f"\n----\nError loading kraken output from {filename}:\n  Column TaxID must be an integer")
-            
-            # Set type of TaxID to int
-            self.table['TaxID'] = self.table['TaxID'].astype(int)
-
-            # Strip unclassified
-            if not self.unclassified:
-                self.table = self.table[self.table['Classification'] == 'C']
+            self.table = pd.concat([self._filter(chunk) for chunk in self._read(filename)])
+        except Exception as e:
+            raise Exception(f"Error loading kraken output from {filename}: {e}")
+        return self
 
-            # Remove reads
-            if not self.readname:
-                self.table = self.table.drop(columns=['Read'])
-            # Add column "Confidence": str_to_confidence(kmers)
-            self.table['Confidence'] = self.table['kmers'].apply(str_to_confidence)
+    def _load_chunks(self, filename):
+        """
+        Streaming version of load(): read `chunksize` lines at a time, filter them and
+        keep running counts per TaxID, so that memory does not depend on the number of reads
+        """
+        counts = pd.Series(dtype="int64")
+        try:
+            for chunk in self._read(filename):
+                chunk = self._filter(chunk)
+                counts = counts.add(chunk['TaxID'].value_counts(), fill_value=0).astype("int64")
+        except Exception as e:
+            raise Exception(f"Error loading kraken output from {filename}: {e}")
 
-            if self.minconfidence > 0:
-                self.table = self.table[self.table['Confidence'] >= self.minconfidence]
+        counts.index.name = 'TaxID'
+        self.table = counts.sort_index().rename(self.name).to_frame()
+        self.collapsed = True
+        return self
 
-            self.table = self.table.drop(columns=['kmers'])
+    def sweep(self, filename, thresholds):
+        """
+        Count the reads per TaxID at several confidence thresholds, parsing the file once.
+        Each read is reduced to the ranges of thresholds at which its label (or, with a
+        taxonomy, each of its ancestors) holds, then counted for every threshold.
+        The table has one column per threshold (minconfidence is not used)
+        """
+        counts = {threshold: pd.Series(dtype="int64") for threshold in thresholds}
+        try:
+            for chunk in self._read(filename):
+                for threshold, taxids in self._sweep_chunk(chunk, thresholds):
+                    counts[threshold] = counts[threshold].add(pd.Series(taxids).value_counts(), fill_value=0).astype("int64")
         except Exception as e:
             raise Exception(f"Error loading kraken output from {filename}: {e}")
+
+        self.table = pd.DataFrame(counts, columns=list(thresholds)).fillna(0).astype("int64").sort_index()
+        self.table.index.name = 'TaxID'
+        self.collapsed = True
         return self
+
+    def _sweep_chunk(self, table, thresholds):
+        """
+        Yield the TaxID of the reads counted at each threshold
+        """
+        if self._rescorer is None:
+            if not self.unclassified:
+                table = table[table['Classification'] == 'C']
+            confidence = self._confidence(table)
+            for threshold in thresholds:
+                # Same filter as load(), where minconfidence 0 keeps every read
+                yield threshold, table['TaxID'].values[confidence >= threshold] if threshold > 0 else table['TaxID'].values
+            return
+
+        # A label holds while the clade k-mers required by the threshold are in (low, high]
+        labels, queried, low, high = self._rescorer.ranges_chunk(table['TaxID'].values, table['kmers'])
+        if not self.unclassified:
+            keep = labels != 0
+            labels, queried, low, high = labels[keep], queried[keep], low[keep], high[keep]
+        for threshold in thresholds:
+            required = np.ceil(threshold * queried)
+            yield threshold, labels[(required > low) & (required <= high)]
+
+    def _read(self, filename):
+        """
+        Yield the validated chunks of a file, from the cache when possible (filling it otherwise)
+        """
+        if self.cache is None or self.readname:
+            for chunk in self._chunks(filename):
+                yield validate_output(chunk, filename)
+            return
+
+        entry = self.cache.get(filename)
+        # Re-scoring needs the LCA strings, that are not always cached
+        if entry is not None and (self._rescorer is None or entry.kmers):
+            yield from entry.chunks(self.chunksize)
+            return
+
+        writer = self.cache.writer(filename, kmers=self.cache.kmers or self._rescorer is not None)
+        try:
+            for chunk in self._chunks(filename):
+                chunk = validate_output(chunk, filename)
+                _, chunk['total'], chunk['defined'] = lca_confidence(chunk['kmers'])
+                writer.append(chunk)
+                yield chunk
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def _confidence(self, table):
+        # str_to_confidence() of each read, from the k-mer run counts when already known
+        if 'total' in table:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return (table['defined'] / table['total']).values
+        return lca_confidence(table['kmers'])[0]
+
+    def _chunks(self, filename):
+        if self.chunksize:
+            yield from pd.read_csv(filename, sep="\t", header=None, names=KRAKEN_COLUMNS, chunksize=self.chunksize)
+        else:
+            yield pd.read_csv(filename, sep="\t", header=None, names=KRAKEN_COLUMNS)
+
+    def _filter(self, table):
+        if self._rescorer is not None:
+            table = self._rescore(table)
+
+        # Strip unclassified
+        if not self.unclassified:
+            table = table[table['Classification'] == 'C']
+
+        # Remove reads
+        if not self.readname:
+            table = table.drop(columns=['Read'], errors='ignore')
+        if self._rescorer is None:
+            # Add column "Confidence": str_to_confidence(kmers), computed for the whole column at once
+            table['Confidence'] = self._confidence(table)
+
+            if self.minconfidence > 0:
+                table = table[table['Confidence'] >= self.minconfidence]
+
+        return table.drop(columns=['kmers', 'total', 'defined'], errors='ignore')
+
+    def _rescore(self, table):
+        # New label and its Kraken2 score for each read, reads moved past the root become unclassified
+        table['TaxID'], table['Confidence'] = self._rescorer.rescore_chunk(table['TaxID'].values, table['kmers'])
+        table.loc[table['TaxID'] == 0, 'Classification'] = 'U'
+        return table
     
     def __str__(self) -> str:
         return self.table.to_string()
     
     def collapse(self):
+        if self.collapsed:
+            return self.table
         if self.table.empty:
+            self.table = pd.Series(dtype="int64", index=pd.Index([], dtype="int64", name="TaxID"), name=self.name).to_frame()
+            self.collapsed = True
             return self.table
         
         # Collapse by TaxID
@@ -105,8 +228,194 @@ class KrakenOutput:
         self.table = self.table.groupby(['TaxID']).sum().reset_index()
         # Index is TaxID
         self.table.set_index('TaxID', inplace=True)
+        self.collapsed = True
         
 
+class KrakenRescorer:
+    """
+    Re-apply the Kraken2 confidence scoring to classified reads, without re-running kraken2.
+    The score of a label is C/Q, where C is the number of k-mers mapped to the clade rooted at
+    the label and Q the number of non-ambiguous k-mers (see envs/test-confidence.py): the label
+    is moved up the tree (KrakenTree or TaxonomyIndex of the database) until its score meets the
+    threshold. Labels can only be moved up, so the threshold should be higher than the one used
+    by kraken2. Whole chunks of reads are scored at once, with the clades as preorder intervals.
+    """
+    def __init__(self, tree, confidence=0.0) -> None:
+        self.tree = tree
+        self.index = tree if isinstance(tree, TaxonomyIndex) else tree.index
+        self.confidence = confidence
+
+    def rescore(self, taxid, lca_string):
+        """
+        Output: (new taxid, score of the new label), taxid is 0 if the read becomes unclassified
+        """
+        labels, scores = self.rescore_chunk([taxid], [lca_string])
+        return int(labels[0]), float(scores[0])
+
+    def rescore_chunk(self, taxids, kmers):
+        """
+        rescore() of many reads, from their labels and LCA strings: (new taxids, scores) as arrays
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        clade, queried, nodes, scored = self._clades(taxids, kmers)
+        required = np.ceil(self.confidence * queried)
+        # Clade counts only grow up the tree: the new label is the lowest ancestor with enough k-mers
+        labels = self.index.lowest_ancestor(nodes, lambda ancestors: ~scored | (clade(ancestors) >= required))
+        counts = clade(np.maximum(labels, 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = np.where(scored & (labels >= 0), counts / queried, 0.0)
+        labels = np.where(labels >= 0, self.index.taxids[np.maximum(labels, 0)], 0)
+        return np.where(scored, labels, taxids), scores
+
+    def ranges(self, taxid, lca_string):
+        """
+        Labels a read can get at any threshold, as (label, Q, low, high): the label is chosen
+        when the k-mers required by the threshold, ceil(threshold * Q), are in (low, high].
+        The highest threshold at which a label holds is high / Q.
+        """
+        return [(int(label), int(total), lower, upper) for label, total, lower, upper in zip(*self.ranges_chunk([taxid], [lca_string]))]
+
+    def ranges_chunk(self, taxids, kmers):
+        """
+        ranges() of many reads at once, as arrays (labels, Q, low, high) with one row per range
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        clade, queried, nodes, scored = self._clades(taxids, kmers)
+        low = np.full(len(taxids), -1.0)
+        # Reads that cannot be re-scored keep their label at any threshold
+        ranges = [(taxids[~scored], queried[~scored], low[~scored], np.full((~scored).sum(), math.inf))]
+        active = scored.copy()
+        while active.any():
+            counts = clade(nodes)
+            # Ancestors with the same clade count as their child are never chosen
+            chosen = active & (counts > low)
+            ranges.append((self.index.taxids[nodes[chosen]], queried[chosen], low[chosen], counts[chosen].astype(np.float64)))
+            low = np.where(chosen, counts, low)
+            active &= self.index.parent[nodes] >= 0
+            nodes = np.where(active, self.index.parent[nodes], nodes)
+        ranges.append((np.zeros(scored.sum(), dtype=np.int64), queried[scored], low[scored], np.full(scored.sum(), math.inf)))
+        return tuple(np.concatenate(column) for column in zip(*ranges))
+
+    def _clades(self, taxids, kmers):
+        # Function counting the k-mers of each read in the clade of a node (one node number per
+        # read), the non-ambiguous k-mers of each read, the node of its label (the root if not
+        # scored) and whether it can be scored (classified, with k-mers)
+        reads, runs, counts, queried = lca_runs(kmers)
+        hit = runs != 0
+        reads, counts, hits = reads[hit], counts[hit], np.atleast_1d(self.index.index(runs[hit]))
+        scored = (taxids != 0) & (queried > 0)
+        nodes = np.zeros(len(taxids), dtype=np.int64)
+        if scored.any():
+            nodes[scored] = self.index.index(taxids[scored])
+
+        def clade(nodes):
+            root = nodes[reads]
+            inside = (hits >= root) & (hits < self.index.end[root])
+            return np.bincount(reads[inside], weights=counts[inside], minlength=len(taxids))
+        return clade, queried, nodes, scored
+
+def validate_output(table, filename):
+    """
+    Check a table of kraken2 output lines (KRAKEN_COLUMNS) read from `filename`, and turn its
+    TaxID column ("562", or "Escherichia coli (taxid 562)" with --use-names) into integers
+    """
+    #Check if the file is a report
+    # 1. Column Classification must be either "C" or "U"
+    if not table['Classification'].isin(['C', 'U']).all():
+        raise Exception(f"\n----\nError loading kraken output from {filename}:\n  Column Classification must be either 'C' or 'U'")
+    # 2. Column TaxID must be an integer, or "name (taxid N)" with --use-names
+    if not table['TaxID'].astype(str).str.isdigit().all():
+        table['TaxID'] = table['TaxID'].astype(str).str.extract(r'\(taxid (\d+)\)$', expand=False).fillna(table['TaxID'].astype(str))
+    if not table['TaxID'].astype(str).str.isdigit().all():
+        raise Exception(f"\n----\nError loading kraken output from {filename}:\n  Column TaxID must be an integer")
+
+    # Set type of TaxID to int
+    table['TaxID'] = table['TaxID'].astype(int)
+    return table
+
+def lca_hits(s):
+    """
+    String: 562:13 561:4 A:31 0:1 562:3
+    Output: ({562: 16, 561: 4}, 21) as k-mers per taxid and number of non-ambiguous k-mers
+    """
+    hits = {}
+    queried = 0
+    for pair in s.split():
+        kmer, count = pair.split(":")
+        if kmer == "|" or kmer == "A":
+            continue
+        count = int(count)
+        queried += count
+        if kmer != "0":
+            hits[int(kmer)] = hits.get(int(kmer), 0) + count
+    return hits, queried
+
+def lca_runs(kmers, batch=10000):
+    """
+    Vectorised lca_hits() for a whole column (or any list) of LCA strings: the read (position in
+    the list), taxid and k-mers of each non-ambiguous run (taxid 0 for unclassified k-mers), and
+    the number of non-ambiguous k-mers of each read.
+    Tokenised like lca_confidence(), `batch` strings at a time (small enough for the temporary
+    arrays to stay in cache).
+    Input: ["562:13 A:31 0:1", "561:4"]
+    Output: (array([0, 0, 1]), array([562, 0, 561]), array([13, 1, 4]), array([14, 4]))
+    """
+    kmers = [s if isinstance(s, str) else "" for s in kmers]
+    reads, taxids, counts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for start in range(0, len(kmers), batch):
+        block = kmers[start:start + batch]
+        buf = np.frombuffer(("\n".join(block) + "\n").encode(), dtype=np.uint8)
+        space = buf <= ord(" ")
+        first = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+        last = np.flatnonzero(~space & np.concatenate((space[1:], [True]))) + 1
+        # Every run, including "A:31" and "|:|", is a single token with one colon
+        colon = np.flatnonzero(buf == ord(":"))
+        if len(colon) != len(first) or np.any((colon < first) | (colon >= last)):
+            raise ValueError("Invalid LCA string: runs must be taxid:k-mers")
+        ends = np.searchsorted(first, np.flatnonzero(buf == ord("\n")))
+        read = np.repeat(np.arange(start, start + len(block)), np.diff(ends, prepend=0))
+        # Ambiguous runs ("A") and the mate separator ("|") are skipped
+        taxon = buf[first]
+        keep = (taxon >= ord("0")) & (taxon <= ord("9"))
+        if not np.all(keep | (taxon == ord("A")) | (taxon == ord("|"))):
+            raise ValueError("Invalid LCA string: runs must be taxid:k-mers")
+        first, colon, last = first[keep], colon[keep], last[keep]
+        # Taxids and k-mer counts parsed together
+        values = _parse_integers(buf, np.concatenate((first, colon + 1)), np.concatenate((colon, last)))
+        reads.append(read[keep])
+        taxids.append(values[:len(first)])
+        counts.append(values[len(first):])
+
+    reads, taxids, counts = np.concatenate(reads), np.concatenate(taxids), np.concatenate(counts)
+    return reads, taxids, counts, np.bincount(reads, weights=counts, minlength=len(kmers)).astype(np.int64)
+
+def _parse_integers(buf, starts, stops):
+    # Decimal integers in buf[starts[i]:stops[i]], eight digits at a time: the last eight bytes of
+    # each field are read as one little-endian integer (first digit in the lowest byte), the bytes
+    # before the field are zeroed (leading zeros), and the digits are combined in pairs, quads, octets
+    lengths = stops - starts
+    if np.any(lengths <= 0):
+        raise ValueError("Invalid LCA string: runs must be taxid:k-mers")
+    low = np.maximum(starts, stops - 8)
+    padded = np.concatenate((np.zeros(8, dtype=np.uint8), buf))
+    # Unaligned view: octets[i] holds buf[i - 8:i]
+    octets = np.ndarray((len(buf) + 1,), dtype="<u8", buffer=padded, strides=(1,))
+    # XOR maps the digit characters, and only them, to 0-9
+    octets = (octets[stops] ^ np.uint64(0x3030303030303030)) & _OCTET_MASKS[stops - low]
+    if np.any((octets + np.uint64(0x7676767676767676) | octets) & np.uint64(0x8080808080808080)):
+        raise ValueError("Invalid LCA string: runs must be taxid:k-mers")
+    octets = (octets * np.uint64(10) + (octets >> np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    octets = (octets * np.uint64(100) + (octets >> np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    octets = (octets * np.uint64(10000) + (octets >> np.uint64(32))) & np.uint64(0xFFFFFFFF)
+    values = octets.astype(np.int64)
+    longer = np.flatnonzero(low > starts)
+    if len(longer):
+        values[longer] += _parse_integers(buf, starts[longer], low[longer]) * 10 ** 8
+    return values
+
+# Keeps the last n bytes of an octet
+_OCTET_MASKS = np.array([0] + [(2 ** 64 - 1) << (8 * (8 - n)) & (2 ** 64 - 1) for n in range(1, 9)], dtype=np.uint64)
+
 def str_to_confidence(s):
     """
     String: 3:83 52:11 3:1 52:5 3:5 52:11 3:10 459:5 874:2 459:3 52:5 3:17 1:14 3:3 1:1 3:19 0:1 2882:4 3:17 |:| 3:43 1:1 3:3 1:36 3:15 0:10 2911:5 0:11 3:3 0:3 52:6 3:81
@@ -123,6 +432,42 @@ def str_to_confidence(s):
             defined += 1
     return defined / total
 
+def lca_confidence(kmers, batch=100000):
+    """
+    Vectorised str_to_confidence() for a whole column (or any list) of LCA strings.
+    The strings are joined in a single byte buffer and tokenised with NumPy,
+    `batch` strings at a time to keep the temporary arrays small.
+    Output: (confidence, total k-mer runs, defined k-mer runs) as arrays.
+    Strings without any k-mer run get a NaN confidence.
+    """
+    kmers = list(kmers)
+    total = np.zeros(len(kmers), dtype=np.int64)
+    zeros = np.zeros(len(kmers), dtype=np.int64)
+    for start in range(0, len(kmers), batch):
+        block = kmers[start:start + batch]
+        buf = np.frombuffer(("\n".join(block) + "\n").encode(), dtype=np.uint8)
+        # Only spaces, tabs and newlines can be found below the space byte in Kraken output
+        space = buf <= ord(" ")
+        # A token starts at every non-space byte following a space (or the start of the buffer)
+        first = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+        # The buffer ends with a newline, so the byte after a token start always exists
+        taxon, sep = buf[first], buf[first + 1] == ord(":")
+        mates = sep & (taxon == ord("|"))
+        undefined = sep & (taxon == ord("0"))
+        # Number of tokens before the end of each string, used to count tokens per string
+        ends = np.searchsorted(first, np.flatnonzero(buf == ord("\n")))
+        total[start:start + len(block)] = np.diff(_cumulative(~mates)[ends], prepend=0)
+        zeros[start:start + len(block)] = np.diff(_cumulative(undefined)[ends], prepend=0)
+
+    defined = total - zeros
+    with np.errstate(divide="ignore", invalid="ignore"):
+        confidence = defined / total
+    return confidence, total, defined
+
+def _cumulative(mask):
+    # Running count of True values, with a leading 0
+    return np.concatenate(([0], np.cumsum(mask)))
+
 def taxonomy_splitter(taxonomy_string):
     """
     Input: 'Bacteria (taxid 3)'
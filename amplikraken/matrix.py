@@ -0,0 +1,260 @@
+# This file contains a sparse taxon by sample count matrix, to merge many samples
+import os
+import json
+import collections
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import amplikraken.cache
+
+
+class CountMatrix:
+    """
+    Sparse (CSR) matrix of integer read counts, with one row per TaxID and one column per sample.
+    Only the non-zero counts are stored, so merging samples never builds the dense table.
+
+    Input:
+        matrix = CountMatrix.from_counts({"S1": {562: 10, 1280: 3}, "S2": {562: 7}})
+    Output:
+        matrix.taxids = [562, 1280], matrix.samples = ["S1", "S2"], matrix.get(1280, "S2") = 0
+    """
+    def __init__(self, matrix, taxids, samples) -> None:
+        self.matrix = scipy.sparse.csr_matrix(matrix, dtype=np.int64)
+        self.taxids = np.asarray(taxids, dtype=np.int64)
+        self.samples = list(samples)
+        if self.matrix.shape != (len(self.taxids), len(self.samples)):
+            raise ValueError(f"Matrix shape {self.matrix.shape} does not match {len(self.taxids)} taxa and {len(self.samples)} samples")
+
+    def __repr__(self) -> str:
+        return f"CountMatrix({len(self.taxids)} taxa, {len(self.samples)} samples, {self.matrix.nnz} counts)"
+
+    def __len__(self):
+        return len(self.taxids)
+
+    @classmethod
+    def from_counts(cls, samples):
+        """
+        Build the matrix from {sample: counts}, where counts is a mapping or a Series of TaxID -> reads
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        names, columns, rows, values = [], [empty], [empty], [empty]
+        for column, (name, counts) in enumerate(samples.items()):
+            counts = pd.Series(counts, dtype="int64")
+            counts = counts[counts != 0]
+            names.append(name)
+            rows.append(counts.index.to_numpy(dtype=np.int64))
+            values.append(counts.to_numpy(dtype=np.int64))
+            columns.append(np.full(len(counts), column, dtype=np.int64))
+
+        taxids, rows = np.unique(np.concatenate(rows), return_inverse=True)
+        matrix = scipy.sparse.coo_matrix((np.concatenate(values), (rows.ravel(), np.concatenate(columns))),
+                                         shape=(len(taxids), len(names)), dtype=np.int64)
+        # Duplicated TaxIDs in a sample are summed by the conversion
+        return cls(matrix.tocsr(), taxids, names)
+
+    @classmethod
+    def from_tables(cls, tables):
+        """
+        Build the matrix from collapsed KrakenOutput tables (TaxID index, one column named after the sample)
+        """
+        tables = list(tables)
+        duplicated = [name for name, n in collections.Counter(table.columns[0] for table in tables).items() if n > 1]
+        if duplicated:
+            raise ValueError(f"Duplicated sample names: {', '.join(map(str, duplicated))}")
+        return cls.from_counts({table.columns[0]: table.iloc[:, 0] for table in tables})
+
+    def get(self, taxid, sample):
+        row = np.searchsorted(self.taxids, taxid)
+        if row == len(self.taxids) or self.taxids[row] != taxid:
+            return 0
+        return int(self.matrix[row, self.samples.index(sample)])
+
+    def totals(self):
+        """
+        Reads counted in each sample, as a Series
+        """
+        return pd.Series(np.asarray(self.matrix.sum(axis=0)).ravel(), index=self.samples)
+
+    def merge(self, other):
+        """
+        Return a new matrix with the samples of both (samples with the same name are summed)
+        """
+        samples = list(self.samples) + [s for s in other.samples if s not in self.samples]
+        taxids = np.union1d(self.taxids, other.taxids)
+        parts = []
+        for part in (self, other):
+            coo = part.matrix.tocoo()
+            columns = np.array([samples.index(s) for s in part.samples], dtype=np.int64)
+            parts.append((coo.data, np.searchsorted(taxids, part.taxids[coo.row]), columns[coo.col]))
+        data, rows, columns = (np.concatenate(values) for values in zip(*parts))
+        matrix = scipy.sparse.coo_matrix((data, (rows, columns)), shape=(len(taxids), len(samples)), dtype=np.int64)
+        return CountMatrix(matrix.tocsr(), taxids, samples)
+
+    def drop(self, samples):
+        """
+        Return a new matrix without some samples (and without the taxa left with no reads)
+        """
+        keep = [i for i, sample in enumerate(self.samples) if sample not in set(samples)]
+        matrix = self.matrix[:, keep]
+        rows = np.flatnonzero(matrix.getnnz(axis=1))
+        return CountMatrix(matrix[rows], self.taxids[rows], [self.samples[i] for i in keep])
+
+    def select(self, samples):
+        """
+        Return a new matrix with only the given samples, in that order (and without the taxa left
+        with no reads). Samples not in the matrix are ignored
+        """
+        present = set(self.samples)
+        samples = [sample for sample in samples if sample in present]
+        matrix = self.matrix[:, [self.samples.index(sample) for sample in samples]]
+        rows = np.flatnonzero(matrix.getnnz(axis=1))
+        return CountMatrix(matrix[rows], self.taxids[rows], samples)
+
+    def to_dataframe(self, names=None):
+        """
+        Dense DataFrame (TaxID index), with a 'Name' column if a {taxid: name} mapping is given
+        """
+        table = pd.DataFrame(self.matrix.toarray(), index=pd.Index(self.taxids, name="TaxID"), columns=self.samples)
+        if names is not None:
+            table.insert(0, "Name", [names.get(taxid) for taxid in self.taxids])
+        return table
+
+    def to_biom(self, names=None, table_id=None):
+        """
+        biom.Table with the TaxIDs as observations, with the names (if given) as observation
+        metadata ('taxonomy', a list as in the BIOM convention)
+        """
+        import biom
+        metadata = None
+        if names is not None:
+            metadata = [{"taxonomy": [names.get(taxid) or ""]} for taxid in self.taxids]
+        return biom.Table(self.matrix.tocsc(), [str(taxid) for taxid in self.taxids], self.samples,
+                          observation_metadata=metadata, table_id=table_id, type="OTU table")
+
+    def write_biom(self, filename, names=None):
+        """
+        Save as BIOM: JSON (BIOM 1.0) if the file name ends with .json, HDF5 (BIOM 2.1) otherwise
+        """
+        import biom.util
+        table = self.to_biom(names=names, table_id=os.path.basename(filename))
+        if filename.endswith(".json"):
+            with open(filename, "w") as f:
+                table.to_json("amplikraken", direct_io=f)
+        else:
+            with biom.util.biom_open(filename, "w") as f:
+                table.to_hdf5(f, "amplikraken")
+
+    def write_tsv(self, filename, names=None, block=10000):
+        """
+        Save as a tab separated table (TaxID, optional Name, one column per sample),
+        densifying `block` rows at a time
+        """
+        with open(filename, "w") as f:
+            header = ["TaxID"] + (["Name"] if names is not None else []) + self.samples
+            f.write("\t".join(header) + "\n")
+            for start in range(0, len(self.taxids), block):
+                counts = self.matrix[start:start + block].toarray()
+                for taxid, row in zip(self.taxids[start:start + block], counts):
+                    fields = [str(taxid)]
+                    if names is not None:
+                        fields.append(names.get(taxid) or "")
+                    fields.extend(map(str, row))
+                    f.write("\t".join(fields) + "\n")
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Load a matrix saved by write() (BIOM or TSV, the names are not kept)
+        """
+        if filename.endswith(".biom") or filename.endswith(".biom.json"):
+            import biom
+            table = biom.load_table(filename)
+            taxids = [int(taxid) for taxid in table.ids(axis="observation")]
+            matrix = table.matrix_data.astype(np.int64)
+            order = np.argsort(taxids, kind="stable")
+            return cls(matrix.tocsr()[order], np.asarray(taxids)[order], list(table.ids(axis="sample")))
+
+        table = pd.read_csv(filename, sep="\t", index_col=0, dtype={"TaxID": np.int64, "Name": str})
+        table = table.drop(columns=["Name"], errors="ignore").astype(np.int64).sort_index()
+        return cls(scipy.sparse.csr_matrix(table.to_numpy()), table.index.to_numpy(), list(table.columns))
+
+    def write(self, filename, names=None):
+        """
+        Save as BIOM if the file name ends with .biom (or .biom.json), as TSV otherwise
+        """
+        if filename.endswith(".biom") or filename.endswith(".biom.json"):
+            self.write_biom(filename, names=names)
+        else:
+            self.write_tsv(filename, names=names)
+
+
+class MatrixManifest:
+    """
+    Record of the inputs merged in a matrix (path, size, modification time and content hash of
+    each sample) and of the parameters used to count them, saved as JSON next to the matrix
+    (`counts.biom` -> `counts.biom.manifest.json`) to add new samples without re-parsing the others.
+
+    Input:
+        manifest = MatrixManifest({"confidence": 0.5, "unclassified": False})
+        manifest.add("S1", "S1.tsv"); manifest.changed("S1", "S1.tsv")
+    Output:
+        False (until S1.tsv is modified)
+    """
+    def __init__(self, parameters, samples=None) -> None:
+        self.parameters = dict(parameters)
+        self.samples = dict(samples or {})
+
+    def __repr__(self) -> str:
+        return f"MatrixManifest({len(self.samples)} samples, {self.parameters})"
+
+    @staticmethod
+    def filename(matrix_filename):
+        return matrix_filename + ".manifest.json"
+
+    @classmethod
+    def load(cls, matrix_filename):
+        with open(cls.filename(matrix_filename)) as f:
+            data = json.load(f)
+        return cls(data["parameters"], data["samples"])
+
+    def save(self, matrix_filename):
+        filename = self.filename(matrix_filename)
+        with open(filename + f".{os.getpid()}", "w") as f:
+            json.dump({"parameters": self.parameters, "samples": self.samples}, f, indent=1)
+        os.replace(filename + f".{os.getpid()}", filename)
+
+    def add(self, sample, filename, hash=None):
+        """
+        Record the file of a sample, with its content `hash` (file_hash) if already computed
+        """
+        stat = os.stat(filename)
+        self.samples[sample] = {
+            "path": os.path.abspath(filename),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": hash if hash is not None else amplikraken.cache.file_hash(filename),
+        }
+
+    def retain(self, samples):
+        """
+        Forget the samples not in `samples` (inputs removed since the matrix was built)
+        """
+        samples = set(samples)
+        self.samples = {sample: record for sample, record in self.samples.items() if sample in samples}
+
+    def changed(self, sample, filename):
+        """
+        True if the sample is not in the manifest or its file differs from the one merged:
+        the content hash is only checked when the size or modification time changed
+        """
+        record = self.samples.get(sample)
+        if record is None:
+            return True
+        stat = os.stat(filename)
+        if stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]:
+            return False
+        if stat.st_size != record["size"] or amplikraken.cache.file_hash(filename) != record["hash"]:
+            return True
+        # Same content (touched or copied): remember the new time
+        self.add(sample, filename)
+        return False
@@ -0,0 +1,283 @@
+# This file contains the clustering of reads into pseudo-OTUs by the taxa hit by their k-mers
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from amplikraken.kraken import KRAKEN_COLUMNS, lca_hits
+from amplikraken.consumers import read_weight
+
+# Prime above 2^32 for the MinHash hash functions: (a * x + b) % PRIME fits in 64 bits
+PRIME = 4294967311
+
+def lca_profiles(kmers, index=None, decay=0.5):
+    """
+    Weighted taxon profiles of LCA strings: a sparse matrix with one L2-normalised row per string
+    and one column per taxon (the k-mers hitting the taxon), and the taxids of the columns.
+    Unclassified and ambiguous k-mers are ignored. With a TaxonomyIndex the hits also count for
+    the ancestors of the taxon (but the root), `decay` times less at each level up, so that reads
+    hitting close taxa get similar profiles.
+
+    Input:
+        lca_profiles(["562:3 561:1", "0:5"])
+    Output:
+        (2 x 2 matrix [[0.32, 0.95], [0, 0]], array([561, 562]))
+    """
+    rows, taxids, counts = [], [], []
+    for row, kmer_string in enumerate(kmers):
+        hits, _ = lca_hits(kmer_string)
+        rows.extend([row] * len(hits))
+        taxids.extend(hits.keys())
+        counts.extend(hits.values())
+    rows = np.asarray(rows, dtype=np.int64)
+    taxids = np.asarray(taxids, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.float64)
+
+    if index is not None and len(taxids):
+        # One level up at a time, for all the hits at once
+        nodes = index.index(taxids)
+        levels = [(rows, taxids, counts)]
+        weight = counts
+        while True:
+            nodes = index.parent[nodes]
+            # Stop before the root, shared by all the profiles
+            keep = (nodes >= 0) & (index.parent[np.maximum(nodes, 0)] >= 0)
+            if not keep.any():
+                break
+            rows, nodes, weight = rows[keep], nodes[keep], weight[keep] * decay
+            levels.append((rows, index.taxids[nodes], weight))
+        rows, taxids, counts = (np.concatenate(columns) for columns in zip(*levels))
+
+    columns, position = np.unique(taxids, return_inverse=True)
+    profiles = scipy.sparse.csr_matrix((counts, (rows, position.ravel())), shape=(len(kmers), len(columns)))
+    norms = np.sqrt(np.asarray(profiles.multiply(profiles).sum(axis=1)).ravel())
+    profiles = scipy.sparse.diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)) @ profiles
+    return profiles.tocsr(), columns
+
+def minhash(profiles, taxids, num_perm=32, seed=1, block=1000000):
+    """
+    MinHash signatures (rows x num_perm) of the set of taxa of each profile, hashing the taxids so
+    that the signatures do not depend on the columns. Empty profiles get PRIME in every position
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 32, num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+    signatures = np.full((profiles.shape[0], num_perm), PRIME, dtype=np.uint64)
+    nonempty = np.flatnonzero(np.diff(profiles.indptr))
+    # Rows of at most `block` hits at a time, to bound the (hits x num_perm) hash array
+    starts = profiles.indptr[nonempty]
+    for first in range(0, len(nonempty), max(1, block // max(1, num_perm))):
+        rows = nonempty[first:first + max(1, block // max(1, num_perm))]
+        begin, end = profiles.indptr[rows[0]], profiles.indptr[rows[-1] + 1]
+        x = taxids[profiles.indices[begin:end]].astype(np.uint64)
+        hashes = (x[:, None] * a[None, :] + b[None, :]) % np.uint64(PRIME)
+        signatures[rows] = np.minimum.reduceat(hashes, starts[first:first + len(rows)] - begin, axis=0)
+    return signatures
+
+def lsh_buckets(signatures, bands):
+    """
+    Bucket of each signature in each band (rows x bands): signatures in the same bucket of
+    a band are equal on the band, and likely to come from similar taxon sets
+    """
+    per_band = signatures.shape[1] // bands
+    if per_band == 0:
+        raise ValueError(f"{bands} bands need at least {bands} hash functions, not {signatures.shape[1]}")
+    buckets = np.empty((signatures.shape[0], bands), dtype=np.int64)
+    for band in range(bands):
+        block = np.ascontiguousarray(signatures[:, band * per_band:(band + 1) * per_band])
+        _, inverse = np.unique(block, axis=0, return_inverse=True)
+        buckets[:, band] = inverse.ravel()
+    return buckets
+
+def distinct_rows(matrix):
+    """
+    Distinct rows of a sparse matrix: the distinct row of each row, and the matrix of the distinct
+    rows (in order of first occurrence)
+    """
+    matrix = matrix.tocsr()
+    matrix.sort_indices()
+    keys = [matrix.indices[start:end].tobytes() + matrix.data[start:end].tobytes()
+            for start, end in zip(matrix.indptr[:-1], matrix.indptr[1:])]
+    codes, _ = pd.factorize(pd.Series(keys, dtype=object))
+    _, first = np.unique(codes, return_index=True)
+    return codes.astype(np.int64), matrix[first]
+
+
+class PseudoOTUs:
+    """
+    Cluster reads into pseudo-OTUs by the taxa hit by their k-mers (the LCA strings of the kraken2
+    output), instead of by their sequence. Each distinct LCA string becomes a weighted taxon
+    profile (lca_profiles); distinct profiles are clustered greedily, most abundant first, joining
+    the most similar centroid (cosine similarity, at least `threshold`) or founding a new OTU.
+    Centroids are only compared with the profiles sharing a bucket of the MinHash LSH index
+    (`num_perm` hash functions in `bands` bands), and the similarities are computed for blocks
+    of profiles at once.
+    After load() or fit(): `labels` (OTU of each read, -1 without classified k-mers), `table`
+    (reads per OTU and sample), and `profiles` (mean profile of each OTU, L1-normalised).
+
+    Input:
+        otus = PseudoOTUs(threshold=0.8).load(["S1.tsv", "S2.tsv"])
+        otus.representatives(names=index.taxids_to_names(otus.taxa))
+    Output:
+        otus.table: DataFrame (OTU index, S1.tsv and S2.tsv columns) of read counts
+    """
+    def __init__(self, threshold=0.8, num_perm=32, bands=16, index=None, decay=0.5, seed=1) -> None:
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.index = index
+        self.decay = decay
+        self.seed = seed
+        self.labels = None
+        self.table = pd.DataFrame()
+        self.profiles = None
+        self.taxa = np.zeros(0, dtype=np.int64)
+
+    def __repr__(self) -> str:
+        return f"PseudoOTUs(threshold={self.threshold}, {len(self.table)} OTUs)"
+
+    def __len__(self):
+        return len(self.table)
+
+    def load(self, filenames, names=None):
+        """
+        Cluster the reads of kraken2 output files (one sample each, named after the files by
+        default); dereplicated reads ("uid;size=40") count as their multiplicity
+        """
+        names = names if names is not None else [os.path.basename(f) for f in filenames]
+        kmers, samples, weights = [], [], []
+        for name, filename in zip(names, filenames):
+            if os.path.getsize(filename) == 0:
+                table = pd.DataFrame({"Read": [], "kmers": []}, dtype=str)
+            else:
+                table = pd.read_csv(filename, sep="\t", header=None, names=KRAKEN_COLUMNS, usecols=["Read", "kmers"], dtype=str)
+            kmers.append(table["kmers"].fillna(""))
+            samples.append(np.full(len(table), name, dtype=object))
+            weights.append(np.fromiter((read_weight(read) for read in table["Read"]), dtype=np.int64, count=len(table)))
+        return self.fit(pd.concat(kmers, ignore_index=True) if kmers else [], np.concatenate(samples) if samples else None,
+                        np.concatenate(weights) if weights else None, columns=names)
+
+    def fit(self, kmers, samples=None, weights=None, columns=None):
+        """
+        Cluster reads given their LCA strings, with the sample (default: "Count") and the number of
+        reads (default: 1) of each. Returns self
+        """
+        kmers = pd.Series(kmers, dtype=object)
+        samples = pd.Series(samples if samples is not None else ["Count"] * len(kmers), dtype=object)
+        weights = np.asarray(weights if weights is not None else np.ones(len(kmers)), dtype=np.int64)
+
+        # Distinct profiles (most LCA strings are unique, but many give the same profile), with their total number of reads
+        codes, uniques = pd.factorize(kmers)
+        profiles, self.taxa = lca_profiles(list(uniques), self.index, self.decay)
+        profile_of, profiles = distinct_rows(profiles)
+        codes = profile_of[codes]
+        abundance = np.bincount(codes, weights=weights, minlength=profiles.shape[0]) if len(codes) else np.zeros(0)
+        centroid_of = self._cluster(profiles, abundance)
+
+        # OTUs numbered from 1 by decreasing abundance
+        valid = centroid_of >= 0
+        centroids, otu_of = np.unique(centroid_of[valid], return_inverse=True)
+        otu_reads = np.bincount(otu_of, weights=abundance[valid], minlength=len(centroids))
+        order = np.argsort(-otu_reads, kind="stable")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(1, len(order) + 1)
+        label_of = np.full(profiles.shape[0], -1, dtype=np.int64)
+        label_of[valid] = rank[otu_of]
+        self.labels = label_of[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+
+        # Mean L1-normalised profile of the members, weighted by their reads
+        l1 = abs(profiles)
+        sums = np.asarray(l1.sum(axis=1)).ravel()
+        l1 = scipy.sparse.diags(np.divide(abundance, sums, out=np.zeros_like(sums), where=sums > 0)) @ l1
+        membership = scipy.sparse.csr_matrix((np.ones(valid.sum()), (label_of[valid] - 1, np.flatnonzero(valid))), shape=(len(centroids), profiles.shape[0]))
+        profiles = (membership @ l1).tocsr()
+        totals = np.asarray(profiles.sum(axis=1)).ravel()
+        self.profiles = (scipy.sparse.diags(np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0)) @ profiles).tocsr()
+
+        # Reads per OTU and sample
+        assigned = self.labels >= 0
+        table = pd.DataFrame({"OTU": self.labels[assigned], "Sample": samples[assigned].to_numpy(), "Reads": weights[assigned]})
+        table = table.groupby(["OTU", "Sample"])["Reads"].sum().unstack(fill_value=0)
+        columns = columns if columns is not None else sorted(samples.unique())
+        self.table = table.reindex(index=pd.RangeIndex(1, len(centroids) + 1, name="OTU"), columns=columns, fill_value=0).astype(np.int64)
+        self.table.columns.name = None
+        return self
+
+    def representatives(self, top=5, names=None):
+        """
+        Representative profile of each OTU: reads, main taxon (with its name if a {taxid: name}
+        mapping is given) and the `top` taxa of the profile with their weight ("562:0.812 561:0.188")
+        """
+        rows = []
+        for otu in range(self.profiles.shape[0]):
+            start, end = self.profiles.indptr[otu], self.profiles.indptr[otu + 1]
+            weights, taxa = self.profiles.data[start:end], self.taxa[self.profiles.indices[start:end]]
+            order = np.lexsort((taxa, -weights))[:top]
+            row = {"OTU": otu + 1, "Reads": int(self.table.loc[otu + 1].sum()), "TaxID": int(taxa[order[0]]) if len(order) else 0}
+            if names is not None:
+                row["Name"] = names.get(row["TaxID"])
+            row["Profile"] = " ".join(f"{taxa[i]}:{weights[i]:.3f}" for i in order)
+            rows.append(row)
+        return pd.DataFrame(rows, columns=["OTU", "Reads", "TaxID"] + (["Name"] if names is not None else []) + ["Profile"]).set_index("OTU")
+
+    def _cluster(self, profiles, abundance, block=512):
+        # Centroid (row of profiles) of each profile, -1 for the empty ones. Profiles are assigned
+        # `block` at a time: the similarities to the centroids of their buckets, then to the
+        # centroids founded earlier in the block, are computed for the whole block at once
+        centroid_of = np.full(profiles.shape[0], -1, dtype=np.int64)
+        nonempty = np.flatnonzero(np.diff(profiles.indptr) > 0)
+        if len(nonempty) == 0:
+            return centroid_of
+        buckets = lsh_buckets(minhash(profiles, self.taxa, self.num_perm, self.seed), self.bands)
+        order = nonempty[np.lexsort((nonempty, -abundance[nonempty]))]
+        # Centroids in each bucket of each band
+        index = [{} for _ in range(self.bands)]
+        for start in range(0, len(order), block):
+            rows = order[start:start + block]
+            row_buckets = buckets[rows]
+            best, best_centroid = self._best_centroids(profiles, rows, row_buckets, index)
+
+            # Similarities within the block, between the profiles sharing a bucket
+            within = (profiles[rows] @ profiles[rows].T).toarray()
+            within[~(row_buckets[:, None, :] == row_buckets[None, :, :]).any(axis=2)] = -np.inf
+            founded = []
+            for position, row in enumerate(rows):
+                if founded:
+                    similarity = within[position, founded]
+                    top = int(np.argmax(similarity))
+                    if similarity[top] > best[position]:
+                        best[position], best_centroid[position] = similarity[top], rows[founded[top]]
+                if best[position] >= self.threshold:
+                    centroid_of[row] = best_centroid[position]
+                else:
+                    centroid_of[row] = row
+                    founded.append(position)
+            for position in founded:
+                for band, bucket in enumerate(row_buckets[position].tolist()):
+                    index[band].setdefault(bucket, []).append(int(rows[position]))
+        return centroid_of
+
+    def _best_centroids(self, profiles, rows, row_buckets, index, pairs=1000000):
+        # Most similar centroid sharing a bucket with each row (-inf and -1 without any)
+        best = np.full(len(rows), -np.inf)
+        best_centroid = np.full(len(rows), -1, dtype=np.int64)
+        positions, candidates = [], []
+        for band in range(self.bands):
+            for position, bucket in enumerate(row_buckets[:, band].tolist()):
+                found = index[band].get(bucket)
+                if found:
+                    positions.extend([position] * len(found))
+                    candidates.extend(found)
+        if not candidates:
+            return best, best_centroid
+        # Each (row, centroid) pair once, its similarity as the dot product of the two profiles
+        keys = np.unique(np.asarray(positions, dtype=np.int64) * profiles.shape[0] + np.asarray(candidates, dtype=np.int64))
+        positions, candidates = keys // profiles.shape[0], keys % profiles.shape[0]
+        similarity = np.concatenate([np.asarray(profiles[rows[positions[i:i + pairs]]].multiply(profiles[candidates[i:i + pairs]]).sum(axis=1)).ravel()
+                                     for i in range(0, len(keys), pairs)])
+        # Highest similarity of each row (the lowest centroid on ties)
+        order = np.lexsort((candidates, -similarity, positions))
+        first = order[np.r_[True, positions[order][1:] != positions[order][:-1]]]
+        best[positions[first]] = similarity[first]
+        best_centroid[positions[first]] = candidates[first]
+        return best, best_centroid
+
@@ -0,0 +1,87 @@
+# This file contains functions writing the kraken2 outputs (names, report) from a TaxonomyIndex
+import numpy as np
+
+# Rank codes of the report, the other ranks are numbered after the closest one above (e.g. "G1")
+REPORT_RANKS = {
+    "superkingdom": "D",
+    "kingdom": "K",
+    "phylum": "P",
+    "class": "C",
+    "order": "O",
+    "family": "F",
+    "genus": "G",
+    "species": "S",
+}
+
+def kraken_report(index, taxids, counts, unclassified=0):
+    """
+    Lines of the report written by `kraken2 --report` for the reads classified at `taxids`
+    (with `counts` reads each) plus `unclassified` reads. As kraken2: percentage of the clade,
+    reads in the clade, reads at the taxon, rank code, taxid and the indented name, visiting
+    the taxonomy depth-first with the children sorted by decreasing clade count, skipping the
+    clades without reads.
+
+    Input:
+        kraken_report(index, [562, 1280], [3, 1], unclassified=1)
+    Output:
+        [" 20.00\\t1\\t1\\tU\\t0\\tunclassified\\n", " 80.00\\t4\\t0\\tR\\t1\\troot\\n", ...]
+    """
+    taxids = np.asarray(taxids, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    taxon = index.node_counts(taxids, counts) if len(taxids) else np.zeros(len(index), dtype=np.int64)
+    cumulative = np.concatenate(([0], np.cumsum(taxon)))
+    clade = cumulative[index.end] - cumulative[:-1]
+    total = int(clade[0]) + unclassified
+
+    lines = []
+    if unclassified:
+        lines.append(_report_line(unclassified, unclassified, total, "U", 0, "unclassified", 0))
+
+    # Depth-first visit from the root, as (node, rank code, rank depth, depth)
+    stack = [(0, "R", -1, 0)]
+    while stack:
+        node, rank_code, rank_depth, depth = stack.pop()
+        if clade[node] == 0:
+            continue
+        rank = index.rank_names[index.rank[node]]
+        if rank in REPORT_RANKS:
+            rank_code, rank_depth = REPORT_RANKS[rank], 0
+        else:
+            rank_depth += 1
+        rank_string = rank_code + (str(rank_depth) if rank_depth != 0 else "")
+        lines.append(_report_line(clade[node], taxon[node], total, rank_string, index.taxids[node], index.names[node] or "", depth))
+
+        children = []
+        child = node + 1
+        while child < index.end[node]:
+            children.append(child)
+            child = index.end[child]
+        # Largest clades first, ties in database order; pushed in reverse to pop in order
+        children.sort(key=lambda child: -clade[child])
+        stack.extend((child, rank_code, rank_depth, depth + 1) for child in reversed(children))
+    return lines
+
+def _report_line(clade, taxon, total, rank, taxid, name, depth):
+    return f"{100.0 * clade / total:6.2f}\t{clade}\t{taxon}\t{rank}\t{taxid}\t{'  ' * depth}{name}\n"
+
+def name_taxid(names, taxid):
+    """
+    Taxon column of `kraken2 --use-names`, from a {taxid: name} mapping
+    Input: 562
+    Output: Escherichia coli (taxid 562)
+    """
+    name = names.get(taxid) if taxid else None
+    return f"{name if name else 'unclassified'} (taxid {taxid})"
+
+def named_lines(lines, index):
+    """
+    Output lines of kraken2 with the names of the taxa, as written by `kraken2 --use-names`.
+    A taxid missing from the index (another database) raises a KeyError
+    """
+    split = [line.split("\t", 3) for line in lines]
+    taxids = np.unique([int(fields[2]) for fields in split])
+    names = index.taxids_to_names(taxids)
+    missing = [int(taxid) for taxid in taxids if taxid != 0 and taxid not in names]
+    if missing:
+        raise KeyError(f"Taxid {missing[0]} not found in the taxonomy")
+    return [f"{fields[0]}\t{fields[1]}\t{name_taxid(names, int(fields[2]))}\t{fields[3]}" for fields in split]
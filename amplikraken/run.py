@@ -4,15 +4,47 @@ Run Kraken2
 
 import os
 import sys
+import queue
+import itertools
+import shutil
+import tempfile
+import threading
 import subprocess
 
 # import utils.py from this dir
 import amplikraken.utils
+import amplikraken.kraken
+from amplikraken.fastq import FastqReader
+from amplikraken.trim import TrimStats
 
+# Lines passed at a time to the consumers, and batches waiting in the queue before the reading stalls
+CONSUMER_BATCH = 10000
+CONSUMER_QUEUE = 100
+
+# Reads written at a time to the named pipes of kraken2, and batches waiting for each pipe.
+# kraken2 reads a block of about 3 MB of R1 before reading the same reads of R2, so the
+# queues must hold more than that not to stall the reading
+FIFO_BATCH = 1000
+FIFO_QUEUE = 64
 
 
 class KrakenRunner:
-    def __init__(self, db, binary="kraken2",  threads=1, confidence=0.0, output=None, verbose=False, keepunclassified=False, workdir=None):
+    """
+    Run kraken2 on a sample, printing the output or saving it to `output`.
+    The output can also be streamed to `consumers` (amplikraken.consumers), fed by a separate
+    thread so that they do not slow down the reading of the pipe, with all the lines
+    (unclassified included); their results (from close()) are saved in `results` after each run.
+    With `names=False` kraken2 is run without --use-names (amplikraken.report can add them).
+    With a KrakenResultCache as `cache`, the output of a run already done with the same
+    database, reads, kraken2 version and parameters is replayed without running kraken2.
+    Reads can also be given as iterables of records, streamed into kraken2 through named pipes
+    without intermediate files. With a ReadTrimmer (amplikraken.trim) as `trimmer`, the reads
+    are trimmed and filtered while they are streamed in the same way; the counts of reads
+    kept and discarded are saved in `trim_stats` after each run.
+    With `memory_mapping=True` kraken2 maps the database instead of loading a private copy,
+    so that concurrent runs share it in the page cache (see amplikraken.database).
+    """
+    def __init__(self, db, binary="kraken2",  threads=1, confidence=0.0, output=None, verbose=False, keepunclassified=False, workdir=None, consumers=None, names=True, cache=None, trimmer=None, memory_mapping=False):
         self.binary = binary
         self.db = db
         self.threads = threads
@@ -21,9 +53,18 @@ class KrakenRunner:
         self.verbose = verbose
         self.workdir = workdir if workdir else os.getcwd()
         self.keepunclassified = keepunclassified
+        self.consumers = list(consumers) if consumers else []
+        self.names = names
+        self.cache = cache
+        self.trimmer = trimmer
+        self.memory_mapping = memory_mapping
+        self.results = None
+        self.trim_stats = None
         self._cmd = None
         self._process = None
         self._output = None
+        self._consumer_error = None
+        self._consumers = []
 
         # Check kraken version
         try:
@@ -39,42 +80,408 @@ class KrakenRunner:
 
 
     def run(self, file1, file2=None):
+        """
+        Classify the reads of `file1` (and `file2` for paired-end reads), or of an iterable of
+        records (header, sequence, quality) or of pairs of records, which are streamed into kraken2
+        through named pipes as they are produced (also used for "-", the standard input).
+        The results of iterables are not cached
+        """
+        records, paired = None, file2 is not None
+        if file1 == "-" or not isinstance(file1, (str, os.PathLike)):
+            if file2 is not None:
+                raise ValueError("Paired reads from an iterable are given as pairs of records, without file2")
+            records = FastqReader(file1) if file1 == "-" else file1
+            records, paired = _peek_paired(records)
+        elif self.trimmer is not None:
+            records = FastqReader(file1, file2, batch_size=FIFO_BATCH)
+
+        # Save to the output file (if set) via a temporary file, so that it only exists when complete
+        if self.output:
+            self._output = open(self.output + ".tmp", "w")
+        try:
+            entry, writer = None, None
+            if self.cache is not None and isinstance(file1, (str, os.PathLike)) and file1 != "-":
+                key = self.cache.key(self, file1, file2)
+                entry = self.cache.get(key)
+                if entry is None:
+                    writer = self.cache.writer(key)
+            if entry is not None:
+                self._replay(entry)
+            elif records is not None:
+                self._execute_records(records, paired, writer)
+            else:
+                self._execute(self._command(file1, file2), writer)
+        except Exception:
+            if self.output:
+                self._output.close()
+                self._output = None
+                os.remove(self.output + ".tmp")
+            raise
+
+        if self.output:
+            self._output.close()
+            self._output = None
+            os.replace(self.output + ".tmp", self.output)
+        return True
+
+    def _command(self, file1, file2=None):
         cmd = [self.binary, "--db", self.db, "--threads", str(self.threads), "--confidence", str(self.confidence)]
+        if self.names:
+            cmd += ["--use-names"]
+        if self.memory_mapping:
+            cmd += ["--memory-mapping"]
         if file2:
-            cmd += ["--paired", "--use-names",  file1, file2]
+            cmd += ["--paired", file1, file2]
         else:
-            cmd += ["--use-names",  file1]
-        
+            cmd += [file1]
+        return cmd
+
+    def _execute(self, cmd, writer=None):
         self._cmd = amplikraken.utils.list_to_string(cmd)
-        print(" ".join(self._cmd))
-        # Use subprocess to run the command, streaming stdout to a function process_line(line)
-        self._process = subprocess.Popen(
-            self._cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
-        # Read the output line by line as it is generated
-        for line in self._process.stdout:
-            self.process_line(line)
+        if self.verbose or not (self.output or self.consumers):
+            print(" ".join(self._cmd), file=sys.stderr if self.output or self.consumers else sys.stdout)
+        # The writer of the result cache (if any) is fed like the consumers
+        consumers = self.consumers + ([writer] if writer is not None else [])
+        self._process = None
+        try:
+            # Use subprocess to run the command, streaming stdout to a function process_line(line)
+            self._process = subprocess.Popen(
+                self._cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True
+            )
+            # Read stderr while reading stdout: kraken2 blocks if the stderr pipe fills up
+            errors = []
+            stderr_reader = threading.Thread(target=lambda: errors.append(self._process.stderr.read()), daemon=True)
+            stderr_reader.start()
+            self._stream(self._process.stdout, consumers)
+        except BaseException:
+            # kraken2 could not start or its output could not be read: stop it, drop the partial results
+            if self._process is not None:
+                self._process.kill()
+                self._process.wait()
+            self._abort(consumers)
+            raise
 
         # Wait for the process to finish and get the return code
         return_code = self._process.wait()
 
         # Handle any error messages from stderr
-        error_message = self._process.stderr.read()
+        stderr_reader.join()
+        error_message = errors[0] if errors else ""
 
         # Check the return code and return appropriate output
-        if return_code == 0:
-            return True
-        else:
+        if return_code != 0:
+            self._abort(consumers)
             raise RuntimeError(f"Error running Kraken2: {error_message}")
+        self._finish(consumers)
+
+    def _execute_records(self, records, paired, writer=None):
+        # Produce the batches in one thread (iterating `records` and trimming), writing them to the
+        # pipes in one thread per mate: the bounded queues stall the producer when kraken2 is slower
+        fifodir, fifos = self._make_fifos(paired, self.consumers + ([writer] if writer is not None else []))
+        queues = [queue.Queue(maxsize=FIFO_QUEUE) for _ in fifos]
+        self.trim_stats = TrimStats() if self.trimmer is not None else None
+        self._writer_errors = []
+        producer = threading.Thread(target=self._produce_records, args=(records, queues), daemon=True)
+        writers = []
+        for fifo, batches in zip(fifos, queues):
+            writers.append(threading.Thread(target=self._write_records, args=(fifo, batches), daemon=True))
+            writers[-1].start()
+        producer.start()
+
+        try:
+            self._execute(self._command(*fifos), writer)
+            producer.join()
+            for thread in writers:
+                thread.join()
+            if self._writer_errors:
+                raise RuntimeError(f"Error streaming reads to Kraken2: {self._writer_errors[0]}")
+        except Exception:
+            self._release(fifos, writers)
+            raise
+        finally:
+            shutil.rmtree(fifodir, ignore_errors=True)
+        if self.verbose and self.trim_stats is not None:
+            print(f"Trimming: kept {self.trim_stats.kept} of {self.trim_stats.reads} reads ({self.trim_stats.no_primer} without primer, {self.trim_stats.too_short} too short)", file=sys.stderr)
+
+    def _make_fifos(self, paired, consumers):
+        # Named pipes for the reads (R1, and R2 if paired) in a new directory of the workdir
+        fifodir = None
+        try:
+            fifodir = tempfile.mkdtemp(prefix="amplikraken-", dir=self.workdir)
+            fifos = [os.path.join(fifodir, "R1.fastq")] + ([os.path.join(fifodir, "R2.fastq")] if paired else [])
+            for fifo in fifos:
+                os.mkfifo(fifo)
+        except BaseException:
+            # kraken2 will not run: nothing is fed to the consumers
+            if fifodir is not None:
+                shutil.rmtree(fifodir, ignore_errors=True)
+            self._abort(consumers)
+            raise
+        return fifodir, fifos
+
+    def _produce_records(self, records, queues):
+        try:
+            batches = _batched(records, FIFO_BATCH)
+            if self.trimmer is not None:
+                batches = self.trimmer.filter(batches, self.trim_stats)
+            batch = []
+            for kept in batches:
+                # Stop early when kraken2 stopped reading
+                if self._writer_errors:
+                    break
+                batch.extend(kept)
+                if len(batch) >= FIFO_BATCH:
+                    self._put_records(batch, queues)
+                    batch = []
+            if batch:
+                self._put_records(batch, queues)
+        except Exception as e:
+            self._writer_errors.append(e)
+        finally:
+            for batches in queues:
+                batches.put(None)
+
+    def _put_records(self, batch, queues):
+        if len(queues) == 1:
+            queues[0].put(batch)
+        else:
+            for mate, batches in enumerate(queues):
+                batches.put([pair[mate] for pair in batch])
+
+    def _write_records(self, fifo, records):
+        out = None
+        try:
+            out = open(fifo, "w")
+        except Exception as e:
+            self._writer_errors.append(e)
+        while True:
+            batch = records.get()
+            if batch is None:
+                break
+            # After an error keep emptying the queue, not to block the trimming
+            if out is not None:
+                try:
+                    out.write("".join(f"@{header}\n{sequence}\n+\n{quality}\n" for header, sequence, quality in batch))
+                except Exception as e:
+                    self._writer_errors.append(e)
+                    out = self._discard(out)
+        if out is not None:
+            try:
+                out.close()
+            except Exception as e:
+                self._writer_errors.append(e)
+
+    def _discard(self, out):
+        try:
+            out.close()
+        except Exception:
+            pass
+        return None
+
+    def _release(self, fifos, writers):
+        # Unblock writers still waiting for kraken2 to open their pipe
+        for fifo, writer in zip(fifos, writers):
+            if writer.is_alive():
+                try:
+                    os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+            writer.join(timeout=10)
+
+    def _replay(self, entry):
+        # Output of a previous run from the result cache, without running kraken2
+        if self.verbose:
+            print(f"Using cached Kraken2 output {entry.path}", file=sys.stderr)
+        try:
+            with entry.open() as lines:
+                self._stream(lines, self.consumers)
+        except BaseException:
+            self._abort(self.consumers)
+            raise
+        self._finish(self.consumers)
+
+    def _stream(self, lines, consumers):
+        self._consumers = consumers
+        if consumers:
+            self._start_consumers()
+        batch = []
+        try:
+            # Read the output line by line as it is generated
+            for line in lines:
+                if self._output is not None or not self.consumers:
+                    self.process_line(line)
+                if consumers:
+                    batch.append(line)
+                    if len(batch) == CONSUMER_BATCH:
+                        self._queue.put(batch)
+                        batch = []
+        finally:
+            if consumers:
+                self._stop_consumers(batch)
+
+    def _finish(self, consumers):
+        if self._consumer_error is not None:
+            self._abort(consumers)
+            raise RuntimeError(f"Error processing Kraken2 output: {self._consumer_error}")
+        results = [consumer.close() for consumer in consumers]
+        self.results = results[:len(self.consumers)]
+
+    def _abort(self, consumers):
+        for consumer in consumers:
+            consumer.abort()
+
+    def _start_consumers(self):
+        self._queue = queue.Queue(maxsize=CONSUMER_QUEUE)
+        self._consumer_error = None
+        self._consumer_thread = threading.Thread(target=self._consume, daemon=True)
+        self._consumer_thread.start()
+
+    def _stop_consumers(self, batch):
+        if batch:
+            self._queue.put(batch)
+        self._queue.put(None)
+        self._consumer_thread.join()
+
+    def _consume(self):
+        while True:
+            lines = self._queue.get()
+            if lines is None:
+                return
+            # After an error keep emptying the queue, not to block the reading
+            if self._consumer_error is None:
+                try:
+                    for consumer in self._consumers:
+                        consumer.feed(lines)
+                except Exception as e:
+                    self._consumer_error = e
 
     def process_line(self, line):
         # Process each line of the output (e.g., store or display)
         # Implement your logic here
         if not self.keepunclassified and line.startswith("U"):
             return
-            
-        print(line, end="")
-        pass
\ No newline at end of file
+
+        if self._output is not None:
+            self._output.write(line)
+        else:
+            print(line, end="")
+        pass
+
+
+def _batched(items, size):
+    # Lists of `size` items (the last one shorter)
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _peek_paired(records):
+    # The records, and whether they are pairs (from the first one: a pair is a tuple of records)
+    iterator = iter(records)
+    first = next(iterator, None)
+    if first is None:
+        return iterator, False
+    return itertools.chain([first], iterator), isinstance(first[0], (tuple, list))
+
+
+class KrakenMultiplexRunner(KrakenRunner):
+    """
+    Classify many samples with a single kraken2 process, so that the database is loaded once.
+    The reads of all the samples are streamed into kraken2 through named pipes, with the read
+    names tagged by the sample ("@3:read_name" for the fourth sample), and the output is split
+    back by sample while it is read. Each read is classified independently, so the per-sample
+    output is the same as running the samples one at a time.
+
+    Input:
+        runner = KrakenMultiplexRunner("db/silva138", threads=16)
+        runner.run(datasets, outdir="output")
+    Output:
+        {"Sample1": "output/Sample1.tsv", ...}, and runner.counts = {"Sample1": {562: 120, ...}, ...}
+    """
+    def run(self, datasets, outdir=None):
+        """
+        Classify a list of FastqDataset (or a FastqDatasets), all paired-end or all single-end.
+        Per-sample outputs are saved as {outdir}/{sample}.tsv if outdir is set, printed otherwise
+        """
+        if hasattr(datasets, "datasets"):
+            datasets = list(datasets.datasets.values())
+        if len(datasets) == 0:
+            return {}
+        paired = set(dataset.reverse is not None for dataset in datasets)
+        if len(paired) > 1:
+            raise ValueError("Cannot multiplex single-end and paired-end samples in the same run")
+        paired = paired.pop()
+
+        self.output = outdir
+        self._samples = [dataset.name for dataset in datasets]
+        self.counts = {name: {} for name in self._samples}
+        outputs = {name: os.path.join(outdir, f"{name}.tsv") for name in self._samples} if outdir else {}
+        self._outputs = {name: open(path + ".tmp", "w") for name, path in outputs.items()}
+        try:
+            fifodir, fifos = self._make_fifos(paired, self.consumers)
+        except BaseException:
+            self._close(outputs, keep=False)
+            raise
+
+        mates = [[dataset.forward for dataset in datasets]] + ([[dataset.reverse for dataset in datasets]] if paired else [])
+        self._writer_errors = []
+        writers = []
+        for fifo, files in zip(fifos, mates):
+            # One thread per mate: kraken2 reads the two pipes alternately
+            writers.append(threading.Thread(target=self._write_fifo, args=(fifo, files), daemon=True))
+            writers[-1].start()
+
+        try:
+            self._execute(self._command(*fifos))
+            if self._writer_errors:
+                raise RuntimeError(f"Error streaming reads to Kraken2: {self._writer_errors[0]}")
+        except Exception:
+            self._release(fifos, writers)
+            self._close(outputs, keep=False)
+            raise
+        finally:
+            shutil.rmtree(fifodir, ignore_errors=True)
+
+        self._close(outputs, keep=True)
+        return outputs
+
+    def process_line(self, line):
+        classification, read, rest = line.split("\t", 2)
+        index, read = read.split(":", 1)
+        sample = self._samples[int(index)]
+        if not self.keepunclassified and classification == "U":
+            return
+
+        taxid, _ = amplikraken.kraken.taxonomy_splitter(rest.split("\t", 1)[0])
+        self.counts[sample][taxid] = self.counts[sample].get(taxid, 0) + 1
+        line = f"{classification}\t{read}\t{rest}"
+        if sample in self._outputs:
+            self._outputs[sample].write(line)
+        else:
+            print(line, end="")
+
+    def _write_fifo(self, fifo, files):
+        try:
+            with open(fifo, "w") as out:
+                for index, filename in enumerate(files):
+                    # Records parsed (not lines), so that a file without a final newline or a
+                    # truncated file cannot shift the tags of the next sample
+                    for batch in FastqReader(filename, batch_size=FIFO_BATCH).batches():
+                        # Tag the name in the header of each record
+                        out.write("".join(f"@{index}:{header}\n{sequence}\n+\n{quality}\n" for header, sequence, quality in batch))
+        except Exception as e:
+            self._writer_errors.append(e)
+
+    def _close(self, outputs, keep):
+        for name, f in self._outputs.items():
+            f.close()
+            if keep:
+                os.replace(outputs[name] + ".tmp", outputs[name])
+            else:
+                os.remove(outputs[name] + ".tmp")
+        self._outputs = {}
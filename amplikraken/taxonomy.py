@@ -0,0 +1,671 @@
+# This file contains classes and functions for handling the taxonomy of a Kraken2 database
+import os
+import sys
+import json
+import struct
+from collections.abc import Mapping
+import numpy as np
+
+# First bytes of a taxonomy saved by TaxonomyIndex.save()
+TAXONOMY_MAGIC = b"AKTAXO01"
+
+# Kraken2 taxonomy (taxo.k2d): magic, node count, names and ranks size, then nodes, names and ranks
+K2D_MAGIC = b"K2TAXDAT"
+K2D_NODE = np.dtype([
+    ("parent_id", "<u8"),
+    ("first_child", "<u8"),
+    ("child_count", "<u8"),
+    ("name_offset", "<u8"),
+    ("rank_offset", "<u8"),
+    ("external_id", "<u8"),
+    ("godparent_id", "<u8"),
+])
+
+class TaxonNode:
+    def __init__(self, node_id, rank=None, name=None):
+        self.node_id = int(node_id)
+        self.rank = rank
+        self.name = name
+        self.children = []
+
+    #def __len__(self):
+    #    return len(self.children)
+    
+    def __str__(self):
+        return f"{self.node_id}:{self.rank}:{self.name} ({len(self.children)} children)"
+
+
+class KrakenTree:
+    def __init__(self, root_id=0):
+        self.root = TaxonNode(root_id)
+        self.nodes = {root_id: self.root}  # Keep track of nodes by their IDs
+        self.parents = {root_id: None}  # Parent ID of each node
+        self.readonly = False
+        self._index = None
+
+    @classmethod
+    def from_index(cls, index):
+        """
+        Read-only tree on top of a TaxonomyIndex (e.g. memory-mapped from a file):
+        nodes are only created when accessed
+        """
+        tree = cls.__new__(cls)
+        tree._index = index
+        tree.nodes = _IndexedNodes(index)
+        tree.parents = _IndexedParents(index)
+        tree.root = tree.nodes[int(index.taxids[0])]
+        tree.readonly = True
+        return tree
+
+    @property
+    def index(self):
+        """
+        TaxonomyIndex of the tree, built on first use (and again after adding nodes)
+        """
+        if self._index is None:
+            self._index = TaxonomyIndex.from_tree(self)
+        return self._index
+
+    def append_child(self, parent_id, child_id, child_rank=None, child_name=None):
+        if self.readonly:
+            raise ValueError("Cannot add nodes to a taxonomy loaded from file")
+        parent_node = self.nodes.get(int(parent_id))
+        if parent_node:
+            child_node = TaxonNode(child_id, child_rank, child_name)
+            parent_node.children.append(child_node)
+            self.nodes[child_id] = child_node
+            self.parents[child_id] = parent_node.node_id
+            self._index = None
+            return True
+        return False
+
+    def print_tree(self, node=None, indent=0):
+        if not node:
+            node = self.root
+        print(' ' * indent + str(node.node_id))
+        for child in node.children:
+            self.print_tree(child, indent + 2)
+
+    def get_parent(self, node_id):
+        if int(node_id) not in self.parents:
+            raise ValueError(f"Node {node_id} not found")
+        return self.parents[int(node_id)]
+
+    def get_lineage(self, node_id):
+        if int(node_id) not in self.parents:
+            raise ValueError(f"Node {node_id} not found")
+
+        # Follow the parents up to the root, then reverse to get the path from root to node
+        lineage = []
+        current = int(node_id)
+        while current is not None:
+            lineage.append(current)
+            current = self.parents[current]
+        lineage.reverse()
+        return lineage
+
+    def get_all_children_ids(self, node_id):
+        if int(node_id) not in self.nodes:
+            raise ValueError(f"Node {node_id} not found")
+        return [int(taxid) for taxid in self.index.descendants(node_id)]
+
+    
+    def get_node_by_name(self, name):
+        taxids = self.index.name_index.search(name)
+        return taxids[0] if taxids else None
+
+    def export_to_newick(self):
+        def build_newick(node):
+            if not node.children:
+                return str(node.node_id)
+            else:
+                children_newick = [build_newick(child) for child in node.children]
+                return f"({','.join(children_newick)}){node.node_id}"
+
+        return build_newick(self.root) + ";"
+    
+    def find_last_common_ancestor(self, ids):
+        if not ids:
+            return None
+        return self.index.lca_set(ids)
+
+
+class TaxonomyIndex:
+    """
+    Taxonomy stored as arrays, with the nodes numbered in preorder (the root is 0):
+    taxid, parent (-1 for the root), depth and rank code of each node.
+    A binary lifting table (the 2^k-th ancestor of each node) answers lowest
+    common ancestor queries in O(log depth), for single ids or whole arrays.
+    In preorder the clade of node i is the interval [i, end[i]), so clade
+    membership is one comparison and descendants or clade sums are slices.
+    """
+    def __init__(self, taxids, parent, ranks, rank_names, names=None) -> None:
+        self.taxids = np.asarray(taxids, dtype=np.int64)
+        self.parent = np.asarray(parent, dtype=np.int32)
+        self.rank = np.asarray(ranks, dtype=np.int16)
+        self.rank_names = list(rank_names)
+        self.names = names if names is not None else [None] * len(self.taxids)
+        self.depth = _depths(self.parent)
+        self.end = (np.arange(len(self.taxids)) + _subtree_sizes(self.parent, self.depth)).astype(np.int32)
+
+        self._order = np.argsort(self.taxids, kind="stable")
+        self._sorted = self.taxids[self._order]
+
+        # up[k][node] is the 2^k-th ancestor of node (the root is its own ancestor)
+        up = np.where(self.parent < 0, np.arange(len(self.parent)), self.parent).astype(np.int32)
+        self._up = [up]
+        for _ in range(1, max(1, int(self.depth.max(initial=0)).bit_length())):
+            self._up.append(self._up[-1][self._up[-1]])
+
+    def __len__(self):
+        return len(self.taxids)
+
+    def __repr__(self) -> str:
+        return f"TaxonomyIndex({len(self)} nodes)"
+
+    @classmethod
+    def from_tree(cls, tree):
+        taxids, parent, ranks, names = [], [], [], []
+        rank_codes = {}
+        # Iterative preorder visit, children in insertion order
+        stack = [(tree.root, -1)]
+        while stack:
+            node, parent_index = stack.pop()
+            taxids.append(node.node_id)
+            parent.append(parent_index)
+            ranks.append(rank_codes.setdefault(node.rank, len(rank_codes)))
+            names.append(node.name)
+            stack.extend((child, len(taxids) - 1) for child in reversed(node.children))
+        return cls(taxids, parent, ranks, list(rank_codes), names)
+
+    def save(self, filename):
+        """
+        Write the arrays (and the names, as one blob) to a binary file that load() memory-maps
+        """
+        names = [(name or "").encode() for name in self.names]
+        arrays = {
+            "taxids": self.taxids,
+            "parent": self.parent,
+            "rank": self.rank,
+            "depth": self.depth,
+            "end": self.end,
+            "order": self._order,
+            "sorted": self._sorted,
+            "up": np.array(self._up),
+            "name_offsets": np.concatenate(([0], np.cumsum([len(name) for name in names]))).astype(np.int64),
+            "names": np.frombuffer(b"".join(names), dtype=np.uint8),
+        }
+        header = {"nodes": len(self), "rank_names": self.rank_names, "arrays": {}}
+        offset = 0
+        for name, values in arrays.items():
+            header["arrays"][name] = [values.dtype.str, list(values.shape), offset]
+            offset += _aligned(values.nbytes)
+        header = json.dumps(header).encode()
+
+        with open(filename + ".tmp", "wb") as f:
+            f.write(TAXONOMY_MAGIC + struct.pack("<Q", len(header)) + header)
+            f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+            for values in arrays.values():
+                f.write(np.ascontiguousarray(values).tobytes())
+                f.write(b"\0" * (_aligned(values.nbytes) - values.nbytes))
+        os.replace(filename + ".tmp", filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Memory-map a file written by save(): loading is immediate and the
+        read-only pages are shared by all the processes using the same file
+        """
+        with open(filename, "rb") as f:
+            if f.read(len(TAXONOMY_MAGIC)) != TAXONOMY_MAGIC:
+                raise ValueError(f"{filename} is not a taxonomy saved by amplikraken")
+            size = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(size))
+        start = _aligned(len(TAXONOMY_MAGIC) + 8 + size)
+        data = np.memmap(filename, dtype=np.uint8, mode="r")
+
+        arrays = {}
+        for name, (dtype, shape, offset) in header["arrays"].items():
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            arrays[name] = data[start + offset:start + offset + nbytes].view(dtype).reshape(shape)
+
+        index = cls.__new__(cls)
+        index.taxids = arrays["taxids"]
+        index.parent = arrays["parent"]
+        index.rank = arrays["rank"]
+        index.depth = arrays["depth"]
+        index.end = arrays["end"]
+        index._order = arrays["order"]
+        index._sorted = arrays["sorted"]
+        index._up = list(arrays["up"])
+        index.rank_names = header["rank_names"]
+        index.names = _BlobNames(arrays["names"], arrays["name_offsets"][:-1], arrays["name_offsets"][1:])
+        return index
+
+    @classmethod
+    def from_k2d(cls, filename):
+        """
+        Index of the taxo.k2d file of a Kraken2 database, read with memory-mapped I/O.
+        Siblings keep the order of the Kraken2 internal ids.
+        """
+        with open(filename, "rb") as f:
+            header = f.read(len(K2D_MAGIC) + 24)
+        if not header.startswith(K2D_MAGIC):
+            raise ValueError(f"{filename} is not a Kraken2 taxonomy (taxo.k2d)")
+        count, names_size, ranks_size = struct.unpack("<QQQ", header[len(K2D_MAGIC):])
+        data = np.memmap(filename, dtype=np.uint8, mode="r")
+        start = len(header) + count * K2D_NODE.itemsize
+        nodes = data[len(header):start].view(K2D_NODE)
+        names = data[start:start + names_size]
+        ranks = data[start + names_size:start + names_size + ranks_size]
+
+        # Node 0 is a placeholder and the root (node 1) has parent 0
+        parent = nodes["parent_id"][1:].astype(np.int64) - 1
+        depth = _depths(parent)
+        position = _preorder(parent, depth, _subtree_sizes(parent, depth))
+        order = np.argsort(position)
+
+        rank_offsets, rank_codes = np.unique(nodes["rank_offset"][1:], return_inverse=True)
+        # Python ints: uint64 offsets would become floats with `+ 1` on NumPy 1.x
+        rank_names = [_c_string(ranks, int(offset)) for offset in rank_offsets]
+        name_starts = nodes["name_offset"][1:][order].astype(np.int64)
+        # Names are null-terminated
+        nulls = np.flatnonzero(names == 0)
+        name_ends = nulls[np.searchsorted(nulls, name_starts)]
+
+        return cls(
+            nodes["external_id"][1:][order],
+            np.where(parent[order] < 0, -1, position[parent[order]]),
+            rank_codes[order],
+            rank_names,
+            _BlobNames(names, name_starts, name_ends),
+        )
+
+    def name_of(self, taxid):
+        return self.names[self.index(taxid)]
+
+    @property
+    def name_index(self):
+        """
+        TaxonNameIndex of the names, built on first use
+        """
+        if getattr(self, "_name_index", None) is None:
+            self._name_index = TaxonNameIndex(self)
+        return self._name_index
+
+    def names_to_taxids(self, names, mode="exact"):
+        """
+        Dictionary name -> list of taxids, for the names that were found.
+        Mode can be 'exact', 'nocase', 'prefix' or 'substring' (the last two ignore case)
+        """
+        return self.name_index.translate(names, mode)
+
+    def taxids_to_names(self, taxids):
+        """
+        Dictionary taxid -> name, for the taxids that were found
+        """
+        values = np.atleast_1d(np.asarray(taxids, dtype=np.int64))
+        position = np.searchsorted(self._sorted, values).clip(0, max(len(self) - 1, 0))
+        found = self._sorted[position] == values
+        return {int(taxid): self.names[node] for taxid, node in zip(values[found], self._order[position[found]])}
+
+    def index(self, taxids):
+        """
+        Node number of one taxid, or of an array of taxids
+        """
+        values = np.asarray(taxids, dtype=np.int64)
+        position = np.searchsorted(self._sorted, values).clip(0, max(len(self) - 1, 0))
+        found = self._sorted[position] == values
+        if not np.all(found):
+            raise ValueError(f"Node {values[~found].flat[0]} not found")
+        nodes = self._order[position]
+        return int(nodes) if nodes.ndim == 0 else nodes
+
+    def get_parent(self, taxid):
+        node = self.index(taxid)
+        return None if self.parent[node] < 0 else int(self.taxids[self.parent[node]])
+
+    def rank_of(self, taxid):
+        return self.rank_names[self.rank[self.index(taxid)]]
+
+    def lineage(self, taxid):
+        """
+        Taxids from the root to the node, in O(depth)
+        """
+        node = self.index(taxid)
+        lineage = []
+        while node >= 0:
+            lineage.append(int(self.taxids[node]))
+            node = self.parent[node]
+        lineage.reverse()
+        return lineage
+
+    def _lift(self, nodes, steps):
+        # Ancestors `steps` levels above nodes
+        for level, up in enumerate(self._up):
+            move = (steps >> level) & 1 == 1
+            nodes = np.where(move, up[nodes], nodes)
+        return nodes
+
+    def lca_nodes(self, a, b):
+        """
+        Lowest common ancestor of node numbers (arrays of the same shape)
+        """
+        a, b = np.asarray(a), np.asarray(b)
+        # Bring the deeper node up to the depth of the other one
+        steps = self.depth[a] - self.depth[b]
+        a = self._lift(a, np.where(steps > 0, steps, 0))
+        b = self._lift(b, np.where(steps < 0, -steps, 0))
+        for up in reversed(self._up):
+            differ = up[a] != up[b]
+            a = np.where(differ, up[a], a)
+            b = np.where(differ, up[b], b)
+        return np.where(a == b, a, self._up[0][a])
+
+    def lca(self, a, b):
+        """
+        Lowest common ancestor of two taxids (or two arrays of taxids)
+        """
+        nodes = self.taxids[self.lca_nodes(self.index(a), self.index(b))]
+        return int(nodes) if nodes.ndim == 0 else nodes
+
+    def lca_set(self, taxids):
+        """
+        Lowest common ancestor of a set of taxids
+        """
+        nodes = np.atleast_1d(self.index(list(taxids)))
+        while len(nodes) > 1:
+            # Pairwise reduction, one vectorised step per halving
+            half = len(nodes) // 2
+            merged = self.lca_nodes(nodes[:half], nodes[half:2 * half])
+            nodes = np.concatenate((merged, nodes[2 * half:]))
+        return int(self.taxids[nodes[0]])
+
+    def lowest_ancestor(self, nodes, predicate):
+        """
+        Lowest ancestor (or the node itself) of each node number where `predicate` holds, -1 if
+        none does. `predicate` tests an array of node numbers (one per node) and, once true on the
+        path to the root, must stay true above: it is called O(log depth) times (binary lifting)
+        """
+        nodes = np.asarray(nodes)
+        found = predicate(nodes)
+        top = nodes
+        # Highest ancestor where the predicate is still false
+        for up in reversed(self._up):
+            candidate = up[top]
+            top = np.where(~found & ~predicate(candidate), candidate, top)
+        parent = self.parent[top]
+        return np.where(found, nodes, np.where(parent >= 0, parent, -1))
+
+    def is_ancestor(self, a, b):
+        """
+        True if taxid a is b or one of its ancestors
+        """
+        return bool(self.in_clade(b, a))
+
+    def in_clade(self, taxids, clade):
+        """
+        True for the taxids (one or an array) in the clade rooted at `clade`
+        """
+        nodes, root = self.index(taxids), self.index(clade)
+        inside = (nodes >= root) & (nodes < self.end[root])
+        return bool(inside) if np.ndim(inside) == 0 else inside
+
+    def descendants(self, taxid):
+        """
+        Taxids of all the descendants of a node, in preorder
+        """
+        node = self.index(taxid)
+        return self.taxids[node + 1:self.end[node]]
+
+    def node_counts(self, taxids, counts):
+        """
+        Array with the counts of the taxids (summed when repeated) at their node number
+        """
+        return np.bincount(np.atleast_1d(self.index(taxids)), weights=counts, minlength=len(self)).astype(np.asarray(counts).dtype)
+
+    def clade_counts(self, taxids, counts):
+        """
+        Array with the total count of the clade rooted at each node (by node number)
+        """
+        cumulative = np.concatenate(([0], np.cumsum(self.node_counts(taxids, counts))))
+        return cumulative[self.end] - cumulative[:-1]
+
+    def clade_count(self, taxid, taxids, counts):
+        """
+        Total count of the taxids in the clade rooted at `taxid`
+        """
+        inside = np.atleast_1d(self.in_clade(taxids, taxid))
+        return np.asarray(counts)[inside].sum()
+
+
+class TaxonNameIndex:
+    """
+    Search the taxa of a TaxonomyIndex by name: exact and case-insensitive matches use
+    dictionaries, prefixes a binary search in the sorted lowercase names and substrings
+    a scan of all the names joined in a single string.
+    Results are taxids, in preorder.
+    """
+    MODES = ("exact", "nocase", "prefix", "substring")
+
+    def __init__(self, index) -> None:
+        self.taxids = index.taxids
+        names = [name or "" for name in index.names]
+        lower = [name.lower() for name in names]
+        self._exact = {}
+        self._nocase = {}
+        for node, (name, name_lower) in enumerate(zip(names, lower)):
+            self._exact.setdefault(name, []).append(node)
+            self._nocase.setdefault(name_lower, []).append(node)
+
+        self._order = np.array(sorted(range(len(lower)), key=lower.__getitem__), dtype=np.int64)
+        self._sorted = np.array([lower[node] for node in self._order], dtype=object)
+        self._text = "\n".join(lower) + "\n"
+        self._starts = np.concatenate(([0], np.cumsum([len(name) + 1 for name in lower]))).astype(np.int64)
+
+    def search(self, query, mode="exact"):
+        """
+        Taxids matching one query
+        """
+        if mode == "exact":
+            nodes = self._exact.get(query, [])
+        elif mode == "nocase":
+            nodes = self._nocase.get(query.lower(), [])
+        elif mode == "prefix":
+            query = query.lower()
+            first = np.searchsorted(self._sorted, query, side="left")
+            last = np.searchsorted(self._sorted, query + "\U0010ffff", side="left")
+            nodes = sorted(self._order[first:last])
+        elif mode == "substring":
+            nodes = self._scan(query.lower())
+        else:
+            raise ValueError(f"Invalid search mode {mode}: expected one of {self.MODES}")
+        return [int(self.taxids[node]) for node in nodes]
+
+    def translate(self, names, mode="exact"):
+        """
+        Dictionary name -> list of taxids, for the names that were found
+        """
+        result = {}
+        for name in names:
+            taxids = self.search(name, mode)
+            if taxids:
+                result[name] = taxids
+        return result
+
+    def _scan(self, query):
+        if not query or "\n" in query:
+            return []
+        positions = []
+        position = self._text.find(query)
+        while position >= 0:
+            positions.append(position)
+            position = self._text.find(query, position + 1)
+        # Name containing each match, reported once
+        return sorted(set(np.searchsorted(self._starts, positions, side="right") - 1))
+
+
+class _BlobNames:
+    # Names of a loaded index, decoded from the names blob when accessed
+    def __init__(self, blob, starts, ends) -> None:
+        self.blob = blob
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, node):
+        if node >= len(self):
+            raise IndexError(node)
+        name = self.blob[self.starts[node]:self.ends[node]].tobytes().decode()
+        return name if name else None
+
+
+class _IndexedTaxonNode(TaxonNode):
+    # TaxonNode reading its attributes from a TaxonomyIndex
+    def __init__(self, index, node) -> None:
+        self._tree_index = index
+        self._node = node
+        self.node_id = int(index.taxids[node])
+        self.rank = index.rank_names[index.rank[node]]
+        self.name = index.names[node]
+
+    @property
+    def children(self):
+        children = []
+        # Children of a node follow it in preorder, each one followed by its own clade
+        child = self._node + 1
+        while child < self._tree_index.end[self._node]:
+            children.append(_IndexedTaxonNode(self._tree_index, child))
+            child = self._tree_index.end[child]
+        return children
+
+
+class _IndexedNodes(Mapping):
+    # Taxid -> TaxonNode, without storing the nodes
+    def __init__(self, index) -> None:
+        self._tree_index = index
+
+    def __getitem__(self, taxid):
+        try:
+            return _IndexedTaxonNode(self._tree_index, self._tree_index.index(taxid))
+        except ValueError:
+            raise KeyError(taxid)
+
+    def __iter__(self):
+        return (int(taxid) for taxid in self._tree_index.taxids)
+
+    def __len__(self):
+        return len(self._tree_index)
+
+
+class _IndexedParents(_IndexedNodes):
+    # Taxid -> parent taxid (None for the root)
+    def __getitem__(self, taxid):
+        try:
+            return self._tree_index.get_parent(taxid)
+        except ValueError:
+            raise KeyError(taxid)
+
+
+def _depths(parent):
+    """
+    Depth of each node, by pointer jumping: O(N log depth) with NumPy
+    """
+    ancestor = parent.astype(np.int64)
+    distance = (ancestor >= 0).astype(np.int32)
+    while True:
+        jump = np.flatnonzero(ancestor >= 0)
+        up = ancestor[jump]
+        # Nodes whose ancestor still has an ancestor jump twice as far
+        further = ancestor[up] >= 0
+        if not further.any():
+            return distance
+        jump, up = jump[further], up[further]
+        distance[jump] += distance[up]
+        ancestor[jump] = ancestor[up]
+
+def _subtree_sizes(parent, depth):
+    """
+    Number of nodes in the clade of each node, summing children into parents one level at a time
+    """
+    size = np.ones(len(parent), dtype=np.int64)
+    order = np.argsort(depth, kind="stable")
+    levels = np.searchsorted(depth[order], np.arange(depth.max(initial=0) + 2))
+    for level in range(len(levels) - 2, 0, -1):
+        nodes = order[levels[level]:levels[level + 1]]
+        size += np.bincount(parent[nodes], weights=size[nodes], minlength=len(parent)).astype(np.int64)
+    return size
+
+def _preorder(parent, depth, size):
+    """
+    Preorder position of each node, siblings in node order, computed one level at a time:
+    a child comes after its parent and the clades of its previous siblings
+    """
+    position = np.zeros(len(parent), dtype=np.int64)
+    order = np.lexsort((np.arange(len(parent)), parent, depth))
+    levels = np.searchsorted(depth[order], np.arange(depth.max(initial=0) + 2))
+    for level in range(1, len(levels) - 1):
+        nodes = order[levels[level]:levels[level + 1]]
+        # Clade sizes of the previous siblings (nodes are grouped by parent)
+        before = np.cumsum(size[nodes]) - size[nodes]
+        first = np.concatenate(([True], parent[nodes][1:] != parent[nodes][:-1]))
+        before -= np.maximum.accumulate(np.where(first, before, 0))
+        position[nodes] = position[parent[nodes]] + 1 + before
+    return position
+
+def _c_string(blob, offset):
+    offset = int(offset)
+    end = offset
+    while blob[end] != 0:
+        end += 1
+    return blob[offset:end].tobytes().decode()
+
+def _aligned(size, alignment=64):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def load_taxonomy(filename):
+    """
+    KrakenTree from a file saved by TaxonomyIndex.save(), a Kraken2 database
+    (directory or taxo.k2d file) or kraken2-inspect output
+    """
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, "taxo.k2d")
+    with open(filename, "rb") as f:
+        magic = f.read(len(TAXONOMY_MAGIC))
+    if magic == TAXONOMY_MAGIC:
+        return KrakenTree.from_index(TaxonomyIndex.load(filename))
+    if magic == K2D_MAGIC:
+        return KrakenTree.from_index(TaxonomyIndex.from_k2d(filename))
+    return parse_kraken_db(filename)
+
+
+def parse_kraken_db(kraken_db_file):
+    tree = None
+    last_level = {}
+    with open(kraken_db_file, 'r') as file:
+        for line in file:
+            line = line.strip()
+            columns = line.split('\t')
+            if len(columns) >= 5:
+                #percentage = columns[0]
+                taxid_str = columns[4]
+                rank = columns[3]
+                name = columns[5]
+                level = int((len(name) - len(name.lstrip())) / 2)
+                name = name.strip()
+                if tree is None:
+                    print("Initializing tree, root:" + taxid_str, file=sys.stderr)
+                    tree = KrakenTree(int(taxid_str))
+                    tree.root.rank = rank
+                    tree.root.name = name
+
+                else:
+                    #print("Appending child " + taxid_str + " to " + str(last_level[level - 1]), file=sys.stderr)
+                    tree.append_child(last_level[level - 1], int(taxid_str), rank, name)
+
+                last_level[level] = int(taxid_str)
+
+    return tree
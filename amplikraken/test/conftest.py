@@ -0,0 +1,74 @@
+# Fixtures (and their helpers) shared by the test modules
+import sys
+import pytest
+
+# A stand-in for kraken2: reads starting with "A" are E. coli (confidence 0.25 if starting
+# with "AG", 1 otherwise), the others unclassified.
+# Each call is logged in the database directory
+FAKE_KRAKEN2 = r'''#!PYTHON
+import os, sys
+args = sys.argv[1:]
+if "--version" in args:
+    print("Kraken version 2.1.3")
+    print("Copyright 2013-2023, Derrick Wood")
+    sys.exit(0)
+db = args[args.index("--db") + 1]
+with open(os.path.join(db, "calls.log"), "a") as log:
+    log.write(" ".join(args) + "\n")
+files = args[-2:] if "--paired" in args else args[-1:]
+names = "--use-names" in args
+mates = [open(f).read().splitlines() for f in files]
+for i in range(0, len(mates[0]), 4):
+    read = mates[0][i][1:].split()[0]
+    seqs = [m[i + 1] for m in mates]
+    lengths = "|".join(str(len(s)) for s in seqs)
+    if seqs[0].startswith("A"):
+        taxon = "Escherichia coli (taxid 562)" if names else "562"
+        kmers = "562:1 0:4 0:2 0:3" if seqs[0].startswith("AG") else "562:3 |:| 562:2"
+        print(f"C\t{read}\t{taxon}\t{lengths}\t{kmers}")
+    else:
+        taxon = "unclassified (taxid 0)" if names else "0"
+        print(f"U\t{read}\t{taxon}\t{lengths}\t0:5")
+'''
+
+@pytest.fixture
+def kraken2(tmp_path):
+    """
+    Path to a fake kraken2 binary, and its database directory
+    """
+    binary = tmp_path / "kraken2"
+    binary.write_text(FAKE_KRAKEN2.replace("PYTHON", sys.executable))
+    binary.chmod(0o755)
+    db = tmp_path / "db"
+    db.mkdir()
+    (db / "hash.k2d").write_bytes(b"\0" * 1000)
+    return str(binary), str(db)
+
+def write_fastq(filename, sequences, prefix="read"):
+    with open(filename, "w") as f:
+        for i, seq in enumerate(sequences):
+            f.write(f"@{prefix}{i} 1\n{seq}\n+\n{'I' * len(seq)}\n")
+
+@pytest.fixture
+def reads_dir(tmp_path):
+    path = tmp_path / "reads"
+    path.mkdir()
+    for sample, n in [("S1", 2), ("S2", 5), ("S3", 3)]:
+        write_fastq(path / f"{sample}_R1.fastq", ["ACGT", "TTGA"] * n)
+        write_fastq(path / f"{sample}_R2.fastq", ["CCGT", "AAGA"] * n)
+    return str(path)
+
+KRAKEN_LINES = [
+    'C\tM00967:43:000000000-A3JHG:1:1101:17025:1426\t2911\t251|251\t3:83 52:11 3:1 52:5 3:5 52:11 3:10 459:5 874:2 459:3 52:5 3:17 1:14 3:3 1:1 3:19 0:1 2882:4 3:17 |:| 3:43 1:1 3:3 1:36 3:15 0:10 2911:5 0:11 3:3 0:3 52:6 3:81',
+    'C\tM00967:43:000000000-A3JHG:1:1101:17549:1611\t1102\t251|250\t3:179 1102:5 3:1 1102:5 535:4 3:1 535:5 307:3 3:5 307:1 3:8 |:| 3:9 307:1 3:5 307:3 535:5 3:1 535:4 1102:5 3:1 1102:5 3:122 1102:11 535:8 3:1 535:1 3:8 535:2 3:24',
+    'C\tM00967:43:000000000-A3JHG:1:1101:15982:1786\t1102\t251|250\t3:26 535:2 21:3 3:5 535:1 21:1 535:11 3:1 535:9 3:1 535:21 307:5 535:13 307:1 535:10 3:5 307:2 3:73 535:4 3:1 535:5 1102:8 0:4 1383:1 0:4 |:| 3:9 535:1 3:8 535:5 3:1 535:4 3:73 307:2 3:5 535:10 307:1 535:11 0:76 1099:2 0:8',
+    'U\tM00967:43:000000000-A3JHG:1:1101:11111:2222\t0\t251|250\t0:217 |:| 0:216',
+    'C\tM00967:43:000000000-A3JHG:1:1101:17592:2407\t1102\t251|250\t3:27 307:1 3:8 21:1 3:1 307:8 535:1 1102:8 3:13 535:6 307:5 1102:32 3:106 |:| 3:107 1102:22 0:5 1102:5 541:5 0:62 1102:2 0:8',
+    'C\tM00967:43:000000000-A3JHG:1:1101:12345:6789\t3\t251|250\t0:100 3:5 0:90 |:| 0:100 3:5 0:90',
+]
+
+@pytest.fixture
+def kraken_tsv(tmp_path):
+    path = tmp_path / "sample.tsv"
+    path.write_text("\n".join(KRAKEN_LINES) + "\n")
+    return str(path)
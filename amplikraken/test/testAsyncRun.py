@@ -0,0 +1,123 @@
+import os
+import sys
+import asyncio
+import threading
+import pytest
+from amplikraken.asyncrun import AsyncKrakenRunner
+from amplikraken.run import KrakenRunner
+from amplikraken.fastq import pairedend_samples_from_path
+from amplikraken.consumers import TaxidCounter
+from amplikraken.cache import KrakenResultCache
+
+# A kraken2 writing a lot to stderr, then hanging (or failing with "fail" in the arguments)
+NOISY_KRAKEN2 = r'''#!PYTHON
+import sys, time
+if "--version" in sys.argv:
+    print("Kraken version 2.1.3")
+    sys.exit(0)
+sys.stderr.write("x" * 1000000)
+print("C\tr1\t562\t4\t562:3")
+sys.stdout.flush()
+if "fail" in sys.argv:
+    sys.exit(1)
+if "hang" in sys.argv:
+    time.sleep(60)
+'''
+
+@pytest.fixture
+def noisy(tmp_path):
+    binary = tmp_path / "noisy"
+    binary.write_text(NOISY_KRAKEN2.replace("PYTHON", sys.executable))
+    binary.chmod(0o755)
+    return str(binary)
+
+class AsyncCounter:
+    def __init__(self) -> None:
+        self.lines = 0
+        self.aborted = False
+
+    async def feed(self, lines):
+        await asyncio.sleep(0)
+        self.lines += len(lines)
+
+    async def close(self):
+        return self.lines
+
+    async def abort(self):
+        self.aborted = True
+
+def test_async_datasets(kraken2, reads_dir, tmp_path):
+    binary, db = kraken2
+    datasets = pairedend_samples_from_path(reads_dir)
+    runner = AsyncKrakenRunner(db, binary=binary, limit=2)
+    outputs = asyncio.run(runner.run_datasets(datasets, str(tmp_path / "async")))
+    assert sorted(outputs) == ["S1", "S2", "S3"]
+    for dataset in datasets.datasets.values():
+        name = dataset.name
+        KrakenRunner(db, binary=binary, output=str(tmp_path / f"{name}.tsv")).run(dataset.forward, dataset.reverse)
+        with open(outputs[name]) as f1, open(tmp_path / f"{name}.tsv") as f2:
+            assert f1.read() == f2.read()
+
+def test_async_consumers(kraken2, reads_dir):
+    binary, db = kraken2
+    runner = AsyncKrakenRunner(db, binary=binary, keepunclassified=True)
+    counter = AsyncCounter()
+    results = asyncio.run(runner.run(os.path.join(reads_dir, "S2_R1.fastq"), consumers=[counter, TaxidCounter("S2")]))
+    assert results[0] == 10
+    assert results[1].loc[562, "S2"] == 5
+
+def test_async_sync_consumers(kraken2, reads_dir):
+    binary, db = kraken2
+    runner = AsyncKrakenRunner(db, binary=binary, limit=1)
+
+    class ThreadCounter(TaxidCounter):
+        def feed(self, lines):
+            self.thread = threading.get_ident()
+            super().feed(lines)
+
+    async def run():
+        counters = [ThreadCounter(name) for name in ("S1", "S2")]
+        await asyncio.gather(*(runner.run(os.path.join(reads_dir, f"{counter.name}_R1.fastq"), consumers=[counter]) for counter in counters))
+        return counters
+    # Sync consumers are fed off the event loop thread, and the runner can be used from another loop
+    for _ in range(2):
+        counters = asyncio.run(run())
+        assert all(counter.thread != threading.get_ident() for counter in counters)
+        assert counters[1].counts == {562: 5}
+
+def test_async_unsupported(kraken2, tmp_path):
+    binary, db = kraken2
+    runner = AsyncKrakenRunner(db, binary=binary)
+    with pytest.raises(ValueError, match="only classifies files"):
+        asyncio.run(runner.run([("read1", "ACGT", "IIII")]))
+    runner.cache = KrakenResultCache(str(tmp_path / "cache"))
+    with pytest.raises(ValueError, match="result cache"):
+        asyncio.run(runner.run("reads.fastq"))
+    with pytest.raises(TypeError):
+        AsyncKrakenRunner(db, binary=binary, trimmer=None)
+
+def test_async_errors(noisy, tmp_path):
+    runner = AsyncKrakenRunner("db", binary=noisy)
+    counter = AsyncCounter()
+    with pytest.raises(TimeoutError):
+        asyncio.run(runner.run("hang", output=str(tmp_path / "out.tsv"), consumers=[counter], timeout=1))
+    assert counter.aborted and not os.path.exists(tmp_path / "out.tsv.tmp")
+    with pytest.raises(RuntimeError, match="xxx"):
+        asyncio.run(runner.run("fail", consumers=[AsyncCounter()]))
+
+    async def cancel():
+        counter = AsyncCounter()
+        task = asyncio.ensure_future(runner.run("hang", consumers=[counter]))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return counter
+    assert asyncio.run(cancel()).aborted
+
+def test_sync_noisy_stderr(noisy, tmp_path):
+    # kraken2 filling the stderr pipe does not block the runner
+    runner = KrakenRunner("db", binary=noisy, output=str(tmp_path / "out.tsv"))
+    runner.run("reads.fastq")
+    with open(tmp_path / "out.tsv") as f:
+        assert f.read() == "C\tr1\t562\t4\t562:3\n"
@@ -0,0 +1,70 @@
+import pytest
+import amplikraken.cache
+import amplikraken.kraken
+from amplikraken.cache import KrakenCache
+from amplikraken.test.conftest import KRAKEN_LINES
+from amplikraken.test.testKrakenFunctions import sample_tree
+
+
+@pytest.mark.parametrize("chunksize", [None, 4])
+def test_cached_load_matches_text(kraken_tsv, tmp_path, chunksize):
+    cache = KrakenCache(tmp_path / "cache")
+    expected = amplikraken.kraken.KrakenOutput(name='sample', minconfidence=0.5, chunksize=chunksize).load(kraken_tsv)
+    for _ in range(2):
+        # First load fills the cache, the second one reads from it
+        cached = amplikraken.kraken.KrakenOutput(name='sample', minconfidence=0.5, chunksize=chunksize, cache=cache).load(kraken_tsv)
+        assert cached.table.equals(expected.table)
+    assert cache.get(kraken_tsv) is not None
+    assert len(cache.get(kraken_tsv)) == len(KRAKEN_LINES)
+
+
+def test_cached_kmers_for_taxonomy(kraken_tsv, tmp_path):
+    cache = KrakenCache(tmp_path / "cache")
+    amplikraken.kraken.KrakenOutput(name='sample', cache=cache).load(kraken_tsv)
+    assert not cache.get(kraken_tsv).kmers
+    # Re-scoring needs the LCA strings: the entry is rebuilt with them
+    expected = amplikraken.kraken.KrakenOutput(name='sample', taxonomy=sample_tree()).sweep(kraken_tsv, [0.0, 0.5])
+    for _ in range(2):
+        cached = amplikraken.kraken.KrakenOutput(name='sample', taxonomy=sample_tree(), cache=cache).sweep(kraken_tsv, [0.0, 0.5])
+        assert cached.table.equals(expected.table)
+    assert cache.get(kraken_tsv).kmers
+
+
+def test_content_hash(kraken_tsv, tmp_path, monkeypatch):
+    expected = amplikraken.cache.file_hash(kraken_tsv)
+    assert KrakenCache(tmp_path / "cache").content_hash(kraken_tsv) == expected
+    amplikraken.kraken.KrakenOutput(name='sample', cache=KrakenCache(tmp_path / "cache")).load(kraken_tsv)
+    # Known from the key of the cached file, without reading it
+    def file_hash(filename):
+        raise AssertionError(f"{filename} hashed again")
+    monkeypatch.setattr(amplikraken.cache, "file_hash", file_hash)
+    assert KrakenCache(tmp_path / "cache").content_hash(kraken_tsv) == expected
+
+
+def test_cache_eviction(kraken_tsv, tmp_path):
+    cache = KrakenCache(tmp_path / "cache", maxsize=0)
+    amplikraken.kraken.KrakenOutput(name='sample', cache=cache).load(kraken_tsv)
+    assert cache.get(kraken_tsv) is None
+
+
+def test_cache_eviction_concurrent_writers(kraken_tsv, tmp_path):
+    cache = KrakenCache(tmp_path / "cache", maxsize=0)
+    # An entry being written by another process (meta.json is written before the rename)
+    writing = tmp_path / "cache" / ".tmp-other"
+    writing.mkdir()
+    (writing / "meta.json").write_text("{}")
+    (tmp_path / "cache" / "keys" / ".tmp-key").write_text("")
+    amplikraken.kraken.KrakenOutput(name='sample', cache=cache).load(kraken_tsv)
+    assert (writing / "meta.json").exists() and (tmp_path / "cache" / "keys" / ".tmp-key").exists()
+    assert not [key for key in (tmp_path / "cache" / "keys").iterdir() if not key.name.startswith(".tmp-")]
+
+
+def test_cache_threads(kraken_tsv, tmp_path):
+    # Writers evicting each other's entries and keys at the same time
+    import concurrent.futures
+    cache = KrakenCache(tmp_path / "cache", maxsize=1)
+    def load(i):
+        for _ in range(20):
+            amplikraken.kraken.KrakenOutput(name='sample', cache=KrakenCache(cache.directory, maxsize=1)).load(kraken_tsv)
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(load, range(8)))
@@ -0,0 +1,121 @@
+import os
+import fcntl
+import subprocess
+import pytest
+from amplikraken.database import DatabaseManager, resolve_database, check_database, databases
+from amplikraken.fastq import pairedend_samples_from_path
+from amplikraken.batch import KrakenBatch
+
+def write_db(path, content=b"k"):
+    os.makedirs(path, exist_ok=True)
+    for name, size in [("hash.k2d", 1000), ("opts.k2d", 10), ("taxo.k2d", 100)]:
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(content * size)
+    return str(path)
+
+def test_resolve_database(tmp_path):
+    db = write_db(tmp_path / "16S_SILVA138_k2db")
+    assert resolve_database(db) == db
+    assert resolve_database("kraken-silva-138", refs=str(tmp_path)) == db
+    assert "greengenes" in databases()
+    with pytest.raises(ValueError, match="akget"):
+        resolve_database("greengenes", refs=str(tmp_path))
+    with pytest.raises(ValueError):
+        resolve_database("unknown")
+    os.remove(os.path.join(db, "taxo.k2d"))
+    with pytest.raises(ValueError, match="taxo.k2d"):
+        check_database(db)
+
+def test_stage(tmp_path):
+    db = write_db(tmp_path / "db")
+    manager = DatabaseManager(str(tmp_path / "staged"))
+    first = manager.acquire(db)
+    with manager.acquire(db) as second:
+        assert second.path == first.path and second.path.startswith(str(tmp_path / "staged"))
+        with open(os.path.join(second.path, "hash.k2d"), "rb") as f:
+            assert f.read() == b"k" * 1000
+        assert manager.staged()[second.path]["users"] == 2
+        assert manager.verify(second)
+    assert manager.staged()[first.path] == {"source": db, "size": 1110, "users": 1}
+    first.release()
+    first.release()
+    assert manager.staged()[first.path]["users"] == 0
+
+    # A corrupted copy is detected, a truncated one is staged again
+    with open(os.path.join(first.path, "opts.k2d"), "wb") as f:
+        f.write(b"x" * 10)
+    with pytest.raises(RuntimeError, match="opts.k2d"):
+        manager.verify(first)
+    with open(os.path.join(first.path, "opts.k2d"), "wb") as f:
+        f.write(b"x")
+    with manager.acquire(db) as staged:
+        assert manager.verify(staged)
+
+    # A changed source is staged again
+    write_db(db, content=b"z")
+    with manager.acquire(db) as staged:
+        assert staged.path != first.path
+        assert len(manager.staged()) == 2
+
+def test_evict(tmp_path):
+    dbs = [write_db(tmp_path / name) for name in ("db1", "db2", "db3")]
+    manager = DatabaseManager(str(tmp_path / "staged"), budget=2500)
+    first = manager.acquire(dbs[0])
+    manager.acquire(dbs[1]).release()
+    # db1 is in use: db2 is evicted for db3
+    with manager.acquire(dbs[2]) as third:
+        assert sorted(info["source"] for info in manager.staged().values()) == [dbs[0], dbs[2]]
+    first.release()
+    assert len(manager.staged()) == 2
+
+    # Users left by processes that died do not count
+    process = subprocess.Popen(["true"])
+    process.wait()
+    open(os.path.join(third.path, "users", f"{process.pid}.0"), "w").close()
+    assert manager.staged()[third.path]["users"] == 0
+
+def test_stage_without_lock(tmp_path):
+    db = write_db(tmp_path / "db")
+
+    class Manager(DatabaseManager):
+        def _stage(self, source, fingerprint):
+            # Other processes and threads can take the lock while the database is copied
+            assert not self._lock.locked()
+            with open(os.path.join(self.directory, ".lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(f, fcntl.LOCK_UN)
+            self.copy = super()._stage(source, fingerprint)
+            # A copy in progress is not a staged database
+            assert self.staged() == {}
+            return self.copy
+
+    manager = Manager(str(tmp_path / "staged"), budget=10000)
+    with manager.acquire(db) as staged:
+        assert manager.verify(staged)
+    assert not os.path.exists(manager.copy)
+
+    # Only the users of processes alive are counted, their files are removed with the lock held
+    process = subprocess.Popen(["true"])
+    process.wait()
+    dead = os.path.join(staged.path, "users", f"{process.pid}.0")
+    open(dead, "w").close()
+    assert manager.staged()[staged.path]["users"] == 0 and os.path.exists(dead)
+    manager.acquire(db).release()
+    assert not os.path.exists(dead)
+
+def test_batch_staging(kraken2, reads_dir, tmp_path):
+    binary, db = kraken2
+    write_db(db)
+    datasets = pairedend_samples_from_path(reads_dir)
+    manager = DatabaseManager(str(tmp_path / "staged"))
+    plain = KrakenBatch(db, str(tmp_path / "plain"), binary=binary, threads=2).run(datasets)
+    staged = KrakenBatch(db, str(tmp_path / "staged_out"), binary=binary, threads=2, staging=manager).run(datasets)
+    for sample in plain:
+        with open(plain[sample]) as f1, open(staged[sample]) as f2:
+            assert f1.read() == f2.read()
+    (path,) = manager.staged()
+    assert manager.staged()[path]["users"] == 0
+    # The fake kraken2 logs its calls in the database it was given
+    with open(os.path.join(path, "calls.log")) as f:
+        calls = f.read().splitlines()
+    assert len(calls) == 3 and all("--memory-mapping" in call for call in calls)
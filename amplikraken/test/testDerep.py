@@ -0,0 +1,73 @@
+import os
+import pytest
+from amplikraken.derep import Dereplicator, expand_output, read_id
+from amplikraken.fastq import read_fastq, pairedend_samples_from_path
+from amplikraken.batch import KrakenBatch
+from amplikraken.test.conftest import write_fastq
+from amplikraken.test.testTaxonomy import write_k2d
+from amplikraken.test.testReport import report_tree
+
+R1 = ["ACGT", "ACGT", "TTGA", "ACGT", "TTGA", "ACGT", "GGCC"]
+R2 = ["CCGT", "CCGT", "AAGA", "CCGA", "AAGA", "CCGT", "TTAA"]
+
+def uniques(r1, r2):
+    records = zip(read_fastq(r1), read_fastq(r2))
+    return sorted((a[1], b[1], int(a[0].split(";size=")[1])) for a, b in records)
+
+@pytest.mark.parametrize("max_uniques", [1000, 1])
+def test_dereplicate(tmp_path, max_uniques):
+    write_fastq(tmp_path / "R1.fastq", R1)
+    write_fastq(tmp_path / "R2.fastq", R2)
+    derep = Dereplicator(str(tmp_path / "derep"), max_uniques=max_uniques, partitions=3)
+    r1, r2 = derep.run(str(tmp_path / "R1.fastq"), str(tmp_path / "R2.fastq"))
+    assert derep.spilled == (max_uniques == 1)
+    assert (derep.reads, derep.uniques) == (7, 4)
+    assert uniques(r1, r2) == [("ACGT", "CCGA", 1), ("ACGT", "CCGT", 3), ("GGCC", "TTAA", 1), ("TTGA", "AAGA", 2)]
+    assert sorted(os.listdir(tmp_path / "derep")) == ["reads.tsv", "uniques_R1.fastq", "uniques_R2.fastq"]
+
+def test_expand_output(tmp_path):
+    write_fastq(tmp_path / "R1.fastq", R1[:3])
+    derep = Dereplicator(str(tmp_path / "derep"))
+    r1, _ = derep.run(str(tmp_path / "R1.fastq"))
+    lines = [f"C\t{header}\t562\t4\t562:1\n" for header, sequence, _ in read_fastq(r1) if sequence == "ACGT"]
+    assert expand_output(lines, derep.mapping, str(tmp_path / "out.tsv")) == 2
+    with open(tmp_path / "out.tsv") as f:
+        assert f.read() == "C\tread0\t562\t4\t562:1\nC\tread1\t562\t4\t562:1\n"
+
+def test_expand_output_spilled(tmp_path):
+    sequences = [f"ACGT{'A' * (i % 50)}" for i in range(500)]
+    write_fastq(tmp_path / "R1.fastq", sequences)
+    derep = Dereplicator(str(tmp_path / "derep"))
+    r1, _ = derep.run(str(tmp_path / "R1.fastq"))
+    lines = [f"C\t{header}\t{len(sequence)}\t{len(sequence)}\t562:1\n" for header, sequence, _ in read_fastq(r1) if len(sequence) % 3]
+    expected = expand_output(lines, derep.mapping, str(tmp_path / "memory.tsv"))
+    assert expand_output(lines, derep.mapping, str(tmp_path / "spilled.tsv"), max_uniques=7, partitions=5) == expected
+    with open(tmp_path / "memory.tsv") as f1, open(tmp_path / "spilled.tsv") as f2:
+        assert f1.read() == f2.read()
+    assert sorted(os.listdir(tmp_path / "derep")) == ["reads.tsv", "uniques_R1.fastq"]
+
+def test_batch_dereplicate_failed(kraken2, reads_dir, tmp_path):
+    binary, db = kraken2
+    datasets = pairedend_samples_from_path(reads_dir)
+    with pytest.raises(RuntimeError):
+        KrakenBatch(db, str(tmp_path / "out"), binary=binary + "-missing", dereplicate=True).run(datasets)
+    assert not [name for name in os.listdir(tmp_path / "out") if name.startswith(".derep-")]
+
+def test_read_id():
+    assert read_id("M00967:43:1101:17025:1426/1 1:N:0:1", paired=True) == "M00967:43:1101:17025:1426"
+    assert read_id("read/1", paired=False) == "read/1"
+    assert read_id("read\tcomment") == "read"
+
+@pytest.mark.parametrize("report", [False, True])
+def test_batch_dereplicate(kraken2, reads_dir, tmp_path, report):
+    binary, db = kraken2
+    write_k2d(report_tree(), os.path.join(db, "taxo.k2d"))
+    datasets = pairedend_samples_from_path(reads_dir)
+    full = KrakenBatch(db, str(tmp_path / "full"), binary=binary, threads=2, report=report, keepunclassified=True).run(datasets)
+    KrakenBatch(db, str(tmp_path / "derep"), binary=binary, threads=2, report=report, keepunclassified=True, dereplicate=True).run(datasets)
+    for sample in full:
+        suffixes = [".tsv", ".report"] if report else [".tsv"]
+        for suffix in suffixes:
+            with open(tmp_path / "full" / f"{sample}{suffix}") as f1, open(tmp_path / "derep" / f"{sample}{suffix}") as f2:
+                assert f1.read() == f2.read()
+    assert sorted(os.listdir(tmp_path / "derep")) == sorted(os.listdir(tmp_path / "full"))
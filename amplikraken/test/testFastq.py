@@ -0,0 +1,58 @@
+import gzip
+import pytest
+from amplikraken.fastq import FastqReader, FastqDataset, read_fastq
+
+def fastq_text(sequences, prefix="read", mate=None):
+    suffix = f"/{mate}" if mate else ""
+    return "".join(f"@{prefix}{i}{suffix} comment\n{seq}\n+\n{'I' * len(seq)}\n" for i, seq in enumerate(sequences))
+
+SEQUENCES = ["ACGT" * (i % 7 + 1) for i in range(1000)]
+
+@pytest.mark.parametrize("compressed", [False, True])
+@pytest.mark.parametrize("buffer_size", [7, 100, 1000000])
+def test_reader_single(tmp_path, compressed, buffer_size):
+    filename = tmp_path / ("R1.fastq.gz" if compressed else "R1.fastq")
+    text = fastq_text(SEQUENCES)
+    if compressed:
+        with gzip.open(filename, "wt") as f:
+            f.write(text)
+    else:
+        filename.write_text(text)
+    reader = FastqReader(str(filename), batch_size=300, buffer_size=buffer_size)
+    batches = list(reader.batches())
+    assert [len(batch) for batch in batches if len(batch) != 300] == [100] or max(len(batch) for batch in batches) <= 300
+    records = [record for batch in batches for record in batch]
+    assert [record[1] for record in records] == SEQUENCES
+    assert records[0] == ("read0 comment", "ACGT", "IIII")
+    assert (reader.stats[0].reads, reader.stats[0].min, reader.stats[0].max) == (1000, 4, 28)
+    assert reader.stats[0].bases == sum(len(s) for s in SEQUENCES)
+    assert reader.stats[0].median() == 16
+
+def test_reader_paired(tmp_path):
+    (tmp_path / "R1.fastq").write_text(fastq_text(SEQUENCES, mate=1))
+    (tmp_path / "R2.fastq").write_text(fastq_text(SEQUENCES[::-1], mate=2))
+    dataset = FastqDataset("S1", str(tmp_path / "R1.fastq"), str(tmp_path / "R2.fastq"))
+    pairs = list(dataset.reader(buffer_size=50))
+    assert len(pairs) == 1000
+    assert pairs[1][0][1] == SEQUENCES[1] and pairs[1][1][1] == SEQUENCES[-2]
+    assert [stats.reads for stats in dataset.stats()] == [1000, 1000]
+
+def test_reader_out_of_sync(tmp_path):
+    (tmp_path / "R1.fastq").write_text(fastq_text(SEQUENCES[:10]))
+    (tmp_path / "R2.fastq").write_text(fastq_text(SEQUENCES[:10], prefix="other"))
+    (tmp_path / "short.fastq").write_text(fastq_text(SEQUENCES[:9]))
+    with pytest.raises(ValueError, match="at pair 1"):
+        list(FastqReader(str(tmp_path / "R1.fastq"), str(tmp_path / "R2.fastq")))
+    with pytest.raises(ValueError, match="fewer reads"):
+        list(FastqReader(str(tmp_path / "R1.fastq"), str(tmp_path / "short.fastq")))
+    assert len(list(FastqReader(str(tmp_path / "R1.fastq"), str(tmp_path / "R2.fastq"), check_names=False))) == 10
+
+def test_reader_invalid(tmp_path):
+    (tmp_path / "truncated.fastq").write_text("".join(fastq_text(SEQUENCES[:3]).splitlines(True)[:-2]))
+    with pytest.raises(ValueError, match="Truncated"):
+        list(read_fastq(str(tmp_path / "truncated.fastq")))
+    (tmp_path / "bad.fastq").write_text("@r1\nACGT\n+\nIII\n")
+    with pytest.raises(ValueError, match="bad record"):
+        list(read_fastq(str(tmp_path / "bad.fastq")))
+    (tmp_path / "nonewline.fastq").write_text(fastq_text(SEQUENCES[:3]).rstrip("\n"))
+    assert len(list(read_fastq(str(tmp_path / "nonewline.fastq")))) == 3
@@ -1,5 +1,7 @@
+import math
 import pytest
 import amplikraken.kraken
+from amplikraken.test.conftest import KRAKEN_LINES
 
 def test_confidence():
     z = '3:83 52:11 0:11 3:81 |:| 3:3 0:3 52:6 3:81'
@@ -52,3 +54,92 @@ def test_fastqdataset_repr_and_eq():
     ds2 = FastqDataset('s1', 'r1.fq', 'r2.fq')
     assert isinstance(repr(ds1), str)
     assert ds1 == ds2
+
+@pytest.mark.parametrize("minconfidence", [0.0, 0.5, 0.8])
+def test_kraken_output_chunked_collapse(kraken_tsv, minconfidence):
+    # Streaming in small chunks gives the same counts as loading the whole file
+    full = amplikraken.kraken.KrakenOutput(name='sample', minconfidence=minconfidence)
+    full.load(kraken_tsv).collapse()
+    chunked = amplikraken.kraken.KrakenOutput(name='sample', minconfidence=minconfidence, chunksize=2)
+    chunked.load(kraken_tsv).collapse()
+    assert chunked.table.equals(full.table)
+
+def test_lca_confidence_matches_str_to_confidence():
+    kmers = [line.split('\t')[4] for line in KRAKEN_LINES] + ['3:5', '0:5', '  3:1\t0:2 ', 'A:31 0:1 562:3']
+    confidence, total, defined = amplikraken.kraken.lca_confidence(kmers)
+    assert list(confidence) == [amplikraken.kraken.str_to_confidence(k) for k in kmers]
+    assert (defined <= total).all()
+
+def test_lca_confidence_counts():
+    confidence, total, defined = amplikraken.kraken.lca_confidence(['3:83 52:11 0:11 3:81 |:| 3:3 0:3 52:6 3:81', '|:|'])
+    assert list(total) == [8, 0]
+    assert list(defined) == [6, 0]
+    assert confidence[0] == 0.75
+    assert confidence[1] != confidence[1]
+
+def test_lca_hits():
+    assert amplikraken.kraken.lca_hits('562:13 561:4 A:31 0:1 562:3 |:| 0:2') == ({562: 16, 561: 4}, 23)
+
+@pytest.mark.parametrize("confidence,expected", [(0.0, 562), (0.7, 562), (0.8, 561), (0.96, 0)])
+def test_kraken_rescorer(confidence, expected):
+    # Example from the Kraken2 manual: 562 scores 16/21 and its parent 561 scores 20/21
+    from amplikraken.taxonomy import KrakenTree
+    tree = KrakenTree(1)
+    tree.append_child(1, 561)
+    tree.append_child(561, 562)
+    rescorer = amplikraken.kraken.KrakenRescorer(tree, confidence)
+    assert rescorer.rescore(562, '562:13 561:4 A:31 0:1 562:3')[0] == expected
+
+def test_lca_runs():
+    reads, taxids, counts, queried = amplikraken.kraken.lca_runs(['562:13 561:4 A:31 0:1 562:3 |:| 0:2', '', '1280:5'])
+    assert list(reads) == [0, 0, 0, 0, 0, 2]
+    assert list(taxids) == [562, 561, 0, 562, 0, 1280]
+    assert list(counts) == [13, 4, 1, 3, 2, 5]
+    assert list(queried) == [23, 0, 5]
+    # Taxids over eight digits, and a batch boundary
+    reads, taxids, counts, queried = amplikraken.kraken.lca_runs(['2147483647:120 0:3', '9:1'], batch=1)
+    assert list(reads) == [0, 0, 1]
+    assert list(taxids) == [2147483647, 0, 9]
+    assert list(counts) == [120, 3, 1]
+    for invalid in ['562:13 561', '562:', '562:1:3', '56x:3', 'x:3']:
+        with pytest.raises(ValueError):
+            amplikraken.kraken.lca_runs([invalid])
+
+@pytest.mark.parametrize("confidence", [0.0, 0.5, 0.9])
+def test_kraken_rescorer_chunk(confidence):
+    taxonomy = sample_tree()
+    reads = [line.split('\t') for line in KRAKEN_LINES]
+    taxids, kmers = [int(read[2]) for read in reads], [read[4] for read in reads]
+    for rescorer in (amplikraken.kraken.KrakenRescorer(taxonomy, confidence), amplikraken.kraken.KrakenRescorer(taxonomy.index, confidence)):
+        labels, scores = rescorer.rescore_chunk(taxids, kmers)
+        assert [(int(label), float(score)) for label, score in zip(labels, scores)] == [rescorer.rescore(t, k) for t, k in zip(taxids, kmers)]
+    assert rescorer.rescore(0, '0:5') == (0, 0.0)
+    assert rescorer.ranges(1102, '1102:2 0:2') == [(1102, 4, -1, 2), (0, 4, 2, math.inf)]
+
+def sample_tree():
+    from amplikraken.taxonomy import KrakenTree
+    tree = KrakenTree(1)
+    for parent, child in [(1, 3), (3, 52), (52, 459), (459, 874), (3, 2882), (2882, 2911), (3, 21), (21, 535),
+                          (535, 307), (307, 1102), (535, 541), (1102, 1383), (1102, 1099)]:
+        tree.append_child(parent, child)
+    return tree
+
+@pytest.mark.parametrize("taxonomy", [None, sample_tree()])
+@pytest.mark.parametrize("unclassified", [False, True])
+def test_kraken_output_sweep(kraken_tsv, taxonomy, unclassified):
+    # One sweep gives the same counts as loading the file at each threshold
+    thresholds = [0.0, 0.3, 0.5, 0.75, 0.9, 1.0]
+    sweep = amplikraken.kraken.KrakenOutput(name='sample', unclassified=unclassified, taxonomy=taxonomy, chunksize=4)
+    sweep.sweep(kraken_tsv, thresholds)
+    for threshold in thresholds:
+        single = amplikraken.kraken.KrakenOutput(name='sample', minconfidence=threshold, unclassified=unclassified, taxonomy=taxonomy, chunksize=4)
+        single.load(kraken_tsv)
+        column = sweep.table[threshold]
+        assert column[column > 0].to_dict() == single.table['sample'].to_dict()
+
+def test_kraken_output_use_names(tmp_path):
+    filename = tmp_path / "names.tsv"
+    filename.write_text("C\tr1\tEscherichia coli (taxid 562)\t150\t562:5\nC\tr2\tBacteria (taxid 2)\t150\t2:5\nC\tr3\tEscherichia coli (taxid 562)\t150\t562:5\n")
+    kraken = amplikraken.kraken.KrakenOutput(name="S1", chunksize=2)
+    kraken.load(str(filename))
+    assert kraken.table["S1"].to_dict() == {2: 1, 562: 2}
@@ -0,0 +1,108 @@
+import os
+import pytest
+import numpy as np
+import pandas as pd
+from amplikraken.matrix import CountMatrix, MatrixManifest
+
+COUNTS = {
+    "S1": {562: 10, 1280: 3},
+    "S2": {562: 7, 9606: 0},
+    "S3": {},
+}
+
+def test_from_counts():
+    matrix = CountMatrix.from_counts(COUNTS)
+    assert list(matrix.taxids) == [562, 1280]
+    assert matrix.samples == ["S1", "S2", "S3"]
+    assert matrix.matrix.dtype == np.int64
+    assert matrix.matrix.nnz == 3
+    assert matrix.get(562, "S2") == 7
+    assert matrix.get(1280, "S2") == 0
+    assert matrix.get(9606, "S1") == 0
+    assert list(matrix.totals()) == [13, 7, 0]
+
+def test_matches_dense_merge():
+    tables = [pd.Series(counts, dtype="int64", name=name).rename_axis("TaxID").to_frame() for name, counts in COUNTS.items()]
+    dense = pd.concat(tables, axis=1, sort=False).fillna(0).astype("int64").sort_index()
+    dense = dense.loc[(dense != 0).any(axis=1)]
+    sparse = CountMatrix.from_tables(tables).to_dataframe()
+    pd.testing.assert_frame_equal(sparse, dense, check_names=False)
+
+def test_duplicated_samples():
+    tables = [pd.Series({562: n}, dtype="int64", name="S1").rename_axis("TaxID").to_frame() for n in (1, 2)]
+    with pytest.raises(ValueError, match="S1"):
+        CountMatrix.from_tables(tables)
+
+def test_merge():
+    first = CountMatrix.from_counts({"S1": {562: 10, 1280: 3}})
+    second = CountMatrix.from_counts({"S2": {1280: 1, 9606: 4}, "S1": {562: 1}})
+    merged = first.merge(second)
+    assert merged.samples == ["S1", "S2"]
+    assert list(merged.taxids) == [562, 1280, 9606]
+    assert merged.get(562, "S1") == 11
+    assert merged.get(9606, "S2") == 4
+
+def test_write_tsv(tmp_path):
+    matrix = CountMatrix.from_counts(COUNTS)
+    filename = str(tmp_path / "counts.tsv")
+    matrix.write(filename, names={562: "Escherichia coli"})
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "TaxID\tName\tS1\tS2\tS3"
+    assert lines[1] == "562\tEscherichia coli\t10\t7\t0"
+    assert lines[2] == "1280\t\t3\t0\t0"
+
+@pytest.mark.parametrize("suffix", [".biom", ".biom.json"])
+def test_write_biom(tmp_path, suffix):
+    biom = pytest.importorskip("biom")
+    matrix = CountMatrix.from_counts(COUNTS)
+    filename = str(tmp_path / f"counts{suffix}")
+    matrix.write(filename, names={562: "Escherichia coli", 1280: "Staphylococcus aureus"})
+    table = biom.load_table(filename)
+    assert list(table.ids(axis="observation")) == ["562", "1280"]
+    assert list(table.ids(axis="sample")) == ["S1", "S2", "S3"]
+    assert table.get_value_by_ids("562", "S2") == 7
+    assert table.metadata("1280", axis="observation")["taxonomy"] == ["Staphylococcus aureus"]
+
+@pytest.mark.parametrize("suffix", [".tsv", ".biom"])
+def test_read(tmp_path, suffix):
+    matrix = CountMatrix.from_counts(COUNTS)
+    filename = str(tmp_path / f"counts{suffix}")
+    matrix.write(filename, names={562: "Escherichia coli"})
+    loaded = CountMatrix.read(filename)
+    assert loaded.samples == matrix.samples
+    assert list(loaded.taxids) == list(matrix.taxids)
+    assert (loaded.matrix != matrix.matrix).nnz == 0
+
+def test_drop_then_merge_matches_rebuild():
+    matrix = CountMatrix.from_counts(COUNTS)
+    updated = matrix.drop(["S1"]).merge(CountMatrix.from_counts({"S1": {9606: 2}})).select(["S1", "S2", "S3"])
+    assert list(updated.taxids) == [562, 9606]
+    rebuilt = CountMatrix.from_counts({"S1": {9606: 2}, "S2": COUNTS["S2"], "S3": {}})
+    pd.testing.assert_frame_equal(updated.to_dataframe(), rebuilt.to_dataframe())
+
+def test_select():
+    matrix = CountMatrix.from_counts(COUNTS)
+    selected = matrix.select(["S3", "S2", "S4"])
+    assert selected.samples == ["S3", "S2"]
+    assert list(selected.taxids) == [562]
+    pd.testing.assert_frame_equal(selected.to_dataframe(), CountMatrix.from_counts({"S3": {}, "S2": COUNTS["S2"]}).to_dataframe())
+
+def test_manifest(tmp_path):
+    sample = tmp_path / "S1.tsv"
+    sample.write_text("C\tread1\t562\t150\t562:10\n")
+    manifest = MatrixManifest({"confidence": 0.5, "unclassified": False})
+    assert manifest.changed("S1", str(sample))
+    manifest.add("S1", str(sample))
+    manifest.save(str(tmp_path / "counts.biom"))
+
+    loaded = MatrixManifest.load(str(tmp_path / "counts.biom"))
+    assert loaded.parameters == {"confidence": 0.5, "unclassified": False}
+    assert not loaded.changed("S1", str(sample))
+    # Same content, new modification time
+    os.utime(sample, ns=(0, 0))
+    assert not loaded.changed("S1", str(sample))
+    sample.write_text("C\tread1\t561\t150\t561:10\n")
+    assert loaded.changed("S1", str(sample))
+    loaded.retain(["S2"])
+    assert loaded.samples == {}
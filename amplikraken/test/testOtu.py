@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from amplikraken.otu import PseudoOTUs, lca_profiles, minhash, lsh_buckets, distinct_rows
+from amplikraken.test.testReport import report_tree
+
+def test_lca_profiles():
+    profiles, taxa = lca_profiles(["562:3 561:1", "0:5", "562:3 |:| A:2 561:1"])
+    assert list(taxa) == [561, 562]
+    assert np.allclose(profiles.toarray(), [[0.1 ** 0.5, 0.9 ** 0.5], [0, 0], [0.1 ** 0.5, 0.9 ** 0.5]])
+
+    # With the taxonomy the ancestors (but the root) get half the hits of each level below
+    profiles, taxa = lca_profiles(["83333:4"], index=report_tree().index)
+    weights = dict(zip(taxa, profiles.toarray()[0] / profiles.toarray()[0].max()))
+    assert weights[83333] == 1 and weights[562] == 0.5 and weights[561] == 0.25
+    assert 1 not in weights and 131567 in weights
+
+def test_minhash():
+    profiles, taxa = lca_profiles(["562:3 561:1", "561:5 562:1", "1280:4", "0:3"])
+    signatures = minhash(profiles, taxa, num_perm=16, block=20)
+    assert (signatures[0] == signatures[1]).all()
+    assert (signatures[0] != signatures[2]).any()
+    assert (signatures[3] == 4294967311).all()
+    buckets = lsh_buckets(signatures, bands=4)
+    assert buckets.shape == (4, 4) and (buckets[0] == buckets[1]).all()
+    with pytest.raises(ValueError):
+        lsh_buckets(signatures, bands=32)
+
+def test_distinct_rows():
+    profiles, _ = lca_profiles(["562:3 561:1", "561:1 562:3", "0:5", "562:3 |:| 561:1", "1280:1", "0:2"])
+    rows, distinct = distinct_rows(profiles)
+    assert list(rows) == [0, 0, 1, 0, 2, 1]
+    assert (distinct != profiles[[0, 2, 4]]).nnz == 0
+
+def test_pseudo_otus_blocks():
+    kmers = [f"{562 + i % 3}:{i % 5 + 1} {1280 + i % 4}:{i % 7 + 1}" for i in range(200)]
+    otus = PseudoOTUs(threshold=0.9)
+    profiles, otus.taxa = lca_profiles(kmers)
+    abundance = np.arange(200, dtype=np.float64) % 11
+    assert (otus._cluster(profiles, abundance, block=7) == otus._cluster(profiles, abundance)).all()
+
+def test_pseudo_otus():
+    kmers = ["562:3 561:1", "0:5", "562:3 |:| 561:1", "1280:5", "1280:4 1279:1", "562:5", "562:3 561:1"]
+    otus = PseudoOTUs(threshold=0.8, num_perm=32, bands=32).fit(kmers, samples=["A", "A", "B", "B", "A", "B", "A"], weights=[1, 1, 1, 1, 1, 1, 10])
+    assert list(otus.labels) == [1, -1, 1, 2, 2, 1, 1]
+    assert otus.table.to_dict() == {"A": {1: 11, 2: 1}, "B": {1: 2, 2: 1}}
+    representatives = otus.representatives(top=1, names={562: "Escherichia coli"})
+    assert representatives.loc[1, "TaxID"] == 562 and representatives.loc[1, "Name"] == "Escherichia coli"
+    assert representatives.loc[2, "Profile"] == "1280:0.900"
+    assert np.allclose(otus.profiles.sum(axis=1), 1)
+
+    # With a high threshold only identical profiles are grouped
+    assert len(PseudoOTUs(threshold=0.999).fit(kmers)) == 4
+    assert len(PseudoOTUs().fit([])) == 0
+
+def test_pseudo_otus_load(tmp_path):
+    (tmp_path / "S1.tsv").write_text("C\tr1\t562\t150\t562:3 561:1\nU\tr2\t0\t150\t0:5\n")
+    (tmp_path / "S2.tsv").write_text("C\tuid1;size=40\t1280\t150|150\t1280:5 |:| 1280:2\n")
+    (tmp_path / "S3.tsv").write_text("")
+    otus = PseudoOTUs().load([str(tmp_path / f"S{i}.tsv") for i in (1, 2, 3)])
+    assert otus.table.to_dict() == {"S1.tsv": {1: 0, 2: 1}, "S2.tsv": {1: 40, 2: 0}, "S3.tsv": {1: 0, 2: 0}}
+    assert list(otus.representatives()["TaxID"]) == [1280, 562]
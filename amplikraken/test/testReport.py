@@ -0,0 +1,69 @@
+import os
+import pytest
+from amplikraken.taxonomy import KrakenTree
+from amplikraken.report import kraken_report, named_lines
+from amplikraken.fastq import pairedend_samples_from_path
+from amplikraken.batch import KrakenBatch
+from amplikraken.test.testTaxonomy import write_k2d
+
+# Report of kraken2 --report for the counts below
+EXPECTED_REPORT = """\
+ 16.67\t2\t2\tU\t0\tunclassified
+ 83.33\t10\t0\tR\t1\troot
+ 83.33\t10\t0\tR1\t131567\t  cellular organisms
+ 83.33\t10\t1\tD\t2\t    Bacteria
+ 58.33\t7\t0\tP\t1224\t      Proteobacteria
+ 58.33\t7\t0\tC\t1236\t        Gammaproteobacteria
+ 58.33\t7\t0\tO\t91347\t          Enterobacterales
+ 58.33\t7\t0\tF\t543\t            Enterobacteriaceae
+ 58.33\t7\t0\tG\t561\t              Escherichia
+ 58.33\t7\t5\tS\t562\t                Escherichia coli
+ 16.67\t2\t2\tS1\t83333\t                  Escherichia coli K-12
+ 16.67\t2\t2\tP\t1239\t      Firmicutes
+"""
+
+def report_tree():
+    tree = KrakenTree(root_id=1)
+    tree.root.rank, tree.root.name = "no rank", "root"
+    for parent, taxid, rank, name in [
+        (1, 131567, "no rank", "cellular organisms"), (131567, 2, "superkingdom", "Bacteria"),
+        (2, 1239, "phylum", "Firmicutes"), (2, 1224, "phylum", "Proteobacteria"),
+        (1224, 1236, "class", "Gammaproteobacteria"), (1236, 91347, "order", "Enterobacterales"),
+        (91347, 543, "family", "Enterobacteriaceae"), (543, 561, "genus", "Escherichia"),
+        (561, 562, "species", "Escherichia coli"), (562, 83333, "strain", "Escherichia coli K-12"),
+        (1, 10239, "superkingdom", "Viruses")]:
+        tree.append_child(parent, taxid, rank, name)
+    return tree
+
+def test_kraken_report():
+    index = report_tree().index
+    lines = kraken_report(index, [562, 83333, 1239, 2, 562], [4, 2, 2, 1, 1], unclassified=2)
+    assert "".join(lines) == EXPECTED_REPORT
+    assert kraken_report(index, [], [], unclassified=0) == []
+
+def test_named_lines():
+    index = report_tree().index
+    lines = ["C\tr1\t562\t150|150\t562:5 |:| 562:5\n", "U\tr2\t0\t150|150\t0:5 |:| 0:5\n"]
+    assert named_lines(lines, index) == [
+        "C\tr1\tEscherichia coli (taxid 562)\t150|150\t562:5 |:| 562:5\n",
+        "U\tr2\tunclassified (taxid 0)\t150|150\t0:5 |:| 0:5\n",
+    ]
+    with pytest.raises(KeyError, match="Taxid 1280 "):
+        named_lines(lines + ["C\tr3\t1280\t150|150\t1280:5 |:| 1280:5\n"], index)
+
+def test_batch_report(kraken2, reads_dir, tmp_path):
+    binary, db = kraken2
+    write_k2d(report_tree(), os.path.join(db, "taxo.k2d"))
+    datasets = pairedend_samples_from_path(reads_dir)
+    named = KrakenBatch(db, str(tmp_path / "named"), binary=binary, threads=2).run(datasets)
+    single = KrakenBatch(db, str(tmp_path / "single"), binary=binary, threads=2, report=True).run(datasets)
+    for sample in named:
+        # Same output as kraken2 --use-names
+        with open(named[sample]) as f1, open(single[sample]) as f2:
+            assert f1.read() == f2.read()
+    with open(os.path.join(tmp_path, "single", "S2.report")) as f:
+        report = f.read().splitlines()
+    assert report[0] == " 50.00\t5\t5\tU\t0\tunclassified"
+    assert report[-1] == " 50.00\t5\t5\tS\t562\t                Escherichia coli"
+    with open(os.path.join(db, "calls.log")) as f:
+        assert all("--use-names" not in line for line in f.readlines()[3:])
@@ -0,0 +1,221 @@
+import os
+import pytest
+import concurrent.futures
+import pandas as pd
+from amplikraken.run import KrakenRunner, KrakenMultiplexRunner
+from amplikraken.fastq import FastqDataset, pairedend_samples_from_path
+from amplikraken.batch import KrakenBatch
+from amplikraken.cache import KrakenCache, KrakenResultCache
+from amplikraken.kraken import KrakenOutput
+from amplikraken.consumers import TaxidCounter, ConfidenceFilter, OutputWriter, CacheFeeder
+from amplikraken.trim import ReadTrimmer
+from amplikraken.test.conftest import write_fastq
+
+def test_runner_output_file(kraken2, reads_dir, tmp_path):
+    binary, db = kraken2
+    output = str(tmp_path / "S1.tsv")
+    runner = KrakenRunner(db, binary=binary, output=output)
+    assert runner.version == "2.1.3"
+    runner.run(os.path.join(reads_dir, "S1_R1.fastq"), os.path.join(reads_dir, "S1_R2.fastq"))
+    with open(output) as f:
+        lines = f.read().splitlines()
+    assert lines == [f"C\tread{i}\tEscherichia coli (taxid 562)\t4|4\t562:3 |:| 562:2" for i in (0, 2)]
+    assert not os.path.exists(output + ".tmp")
+
+def test_batch_slots(kraken2):
+    binary, db = kraken2
+    assert KrakenBatch(db, "out", threads=16, memory=10 ** 6).slots(10) == (10, 1)
+    assert KrakenBatch(db, "out", threads=16, memory=10 ** 6).slots(3) == (3, 5)
+    # Each job needs the 1000 bytes database
+    assert KrakenBatch(db, "out", threads=16, memory=2500).slots(10) == (2, 8)
+    assert KrakenBatch(db, "out", threads=16, memory=10 ** 6, jobs=4).slots(10) == (4, 4)
+
+def test_batch_run(kraken2, reads_dir, tmp_path):
+    binary, db = kraken2
+    outdir = str(tmp_path / "out")
+    datasets = pairedend_samples_from_path(reads_dir)
+    batch = KrakenBatch(db, outdir, binary=binary, threads=4, memory=10 ** 6)
+    assert [dataset.name for dataset in batch.plan(datasets)] == ["S2", "S3", "S1"]
+
+    outputs = batch.run(datasets)
+    assert sorted(outputs) == ["S1", "S2", "S3"]
+    with open(outputs["S2"]) as f:
+        assert len(f.readlines()) == 5
+
+    # Done samples are skipped
+    os.remove(outputs["S3"])
+    assert [dataset.name for dataset in batch.plan(datasets)] == ["S3"]
+    assert list(batch.run(datasets)) == ["S3"]
+    with open(os.path.join(db, "calls.log")) as f:
+        assert len(f.readlines()) == 4
+
+@pytest.mark.parametrize("keepunclassified", [False, True])
+def test_multiplex_matches_single_runs(kraken2, reads_dir, tmp_path, keepunclassified):
+    binary, db = kraken2
+    datasets = pairedend_samples_from_path(reads_dir)
+    single = KrakenBatch(db, str(tmp_path / "single"), binary=binary, threads=2, keepunclassified=keepunclassified).run(datasets)
+    multiplex = KrakenBatch(db, str(tmp_path / "multi"), binary=binary, threads=2, keepunclassified=keepunclassified, multiplex=True).run(datasets)
+    assert sorted(single) == sorted(multiplex)
+    for sample in single:
+        with open(single[sample]) as f1, open(multiplex[sample]) as f2:
+            assert f1.read() == f2.read()
+    with open(os.path.join(db, "calls.log")) as f:
+        assert len(f.readlines()) == 3 + 1
+
+def test_multiplex_counts(kraken2, reads_dir, tmp_path):
+    binary, db = kraken2
+    datasets = pairedend_samples_from_path(reads_dir)
+    runner = KrakenMultiplexRunner(db, binary=binary, workdir=str(tmp_path), keepunclassified=True)
+    runner.run(datasets, outdir=str(tmp_path))
+    assert runner.counts["S2"] == {562: 5, 0: 5}
+    assert runner.counts["S1"] == {562: 2, 0: 2}
+    assert not [f for f in os.listdir(tmp_path) if f.startswith("amplikraken-")]
+
+def test_runner_consumers(kraken2, tmp_path):
+    binary, db = kraken2
+    write_fastq(tmp_path / "R1.fastq", ["ACGT", "AGGT", "TTGA", "ACCA"] * 3000)
+    output = str(tmp_path / "sample.tsv.gz")
+    cache = KrakenCache(str(tmp_path / "cache"))
+    counter, filtered = TaxidCounter("all", unclassified=True), TaxidCounter("filtered", unclassified=True)
+    runner = KrakenRunner(db, binary=binary, keepunclassified=True,
+                          consumers=[counter, OutputWriter(output), CacheFeeder(cache, output), ConfidenceFilter(0.5, filtered),
+                                     ConfidenceFilter(0, TaxidCounter("all", unclassified=True))])
+    runner.run(str(tmp_path / "R1.fastq"))
+
+    all_counts, saved, entry, (filtered_counts,), (unfiltered_counts,) = runner.results
+    assert all_counts["all"].to_dict() == {0: 3000, 562: 9000}
+    assert filtered_counts["filtered"].to_dict() == {562: 6000}
+    assert saved == output and len(entry) == 12000
+    pd.testing.assert_frame_equal(unfiltered_counts, all_counts)
+
+    # Same counts when parsing the compressed output, or loading it from the cache
+    for kraken_cache in (None, cache):
+        kraken = KrakenOutput(name="filtered", minconfidence=0.5, unclassified=True, chunksize=5000, cache=kraken_cache)
+        kraken.load(output)
+        pd.testing.assert_frame_equal(kraken.table, filtered_counts)
+
+def test_runner_consumer_error(kraken2, tmp_path):
+    binary, db = kraken2
+    write_fastq(tmp_path / "R1.fastq", ["ACGT"])
+
+    class Failing(TaxidCounter):
+        def feed(self, lines):
+            raise ValueError("broken")
+
+    output = str(tmp_path / "sample.tsv")
+    runner = KrakenRunner(db, binary=binary, consumers=[OutputWriter(output), Failing()])
+    with pytest.raises(RuntimeError, match="broken"):
+        runner.run(str(tmp_path / "R1.fastq"))
+    assert not os.path.exists(output)
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+def test_runner_stream_error(kraken2, tmp_path, monkeypatch):
+    binary, db = kraken2
+    write_fastq(tmp_path / "R1.fastq", ["ACGT", "TTGA", "ACGT"])
+    cache = KrakenResultCache(str(tmp_path / "results"))
+    output = str(tmp_path / "sample.tsv")
+    runner = KrakenRunner(db, binary=binary, output=str(tmp_path / "out.tsv"), consumers=[OutputWriter(output)], cache=cache)
+
+    # The output of kraken2 breaks after the first line
+    def broken(lines, consumers, stream=runner._stream):
+        def first_line():
+            yield next(iter(lines))
+            raise OSError("broken pipe")
+        stream(first_line(), consumers)
+    monkeypatch.setattr(runner, "_stream", broken)
+    with pytest.raises(OSError, match="broken pipe"):
+        runner.run(str(tmp_path / "R1.fastq"))
+    assert not os.path.exists(output) and not os.path.exists(tmp_path / "out.tsv")
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+    assert not [name for name in os.listdir(cache.directory) if name.startswith(".tmp-")]
+    assert cache.stats()["entries"] == 0
+
+def test_runner_fifo_error(kraken2, tmp_path, monkeypatch):
+    binary, db = kraken2
+    write_fastq(tmp_path / "R1.fastq", ["GGACGT"])
+    cache = KrakenResultCache(str(tmp_path / "results"))
+    output = str(tmp_path / "sample.tsv")
+    runner = KrakenRunner(db, binary=binary, consumers=[OutputWriter(output)], cache=cache, trimmer=ReadTrimmer("GG"), workdir=str(tmp_path))
+
+    def mkfifo(path):
+        raise OSError("no named pipes here")
+    monkeypatch.setattr(os, "mkfifo", mkfifo)
+    with pytest.raises(OSError, match="no named pipes"):
+        runner.run(str(tmp_path / "R1.fastq"))
+    assert not os.path.exists(output)
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp") or f.startswith("amplikraken-")]
+    assert not [name for name in os.listdir(cache.directory) if name.startswith(".tmp-")]
+
+def test_multiplex_no_final_newline(kraken2, tmp_path):
+    binary, db = kraken2
+    for sample, sequences in (("S1", ["ACGT", "TTGA"]), ("S2", ["ACGT", "ACGT", "TTGA"])):
+        write_fastq(tmp_path / f"{sample}.fastq", sequences)
+        text = (tmp_path / f"{sample}.fastq").read_text()
+        (tmp_path / f"{sample}.fastq").write_text(text.rstrip("\n"))
+    datasets = [FastqDataset(sample, str(tmp_path / f"{sample}.fastq")) for sample in ("S1", "S2")]
+    runner = KrakenMultiplexRunner(db, binary=binary, workdir=str(tmp_path), keepunclassified=True)
+    runner.run(datasets, outdir=str(tmp_path))
+    assert runner.counts == {"S1": {562: 1, 0: 1}, "S2": {562: 2, 0: 1}}
+
+def test_result_cache(kraken2, reads_dir, tmp_path):
+    binary, db = kraken2
+    cache = KrakenResultCache(str(tmp_path / "results"))
+    r1, r2 = os.path.join(reads_dir, "S2_R1.fastq"), os.path.join(reads_dir, "S2_R2.fastq")
+    outputs = []
+    for run in range(3):
+        output = str(tmp_path / f"run{run}.tsv")
+        counter = TaxidCounter("S2")
+        # The last run has different parameters
+        KrakenRunner(db, binary=binary, output=output, consumers=[counter], cache=cache,
+                     confidence=0.5 if run == 2 else 0.0).run(r1, r2)
+        with open(output) as f:
+            outputs.append(f.read())
+        assert counter.close()["S2"].to_dict() == {562: 5}
+    assert outputs[0] == outputs[1] == outputs[2]
+    with open(os.path.join(db, "calls.log")) as f:
+        assert len(f.readlines()) == 2
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 2)
+    assert stats["total"] == {"hits": 1, "misses": 2}
+
+    # Modified reads are classified again, the oldest entry goes beyond the size limit
+    write_fastq(r1, ["ACGT"] * 3)
+    cache.maxsize = stats["size"]
+    KrakenRunner(db, binary=binary, output=str(tmp_path / "new.tsv"), cache=cache).run(r1, r2)
+    assert cache.misses == 3 and cache.stats()["entries"] == 2
+
+def test_result_cache_threads(tmp_path, reads_dir):
+    # Threads sharing a cache (as in KrakenBatch) count every hit and miss without clashing
+    cache = KrakenResultCache(str(tmp_path / "results"))
+    files = [os.path.join(reads_dir, f"S{i}_R1.fastq") for i in (1, 2, 3)]
+    def lookups(thread):
+        for i in range(300):
+            cache.fingerprint(files[(thread + i) % 3])
+            cache.get(f"missing{thread}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lookups, range(8)))
+    assert cache.misses == 2400 and cache.stats()["total"] == {"hits": 0, "misses": 2400}
+    assert not [name for name in os.listdir(cache.directory) if name.startswith(".tmp-")]
+
+def test_runner_records(kraken2, tmp_path):
+    binary, db = kraken2
+    runner = KrakenRunner(db, binary=binary, output=str(tmp_path / "out.tsv"), keepunclassified=True, workdir=str(tmp_path))
+    pairs = (((f"read{i}/1", seq, "IIII"), (f"read{i}/2", "CCGT", "IIII")) for i, seq in enumerate(["ACGT", "TTGA"] * 5000))
+    runner.run(pairs)
+    with open(tmp_path / "out.tsv") as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 10000
+    assert lines[:2] == ["C\tread0/1\tEscherichia coli (taxid 562)\t4|4\t562:3 |:| 562:2", "U\tread1/1\tunclassified (taxid 0)\t4|4\t0:5"]
+    runner.run([("r1", "ACGT", "IIII")])
+    with open(tmp_path / "out.tsv") as f:
+        assert f.read() == "C\tr1\tEscherichia coli (taxid 562)\t4\t562:3 |:| 562:2\n"
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("amplikraken-")]
+
+    def failing():
+        yield ("r1", "ACGT", "IIII")
+        raise ValueError("broken input")
+    with pytest.raises(RuntimeError, match="broken input"):
+        runner.run(failing())
+    assert not os.path.exists(tmp_path / "out.tsv.tmp")
+    with pytest.raises(ValueError):
+        runner.run([("r1", "ACGT", "IIII")], "R2.fastq")
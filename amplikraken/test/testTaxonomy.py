@@ -0,0 +1,166 @@
+import random
+import pytest
+from amplikraken.taxonomy import KrakenTree
+from amplikraken.test.testKrakenFunctions import sample_tree
+
+
+def random_tree(size=300, seed=42):
+    rng = random.Random(seed)
+    tree = KrakenTree(1)
+    ids = [1]
+    for taxid in rng.sample(range(2, size * 10), size):
+        tree.append_child(rng.choice(ids), taxid)
+        ids.append(taxid)
+    return tree, ids
+
+
+def naive_lca(tree, a, b):
+    common = None
+    for x, y in zip(tree.get_lineage(a), tree.get_lineage(b)):
+        if x != y:
+            break
+        common = x
+    return common
+
+
+def test_lineage():
+    tree = sample_tree()
+    assert tree.get_lineage(1099) == [1, 3, 21, 535, 307, 1102, 1099]
+    assert tree.index.lineage(1099) == tree.get_lineage(1099)
+    assert tree.get_lineage(1) == [1]
+
+
+def test_lca():
+    tree = sample_tree()
+    assert tree.index.lca(1099, 541) == 535
+    assert tree.index.lca(874, 1383) == 3
+    assert tree.index.lca(1102, 1099) == 1102
+    assert tree.find_last_common_ancestor([307, 541, 1099]) == 535
+
+
+def test_lca_random_tree():
+    tree, ids = random_tree()
+    rng = random.Random(1)
+    a = [rng.choice(ids) for _ in range(500)]
+    b = [rng.choice(ids) for _ in range(500)]
+    assert list(tree.index.lca(a, b)) == [naive_lca(tree, x, y) for x, y in zip(a, b)]
+
+
+def test_is_ancestor():
+    index = sample_tree().index
+    assert index.is_ancestor(3, 1099)
+    assert index.is_ancestor(1099, 1099)
+    assert not index.is_ancestor(52, 1099)
+    assert not index.is_ancestor(1099, 3)
+
+
+def test_index_unknown_taxid():
+    with pytest.raises(ValueError):
+        sample_tree().index.lineage(999999)
+
+
+def test_clade_intervals():
+    tree = sample_tree()
+    assert tree.get_all_children_ids(535) == [307, 1102, 1383, 1099, 541]
+    assert list(tree.index.in_clade([1099, 874, 535], 535)) == [True, False, True]
+    # 1099 and 541 are in the clade of 535, 874 is not
+    assert tree.index.clade_count(535, [1099, 541, 874], [2, 3, 4]) == 5
+    clades = tree.index.clade_counts([1099, 541, 874], [2, 3, 4])
+    assert clades[tree.index.index(1)] == 9
+    assert clades[tree.index.index(52)] == 4
+
+
+def test_lowest_ancestor():
+    index = sample_tree().index
+    nodes = index.index([1099, 1099, 874, 1])
+    # Lowest ancestor with a clade of at least 0, 4, 4 and 20 nodes
+    sizes = index.end - index.index(index.taxids)
+    found = index.lowest_ancestor(nodes, lambda ancestors: sizes[ancestors] >= [0, 4, 4, 20])
+    assert [int(index.taxids[node]) if node >= 0 else -1 for node in found] == [1099, 307, 3, -1]
+
+
+def test_descendants_random_tree():
+    tree, ids = random_tree()
+    for taxid in ids[:50]:
+        expected = [x for x in ids if x != taxid and taxid in tree.get_lineage(x)]
+        assert sorted(tree.index.descendants(taxid)) == sorted(expected)
+
+
+def test_saved_taxonomy(tmp_path):
+    from amplikraken.taxonomy import load_taxonomy
+    tree = sample_tree()
+    tree.nodes[3].name = 'Bacteria'
+    tree.index.save(str(tmp_path / "taxonomy.aktax"))
+    view = load_taxonomy(str(tmp_path / "taxonomy.aktax"))
+    assert view.readonly
+    assert view.nodes[3].name == 'Bacteria'
+    assert view.get_lineage(1099) == tree.get_lineage(1099)
+    assert view.get_all_children_ids(535) == tree.get_all_children_ids(535)
+    assert view.export_to_newick() == tree.export_to_newick()
+    assert view.index.lca(1099, 541) == 535
+    with pytest.raises(ValueError):
+        view.append_child(3, 12345)
+
+
+def write_k2d(tree, filename):
+    # Minimal taxo.k2d writer: nodes in BFS order after the placeholder node 0
+    import struct
+    import numpy as np
+    from amplikraken.taxonomy import K2D_MAGIC, K2D_NODE
+    bfs = [tree.root]
+    for node in bfs:
+        bfs.extend(node.children)
+    internal = {node.node_id: i + 1 for i, node in enumerate(bfs)}
+    names, ranks = b"\0", b"\0"
+    rank_offsets = {}
+    nodes = np.zeros(len(bfs) + 1, dtype=K2D_NODE)
+    for i, node in enumerate(bfs, start=1):
+        parent = tree.get_parent(node.node_id)
+        rank = (node.rank or "no rank").encode()
+        if rank not in rank_offsets:
+            rank_offsets[rank] = len(ranks)
+            ranks += rank + b"\0"
+        nodes[i] = (internal[parent] if parent is not None else 0,
+                    internal[node.children[0].node_id] if node.children else 0, len(node.children),
+                    len(names), rank_offsets[rank], node.node_id, 0)
+        names += (node.name or str(node.node_id)).encode() + b"\0"
+    with open(filename, "wb") as f:
+        f.write(K2D_MAGIC + struct.pack("<QQQ", len(nodes), len(names), len(ranks)))
+        f.write(nodes.tobytes() + names + ranks)
+
+
+def test_k2d_taxonomy(tmp_path):
+    from amplikraken.taxonomy import load_taxonomy
+    tree, ids = random_tree(200)
+    for taxid in ids:
+        tree.nodes[taxid].name = f"taxon {taxid}"
+        tree.nodes[taxid].rank = "genus" if taxid % 2 else "species"
+    write_k2d(tree, str(tmp_path / "taxo.k2d"))
+    k2d = load_taxonomy(str(tmp_path))
+    assert k2d.export_to_newick() == tree.export_to_newick()
+    for taxid in ids[::7]:
+        assert k2d.get_lineage(taxid) == tree.get_lineage(taxid)
+        assert k2d.nodes[taxid].name == f"taxon {taxid}"
+        assert k2d.nodes[taxid].rank == tree.nodes[taxid].rank
+
+
+def named_tree():
+    tree = sample_tree()
+    for taxid, name in [(3, 'Bacteria'), (52, 'Firmicutes'), (21, 'Bacteroidota'), (535, 'Bacteroidia'),
+                        (1102, 'Bacteroides'), (1099, 'Bacteroides fragilis'), (541, 'Bacteroides')]:
+        tree.nodes[taxid].name = name
+    return tree
+
+
+def test_name_search():
+    tree = named_tree()
+    index = tree.index
+    assert tree.get_node_by_name('Bacteroides') == 1102
+    assert tree.get_node_by_name('Missing') is None
+    assert index.names_to_taxids(['Bacteroides', 'bacteroides', 'Missing']) == {'Bacteroides': [1102, 541]}
+    assert index.names_to_taxids(['bacteria'], mode='nocase') == {'bacteria': [3]}
+    assert index.names_to_taxids(['Bacteroides f'], mode='prefix') == {'Bacteroides f': [1099]}
+    assert index.names_to_taxids(['MICUT'], mode='substring') == {'MICUT': [52]}
+    assert index.taxids_to_names([3, 1099, 999999]) == {3: 'Bacteria', 1099: 'Bacteroides fragilis'}
+    with pytest.raises(ValueError):
+        index.names_to_taxids(['Bacteria'], mode='fuzzy')
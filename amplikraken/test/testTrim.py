@@ -0,0 +1,85 @@
+import os
+import pytest
+from amplikraken.trim import ReadTrimmer, TrimStats, primer_end, quality_trim_index
+from amplikraken.run import KrakenRunner
+from amplikraken.fastq import pairedend_samples_from_path
+from amplikraken.batch import KrakenBatch
+from amplikraken.cache import KrakenResultCache
+from amplikraken.test.conftest import write_fastq
+
+def test_primer_end():
+    assert primer_end("ACGTTTGCA", "ACSTT") == 5
+    assert primer_end("ACCTTTGCA", "ACGTT") == -1
+    assert primer_end("ACCTTTGCA", "ACGTT", mismatches=1) == 5
+    assert primer_end("GGACGTTTGCA", "ACGTT", offset=2) == 7
+    assert primer_end("ACG", "ACGTT", mismatches=2) == -1
+
+def test_quality_trim_index():
+    assert quality_trim_index("IIII##", 20) == 4
+    assert quality_trim_index("IIII#(", 20) == 4
+    assert quality_trim_index("IIII#I", 20) == 6
+    assert quality_trim_index("IIIIII", 20) == 6
+    assert quality_trim_index("######", 20) == 0
+
+def test_trimmer_pairs():
+    trimmer = ReadTrimmer("AAGG", "CCTT", mismatches=0, quality=20, truncate=(4, 3))
+    pairs = [
+        (("r1", "AAGGACGTAC", "IIIIIIIIII"), ("r1", "CCTTGGCA", "IIIIIIII")),   # kept
+        (("r2", "AAGGACGTAC", "IIIIIIIIII"), ("r2", "GGGGGGCA", "IIIIIIII")),   # no reverse primer
+        (("r3", "AAGGACGTAC", "IIIIII####"), ("r3", "CCTTGGCA", "IIIIIIII")),   # too short after trimming
+        (("r4", "AAGGTTTTTT", "IIIIIIIIII"), ("r4", "CCTTAAAAA", "IIIIIIIII")), # kept
+    ]
+    stats = TrimStats()
+    batches = list(trimmer.filter([pairs[:2], pairs[2:3], pairs[3:]], stats))
+    assert batches == [
+        [(("r1", "ACGT", "IIII"), ("r1", "GGC", "III"))],
+        [(("r4", "TTTT", "IIII"), ("r4", "AAA", "III"))],
+    ]
+    assert (stats.reads, stats.kept, stats.no_primer, stats.too_short) == (4, 2, 1, 1)
+    with pytest.raises(ValueError):
+        ReadTrimmer("ACGTZ")
+
+def test_trimmer_single():
+    trimmer = ReadTrimmer("ACGT", keep_untrimmed=True, min_length=3)
+    records = [("r1", "ACGTGGC", "IIIIIII"), ("r2", "TTTTTT", "IIIIII"), ("r3", "ACGTGG", "IIIIII")]
+    assert list(trimmer.filter([records])) == [[("r1", "GGC", "III"), ("r2", "TTTTTT", "IIIIII")]]
+
+def test_runner_trimmer(kraken2, tmp_path):
+    binary, db = kraken2
+    # Without the primer "GG" the reads starting with A are classified, the others are discarded
+    write_fastq(tmp_path / "R1.fastq", ["GGACGT", "GGTTGA", "CCACGT", "GGAGTT"] * 3000)
+    write_fastq(tmp_path / "R2.fastq", ["CCGT", "AAGA", "CCGT", "AAGA"] * 3000)
+    cache = KrakenResultCache(str(tmp_path / "cache"))
+    trimmer = ReadTrimmer("GG", mismatches=0)
+    for _ in range(2):
+        runner = KrakenRunner(db, binary=binary, output=str(tmp_path / "out.tsv"), keepunclassified=True, trimmer=trimmer, cache=cache, workdir=str(tmp_path))
+        runner.run(str(tmp_path / "R1.fastq"), str(tmp_path / "R2.fastq"))
+    assert (runner.trim_stats is None) and cache.stats()["hits"] == 1
+    with open(tmp_path / "out.tsv") as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 9000
+    assert lines[:3] == ["C\tread0\tEscherichia coli (taxid 562)\t4|4\t562:3 |:| 562:2",
+                         "U\tread1\tunclassified (taxid 0)\t4|4\t0:5",
+                         "C\tread3\tEscherichia coli (taxid 562)\t4|4\t562:1 0:4 0:2 0:3"]
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("amplikraken-")]
+
+    # A different trimmer is not served from the cache
+    runner = KrakenRunner(db, binary=binary, output=str(tmp_path / "out.tsv"), trimmer=ReadTrimmer("GG", mismatches=0, truncate=3), cache=cache)
+    runner.run(str(tmp_path / "R1.fastq"), str(tmp_path / "R2.fastq"))
+    assert (runner.trim_stats.reads, runner.trim_stats.kept) == (12000, 9000)
+    assert cache.stats()["misses"] == 2
+
+@pytest.mark.parametrize("dereplicate", [False, True])
+def test_batch_trimmer(kraken2, tmp_path, dereplicate):
+    binary, db = kraken2
+    path = tmp_path / "reads"
+    path.mkdir()
+    write_fastq(path / "S1_R1.fastq", ["GGACGT", "TTTTTT", "GGACGT"])
+    write_fastq(path / "S1_R2.fastq", ["CCGT", "AAGA", "CCGT"])
+    outputs = KrakenBatch(db, str(tmp_path / "out"), binary=binary, threads=1, dereplicate=dereplicate,
+                          trimmer=ReadTrimmer("GG")).run(pairedend_samples_from_path(str(path)))
+    (output,) = outputs.values()
+    with open(output) as f:
+        assert [line.split("\t")[1] for line in f] == ["read0", "read2"]
+    with pytest.raises(ValueError):
+        KrakenBatch(db, str(tmp_path / "out"), multiplex=True, trimmer=ReadTrimmer("GG"))
@@ -0,0 +1,157 @@
+# This file contains the pre-processing of the reads before classification: primer removal, quality and length filters
+import re
+
+# Bases matched by each IUPAC code
+IUPAC = {
+    "A": "A", "C": "C", "G": "G", "T": "T", "U": "T",
+    "R": "AG", "Y": "CT", "S": "CG", "W": "AT", "K": "GT", "M": "AC",
+    "B": "CGT", "D": "AGT", "H": "ACT", "V": "ACG", "N": "ACGT",
+}
+
+def primer_end(sequence, primer, mismatches=0, offset=0):
+    """
+    Position of the end of `primer` (IUPAC codes allowed) at the start of `sequence`, with at most
+    `mismatches` mismatches and `offset` extra bases before it, or -1 if the primer is not found
+    Input: primer_end("ACGTTTGCA", "ACSTT")
+    Output: 5
+    """
+    primer = primer.upper()
+    for start in range(offset + 1):
+        if start + len(primer) > len(sequence):
+            break
+        found = 0
+        for base, code in zip(sequence[start:start + len(primer)], primer):
+            if base not in IUPAC.get(code, code):
+                found += 1
+                if found > mismatches:
+                    break
+        else:
+            return start + len(primer)
+    return -1
+
+def quality_trim_index(quality, cutoff, phred=33):
+    """
+    Length of the read after trimming the low quality 3' end, as `cutadapt -q` (BWA algorithm):
+    the end minimising the sum of (cutoff - quality) of the removed bases
+    Input: quality_trim_index("IIII##", 20)
+    Output: 4
+    """
+    total, best, stop = 0, 0, len(quality)
+    for i in range(len(quality) - 1, -1, -1):
+        total += cutoff - (ord(quality[i]) - phred)
+        if total < 0:
+            break
+        if total > best:
+            best, stop = total, i
+    return stop
+
+
+class TrimStats:
+    """
+    Number of reads (or pairs) processed by a ReadTrimmer, kept and discarded by reason
+    """
+    def __init__(self) -> None:
+        self.reads = 0
+        self.kept = 0
+        self.no_primer = 0
+        self.too_short = 0
+
+    def __repr__(self) -> str:
+        return f"TrimStats(reads={self.reads}, kept={self.kept}, no_primer={self.no_primer}, too_short={self.too_short})"
+
+
+class ReadTrimmer:
+    """
+    Pre-processing of amplicon reads before classification, on the records of a FastqReader.
+    In order: remove the `forward` primer from the start of R1 (and the `reverse` primer from the
+    start of R2), allowing `mismatches` mismatches and `offset` bases before the primer, discarding
+    the reads without primer unless `keep_untrimmed`; trim the 3' end below `quality`; truncate
+    to `truncate` bases (an int, or one per mate), discarding the shorter reads as DADA2
+    does; discard the reads shorter than `min_length`. Pairs are kept only if both mates pass.
+
+    Input:
+        trimmer = ReadTrimmer("CCTACGGGNGGCWGCAG", "GACTACHVGGGTATCTAATCC", quality=20, truncate=(240, 200))
+        for batch in trimmer.filter(FastqReader("S1_R1.fastq.gz", "S1_R2.fastq.gz").batches(), stats): ...
+    Output:
+        [(("read1", "TGGGGAATATTG...", "IIII..."), ("read1", "TACGGAGGGTGC...", "IIII...")), ...], stats.kept
+    """
+    def __init__(self, forward=None, reverse=None, mismatches=2, offset=0, keep_untrimmed=False, quality=None, truncate=None, min_length=1, phred=33) -> None:
+        self.primers = [forward.upper() if forward else None, reverse.upper() if reverse else None]
+        self.mismatches = mismatches
+        self.offset = offset
+        self.keep_untrimmed = keep_untrimmed
+        self.quality = quality
+        self.truncate = tuple(truncate) if isinstance(truncate, (list, tuple)) else (truncate, truncate)
+        self.min_length = min_length
+        self.phred = phred
+        for primer in self.primers:
+            if primer and any(code not in IUPAC for code in primer):
+                raise ValueError(f"Invalid primer {primer}: only IUPAC codes are allowed")
+        # Exact matches are searched first with a regular expression
+        self._patterns = [re.compile(f".{{0,{offset}}}?" + "".join(f"[{IUPAC[code]}]" for code in primer)) if primer else None for primer in self.primers]
+
+    def __repr__(self) -> str:
+        return f"ReadTrimmer({', '.join(f'{key}={value}' for key, value in self.parameters().items())})"
+
+    def parameters(self):
+        """
+        Settings of the trimmer, changing the reads classified
+        """
+        return {
+            "primers": self.primers, "mismatches": self.mismatches, "offset": self.offset,
+            "keep_untrimmed": self.keep_untrimmed, "quality": self.quality,
+            "truncate": list(self.truncate), "min_length": self.min_length, "phred": self.phred,
+        }
+
+    def filter(self, batches, stats=None):
+        """
+        Trimmed records (or pairs) of each batch, without the discarded ones, updating `stats`
+        (a TrimStats) if given. Empty batches are skipped
+        """
+        stats = stats if stats is not None else TrimStats()
+        for batch in batches:
+            kept = []
+            for item in batch:
+                paired = isinstance(item[0], tuple)
+                records = item if paired else (item,)
+                trimmed, reason = [], None
+                for mate, record in enumerate(records):
+                    record, reason = self.trim(record, mate)
+                    if record is None:
+                        break
+                    trimmed.append(record)
+                stats.reads += 1
+                if reason == "no_primer":
+                    stats.no_primer += 1
+                elif reason == "too_short":
+                    stats.too_short += 1
+                else:
+                    kept.append(tuple(trimmed) if paired else trimmed[0])
+            stats.kept += len(kept)
+            if kept:
+                yield kept
+
+    def trim(self, record, mate=0):
+        """
+        Trimmed record of R1 (mate=0) or R2 (mate=1), or None with the reason it is discarded
+        """
+        header, sequence, quality = record
+        primer = self.primers[mate]
+        if primer:
+            match = self._patterns[mate].match(sequence)
+            end = match.end() if match else primer_end(sequence, primer, self.mismatches, self.offset) if self.mismatches else -1
+            if end >= 0:
+                sequence, quality = sequence[end:], quality[end:]
+            elif not self.keep_untrimmed:
+                return None, "no_primer"
+        if self.quality is not None:
+            stop = quality_trim_index(quality, self.quality, self.phred)
+            sequence, quality = sequence[:stop], quality[:stop]
+        truncate = self.truncate[mate]
+        if truncate:
+            if len(sequence) < truncate:
+                return None, "too_short"
+            sequence, quality = sequence[:truncate], quality[:truncate]
+        if len(sequence) < self.min_length:
+            return None, "too_short"
+        return (header, sequence, quality), None
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import os
+import sys
+import shutil
+import argparse
+import amplikraken
+import amplikraken.fastq
+from amplikraken.batch import KrakenBatch
+from amplikraken.cache import KrakenResultCache
+from amplikraken.trim import ReadTrimmer
+from amplikraken.database import DatabaseManager, resolve_database
+
+def main():
+    args = argparse.ArgumentParser(description='Run kraken2 on all the samples of a directory')
+    args.add_argument('DIR', type=str, help='Directory with the FASTQ files')
+    args.add_argument('-d', '--database', type=str, help='Database directory or akget code (default: %(default)s)', default=os.environ.get('KRAKEN2_DEFAULT_DB'))
+    args.add_argument('-o', '--outdir', type=str, required=True, help='Output directory (one SAMPLE.tsv per sample, existing ones are skipped)')
+    args.add_argument('-c', '--confidence', type=float, default='0.0', help='Minimum confidence score (default: %(default)s)')
+    args.add_argument('-t', '--threads', type=int, default=os.cpu_count(), help='Total number of threads (default: %(default)s)')
+    args.add_argument('-m', '--memory', type=float, help='Total memory for the kraken2 processes in GB (default: available memory)')
+    args.add_argument('-j', '--jobs', type=int, help='Maximum number of kraken2 processes at a time (default: as many as threads and memory allow)')
+    args.add_argument('-x', '--multiplex', action="store_true", help='Classify all the samples in a single kraken2 run, loading the database once (best for many small samples)')
+    args.add_argument('-r', '--report', action="store_true", help='Also write the kraken2 report of each sample (SAMPLE.report), with a single kraken2 run')
+    args.add_argument('--dereplicate', action="store_true", help='Classify only the unique reads (pairs) of each sample, expanding the output to all the reads')
+    args.add_argument('--primer-forward', type=str, help='Remove this primer (IUPAC codes allowed) from the start of R1, discarding the reads without it')
+    args.add_argument('--primer-reverse', type=str, help='Remove this primer from the start of R2, discarding the pairs without it')
+    args.add_argument('--primer-mismatches', type=int, default=2, help='Mismatches allowed in the primers (default: %(default)s)')
+    args.add_argument('--keep-untrimmed', action="store_true", help='Keep the reads without primer')
+    args.add_argument('--min-quality', type=int, help='Trim the 3\' end of the reads below this quality')
+    args.add_argument('--truncate', type=int, nargs='+', help='Truncate the reads to this length (one value, or one for R1 and one for R2), discarding the shorter ones')
+    args.add_argument('--min-length', type=int, default=1, help='Discard the reads shorter than this after trimming (default: %(default)s)')
+    args.add_argument('-u', '--unclassified', action="store_true", help='Keep unclassified reads in the output')
+    args.add_argument('--cache-dir', type=str, help='Directory caching the kraken2 results, to skip the samples already classified with the same database and parameters')
+    args.add_argument('--cache-size', type=float, default=50, help='Maximum size of the result cache in GB (default: %(default)s)')
+    args.add_argument('--stage', type=str, nargs='?', const='', help='Copy the database to local storage (DIR, default /dev/shm) and share it between the kraken2 processes with --memory-mapping')
+    args.add_argument('--stage-budget', type=float, help='Maximum size of the staged databases in GB, removing the unused ones beyond it (default: half of the staging file system)')
+    args.add_argument('--binary', type=str, default='kraken2', help='Kraken2 binary (default: %(default)s)')
+    args.add_argument('--verbose', action="store_true", help='Verbose output')
+    args.add_argument('--version', help='Print version and exit', action='version', version=amplikraken.__version__)
+    args = args.parse_args()
+
+    # Check db
+    if args.database is None:
+        print("ERROR: No database specified", file=sys.stderr)
+        sys.exit(1)
+    try:
+        args.database = resolve_database(args.database)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not os.path.exists(os.path.join(args.database, "hash.k2d")):
+        print(f"ERROR: Invalid database {args.database}", file=sys.stderr)
+        sys.exit(1)
+
+    trimmer = None
+    if args.primer_forward or args.primer_reverse or args.min_quality is not None or args.truncate or args.min_length > 1:
+        if args.truncate and len(args.truncate) > 2:
+            print("ERROR: --truncate takes one or two lengths", file=sys.stderr)
+            sys.exit(1)
+        try:
+            trimmer = ReadTrimmer(args.primer_forward, args.primer_reverse, mismatches=args.primer_mismatches, keep_untrimmed=args.keep_untrimmed,
+                                  quality=args.min_quality, truncate=args.truncate if args.truncate and len(args.truncate) == 2 else args.truncate[0] if args.truncate else None,
+                                  min_length=args.min_length)
+        except ValueError as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    if args.multiplex and (args.report or args.dereplicate or trimmer):
+        print("ERROR: --report, --dereplicate and trimming are not available with --multiplex", file=sys.stderr)
+        sys.exit(1)
+
+    datasets = amplikraken.fastq.pairedend_samples_from_path(args.DIR)
+    staging = None
+    if args.stage is not None:
+        staging = DatabaseManager(args.stage or None, budget=int(args.stage_budget * 1024 ** 3) if args.stage_budget else None, verbose=args.verbose)
+        if args.stage_budget is None:
+            # Without a budget the copies would stay in the staging directory (in memory for /dev/shm)
+            staging.budget = shutil.disk_usage(staging.directory).total // 2
+            print(f"Staged databases in {staging.directory} limited to {staging.budget / 1024 ** 3:.1f} GB (half of its file system, see --stage-budget)", file=sys.stderr)
+    cache = KrakenResultCache(args.cache_dir, maxsize=int(args.cache_size * 1024 ** 3)) if args.cache_dir else None
+    batch = KrakenBatch(args.database, args.outdir, binary=args.binary, threads=args.threads,
+                        memory=int(args.memory * 1024 ** 3) if args.memory else None, jobs=args.jobs,
+                        confidence=args.confidence, keepunclassified=args.unclassified, multiplex=args.multiplex, report=args.report, cache=cache, dereplicate=args.dereplicate, trimmer=trimmer, staging=staging, verbose=args.verbose)
+    try:
+        batch.run(datasets)
+    except RuntimeError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
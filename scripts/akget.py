@@ -16,46 +16,8 @@ __version__ = "x"
 
  
 
-# Set database in JSON format for interoperability
-databases_json = """{
- 
-  "greengenes": {
-    "md5": "c66091696e1fcf35a7ac6b8fcb48bbef",
-    "ver": "13.5",
-    "outdir": "16S_Greengenes_k2db",
-    "url": "https://genome-idx.s3.amazonaws.com/kraken/16S_Greengenes13.5_20200326.tgz",
-    "desc": "Greengenes",
-    "c": "McDonald 2012",
-    "cite": "McDonald D, (2012) 'An improved Greengenes taxonomy with explicit ranks for ecological and evolutionary analyses of bacteria and archaea' 10.1038/ismej.2011.139 "
-  },
-  "kraken-silva-138": {
-    "md5": "94ecb2c851f3e4f02335559d42013f0f",
-    "outdir": "16S_SILVA138_k2db",
-    "ver": "138",
-    "desc": "SILVA release 138",
-    "url": "https://genome-idx.s3.amazonaws.com/kraken/16S_Silva138_20200326.tgz",
-    "c": "Quast 2013",
-    "cite": "Quast C, Pruesse E, Yilmaz P, Gerken J, Schweer T, Yarza P, Peplies J, Glöckner FO (2013) The SILVA ribosomal RNA gene database project: improved data processing and web-based tools.  ucl. Acids Res. 41 (D1): D590-D596."
-  },
-  "kraken-silva-132": {
-    "url": "https://genome-idx.s3.amazonaws.com/kraken/16S_Silva132_20200326.tgz",
-    "outdir": "16S_SILVA132_k2db",
-    "desc": "SILVA release 132",
-    "md5": "0b6d8ed61e63210c1dc2ccdd373a9d5d",
-    "ver": "132",
-    "c": "Quast 2013",
-    "cite": "Quast C, Pruesse E, Yilmaz P, Gerken J, Schweer T, Yarza P, Peplies J, Glöckner FO (2013) The SILVA ribosomal RNA gene database project: improved data processing and web-based tools.  ucl. Acids Res. 41 (D1): D590-D596."
-  },
-  "kraken-rdp-115": {
-    "url": "https://genome-idx.s3.amazonaws.com/kraken/16S_RDP11.5_20200326.tgz",
-    "outdir": "16S_RDP_k2db",
-    "desc": "RDP release 11.5",
-    "md5": "7381792a19064962741724eee188121e",
-    "ver": "11.5",
-    "c": "Cole 2014",
-    "cite": "Cole JR, Wang Q, Fish JA, Chai B, McGarrell DM, Sun Y, Brown CT, Porras-Alfaro A, Kuske CR, Tiedje JM (2014)'Ribosomal Database Project: data and tools for high throughput rRNA analysis', NAR, 10.1093/nar/gkt1244"
-  }
-}"""
+# Database catalog, shared with amplikraken.database
+from amplikraken.database import databases_json
    
 
 
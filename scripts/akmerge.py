@@ -2,32 +2,169 @@
 import os
 import sys
 import argparse
-import pandas as pd
+import collections
+import concurrent.futures
+import amplikraken.cache
 import amplikraken.kraken
+import amplikraken.matrix
+import amplikraken.taxonomy
+
+# State of the process loading the samples (each worker, with --jobs), set by init_worker()
+_worker = {}
 
 def main():
     args = argparse.ArgumentParser(description='Merge kraken output files')
     args.add_argument('TSV', type=str, nargs='+', help='Path to kraken output files (not reports)')
-    args.add_argument('-o', '--output', type=str, help='Output file name')
+    args.add_argument('-o', '--output', type=str, help='Output file name: BIOM if ending with .biom (.biom.json for JSON), TSV otherwise')
     args.add_argument('-c', '--confidence', type=float, default='0.0', help='Confidence')
+    args.add_argument('-t', '--taxonomy', type=str, help='Database taxonomy (database directory, taxo.k2d, aktaxonomy file or kraken2-inspect output) to re-score labels as kraken2 --confidence')
+    args.add_argument('-n', '--names', action="store_true", help='Add the taxon names (from --taxonomy) to the merged table')
+    args.add_argument('-s', '--sweep', type=str, help='Count each sample at several confidence thresholds, as START:STOP:STEP or a comma separated list (one table per sample, saved in the --output directory)')
+    args.add_argument('-u', '--update', action="store_true", help='Add the new (or modified) files to the existing --output matrix, using its manifest, instead of merging all files again')
+    args.add_argument('-j', '--jobs', type=int, default=1, help='Number of samples loaded in parallel (default: %(default)s)')
+    args.add_argument('--chunk-size', dest='chunksize', type=int, default=1000000, help='Lines to parse at a time, 0 to load whole files (default: %(default)s)')
+    args.add_argument('--cache-dir', type=str, help='Directory caching the parsed files, to load them faster next time (default: $AMPLIKRAKEN_CACHE, no cache if not set)', default=os.environ.get('AMPLIKRAKEN_CACHE'))
+    args.add_argument('--cache-size', type=float, default=10, help='Maximum size of the cache in GB (default: %(default)s)')
+    args.add_argument('--no-cache', action="store_true", help='Do not read or write the cache, even with $AMPLIKRAKEN_CACHE set')
     args.add_argument('--verbose', action="store_true", help='Verbose output')
     args.add_argument('--version', help='Print version and exit', action='version', version=amplikraken.__version__)
     args = args.parse_args()
 
     # Check files
-    kraken_outputs = []
     for f in args.TSV:
         if not os.path.exists(f):
             print(f"File not found: {f}")
             sys.exit(1)
-        kraken = amplikraken.kraken.KrakenOutput(name=os.path.basename(f))
-        kraken.load(f)
-        kraken.collapse()
-        kraken_outputs.append(kraken)
-        print("Loading ", kraken.name, len(kraken), file=sys.stderr)
+
+    # Samples are named after the files
+    duplicated = [name for name, n in collections.Counter(os.path.basename(f) for f in args.TSV).items() if n > 1]
+    if duplicated:
+        print(f"Duplicated sample names: {', '.join(duplicated)}")
+        sys.exit(1)
+
+    if args.names and not args.taxonomy:
+        print("--names requires --taxonomy")
+        sys.exit(1)
+
+    init_worker(args)
+    if args.sweep:
+        sweep(args)
+        return
+
+    # Inputs and parameters of the matrix, to update it later
+    parameters = {"confidence": args.confidence, "unclassified": False, "taxonomy": os.path.abspath(args.taxonomy) if args.taxonomy else None}
+    manifest = amplikraken.matrix.MatrixManifest(parameters)
+    matrix = None
+    if args.update:
+        if not args.output:
+            print("--update requires --output")
+            sys.exit(1)
+        manifest_file = amplikraken.matrix.MatrixManifest.filename(args.output)
+        if not os.path.exists(args.output) or not os.path.exists(manifest_file):
+            print(f"No matrix and manifest to update ({args.output}), merging all files", file=sys.stderr)
+        elif amplikraken.matrix.MatrixManifest.load(args.output).parameters != parameters:
+            print(f"Parameters differ from the ones of {args.output}, merging all files", file=sys.stderr)
+        else:
+            manifest = amplikraken.matrix.MatrixManifest.load(args.output)
+            matrix = amplikraken.matrix.CountMatrix.read(args.output)
+
+    # Only parse the files not already merged (all of them without --update)
+    files = [f for f in args.TSV if matrix is None or manifest.changed(os.path.basename(f), f)]
+    tables, hashes = [None] * len(files), [None] * len(files)
+    for done, (i, (table, hash)) in enumerate(run_samples(load_sample, files, args), start=1):
+        tables[i], hashes[i] = table, hash
+        print(f"Loading [{done}/{len(files)}]", os.path.basename(files[i]), len(table), file=sys.stderr)
         
-    # Merge all dfs by TaxID, each having kraken.name aas column name of their counts
-    merged = pd.concat([k.table for k in kraken_outputs], axis=1, sort=False)
-    merged = merged.fillna(0)
-    print(merged.head())
+    # Merge the samples in a sparse TaxID x sample matrix of integer counts
+    added = amplikraken.matrix.CountMatrix.from_tables(tables)
+    if matrix is not None:
+        print(f"Updating {len(files)} of {len(args.TSV)} samples in {args.output}", file=sys.stderr)
+        # Samples in the order of the inputs, without the ones no longer given
+        samples = [os.path.basename(f) for f in args.TSV]
+        matrix = matrix.drop(added.samples).merge(added).select(samples)
+        manifest.retain(samples)
+    else:
+        matrix = added
+    if args.output:
+        for f, hash in zip(files, hashes):
+            manifest.add(os.path.basename(f), f, hash=hash)
+
+    taxonomy = _worker['taxonomy']
+    names = None
+    if args.names and taxonomy is not None:
+        names = taxonomy.index.taxids_to_names(matrix.taxids)
+    if args.output:
+        matrix.write(args.output, names=names)
+        manifest.save(args.output)
+        print(f"Saved {matrix} to {args.output}", file=sys.stderr)
+    else:
+        print(matrix.to_dataframe(names=names).head())
         
+
+
+def sweep(args):
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    for done, (i, table) in enumerate(run_samples(sweep_sample, args.TSV, args), start=1):
+        name = os.path.basename(args.TSV[i])
+        print(f"Loading [{done}/{len(args.TSV)}]", name, len(table), file=sys.stderr)
+        if args.output:
+            table.to_csv(os.path.join(args.output, f"{name}.sweep.tsv"), sep="\t")
+        else:
+            print(name)
+            print(table)
+
+def init_worker(args):
+    _worker['args'] = args
+    _worker['taxonomy'] = amplikraken.taxonomy.load_taxonomy(args.taxonomy) if args.taxonomy else None
+    _worker['cache'] = None if args.no_cache or not args.cache_dir else amplikraken.cache.KrakenCache(args.cache_dir, maxsize=int(args.cache_size * 1024 ** 3))
+
+def kraken_output(filename):
+    args = _worker['args']
+    # At confidence 0 the labels are kraken2's own: re-scoring is only needed above it, or to sweep
+    rescore = args.confidence > 0 or args.sweep
+    return amplikraken.kraken.KrakenOutput(name=os.path.basename(filename), minconfidence=args.confidence, chunksize=args.chunksize,
+                                           taxonomy=_worker['taxonomy'] if rescore else None, cache=_worker['cache'])
+
+def load_sample(filename):
+    """
+    Load and collapse one Kraken2 output: only the per-TaxID counts go back to the main process,
+    with the content hash of the file for the manifest (None without --output)
+    """
+    kraken = kraken_output(filename)
+    kraken.load(filename)
+    kraken.collapse()
+    hash = None
+    if _worker['args'].output:
+        # Hashed by the cache already (if any): not read again
+        cache = _worker['cache']
+        hash = cache.content_hash(filename) if cache is not None else amplikraken.cache.file_hash(filename)
+    return kraken.table, hash
+
+def sweep_sample(filename):
+    return kraken_output(filename).sweep(filename, parse_thresholds(_worker['args'].sweep)).table
+
+def run_samples(function, files, args):
+    """
+    Yield (position, result) for each file as soon as it is done, using a pool of --jobs processes
+    """
+    if args.jobs <= 1:
+        for i, f in enumerate(files):
+            yield i, function(f)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(args,)) as executor:
+        futures = {executor.submit(function, f): i for i, f in enumerate(files)}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+def parse_thresholds(string):
+    """
+    Input: '0:1:0.25' or '0,0.5,0.9'
+    Output: [0.0, 0.25, 0.5, 0.75, 1.0] or [0.0, 0.5, 0.9]
+    """
+    if ":" not in string:
+        return [float(x) for x in string.split(",")]
+    start, stop, step = [float(x) for x in string.split(":")]
+    steps = int(round((stop - start) / step))
+    return [round(start + i * step, 10) for i in range(steps + 1)]
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import amplikraken
+import amplikraken.otu
+import amplikraken.taxonomy
+
+def main():
+    args = argparse.ArgumentParser(description='Cluster the reads of kraken output files into pseudo-OTUs by the taxa of their k-mers')
+    args.add_argument('TSV', type=str, nargs='+', help='Path to kraken output files (not reports), one per sample')
+    args.add_argument('-o', '--output', type=str, required=True, help='Output prefix: PREFIX.otu.tsv (reads per OTU and sample) and PREFIX.profiles.tsv (profile of each OTU)')
+    args.add_argument('-s', '--similarity', type=float, default=0.8, help='Minimum cosine similarity to the OTU centroid (default: %(default)s)')
+    args.add_argument('-t', '--taxonomy', type=str, help='Database taxonomy (database directory, taxo.k2d, aktaxonomy file or kraken2-inspect output): hits also count for the ancestors, and OTUs get names')
+    args.add_argument('--top', type=int, default=5, help='Taxa listed in the profile of each OTU (default: %(default)s)')
+    args.add_argument('--num-perm', type=int, default=32, help='MinHash hash functions (default: %(default)s)')
+    args.add_argument('--bands', type=int, default=16, help='LSH bands: more bands find more candidates (default: %(default)s)')
+    args.add_argument('--verbose', action="store_true", help='Verbose output')
+    args.add_argument('--version', help='Print version and exit', action='version', version=amplikraken.__version__)
+    args = args.parse_args()
+
+    # Check files
+    for f in args.TSV:
+        if not os.path.exists(f):
+            print(f"File not found: {f}")
+            sys.exit(1)
+
+    index = amplikraken.taxonomy.load_taxonomy(args.taxonomy).index if args.taxonomy else None
+    try:
+        otus = amplikraken.otu.PseudoOTUs(threshold=args.similarity, num_perm=args.num_perm, bands=args.bands, index=index).load(args.TSV)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    names = index.taxids_to_names(otus.taxa) if index is not None else None
+    otus.table.to_csv(f"{args.output}.otu.tsv", sep="\t")
+    otus.representatives(top=args.top, names=names).to_csv(f"{args.output}.profiles.tsv", sep="\t")
+    unassigned = int((otus.labels < 0).sum())
+    print(f"Saved {len(otus)} pseudo-OTUs to {args.output}.otu.tsv ({unassigned} reads without classified k-mers)", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import amplikraken
+import amplikraken.taxonomy
+
+def main():
+    args = argparse.ArgumentParser(description='Compile the taxonomy of a Kraken2 database to a memory-mappable file')
+    args.add_argument('INPUT', type=str, help='Kraken2 database (directory or taxo.k2d) or kraken2-inspect output')
+    args.add_argument('-o', '--output', type=str, required=True, help='Output file name')
+    args.add_argument('--verbose', action="store_true", help='Verbose output')
+    args.add_argument('--version', help='Print version and exit', action='version', version=amplikraken.__version__)
+    args = args.parse_args()
+
+    if not os.path.exists(args.INPUT):
+        print(f"File not found: {args.INPUT}", file=sys.stderr)
+        sys.exit(1)
+
+    tree = amplikraken.taxonomy.load_taxonomy(args.INPUT)
+    if tree is None:
+        print(f"ERROR: No taxonomy found in {args.INPUT}", file=sys.stderr)
+        sys.exit(1)
+    tree.index.save(args.output)
+    print(f"Saved {len(tree.index)} taxa to {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 from amplikraken.core import AmplikrakenCore
 import amplikraken.fastq
 import argparse
+import os
 import sys
 
 
@@ -16,6 +17,8 @@ def main():
     args.add_argument('path', type=str, nargs='+', help='Path to fastq files')
     args.add_argument('-a',  action="store_true", help='Print absolute path')
     args.add_argument('-b',  action="store_true", help='Print basename')
+    args.add_argument('-s', '--stats', action="store_true", help='Read the files and print the number of reads and their lengths')
+    args.add_argument('-t', '--threads', type=int, help='Decompression threads per file')
     argz = args.parse_args()
     
 
@@ -24,5 +27,11 @@ def main():
         datasets = amplikraken.fastq.pairedend_samples_from_path(path)
         datasets.displayBasename() if argz.b else datasets.displayAbsolute()
         print(datasets)
+        if argz.stats:
+            for dataset in datasets.datasets.values():
+                if not dataset.valid:
+                    continue
+                for filename, stats in zip((dataset.forward, dataset.reverse), dataset.stats(threads=argz.threads)):
+                    print(dataset.name, os.path.basename(filename), stats.reads, stats.bases, stats.min, stats.max, f"{stats.mean:.1f}", sep="\t")
 if __name__ == '__main__':
     main()
\ No newline at end of file
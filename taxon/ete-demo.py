@@ -58,8 +58,10 @@ def main():
         except Exception as e:
             print("Skipping " + quant, file=sys.stderr)
 
+    # Translate all the taxa with a single query
+    translated = ncbi.get_taxid_translator(list(items))
     for tax, quant in items.items():
-        species = ncbi.get_taxid_translator([tax])
+        species = {int(tax): translated[int(tax)]} if int(tax) in translated else {}
         
         # check if tax is a key of species
          